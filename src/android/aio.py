@@ -0,0 +1,600 @@
+"""
+Copyright (c) 2011 Michael Elsdoerfer <michael@elsdoerfer.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+asyncio versions of ``PlatformTarget`` and ``AndroidProject``.
+
+The external tools are run as asyncio subprocesses, so any number of
+builds can be in progress in a single event loop, without a thread for
+each tool. Cancelling a build kills the tool that is currently running.
+
+Requires Python 3.5 or later.
+"""
+
+import os
+import sys
+import time
+import shutil
+import functools
+import asyncio
+import subprocess
+import tempfile
+from os import path
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+from .tools import Program, ProgramFailedError, _cpu_count
+from .cache import content_key
+from .report import (
+    ToolUsage, BuildReport, record_usage, step, up_to_date, rename)
+from .signing import SigningKey, UnsupportedKeyError, load_keystore, sign_apk
+from . import metrics, packaging
+from .shrinking import keep_rules
+from .axml import derive_resources
+from .sources import partition_sources
+from .build import (
+    PlatformTarget, AndroidProject, CodeObj, ResourceObj, AssetPack, Apk,
+    get_platform,
+    recursive_glob, as_list, mkdir, move_tree, is_current, set_current, log)
+
+
+__all__ = ('AsyncPlatformTarget', 'AsyncAndroidProject',
+           'get_async_platform')
+
+
+def async_build_step(func):
+    """Like ``build_step``, for coroutines.
+    """
+    @functools.wraps(func)
+    async def wrapper(*a, **kw):
+        start = time.time()
+        outcome = 'failed'
+        try:
+            with step(func.__name__):
+                result = await func(*a, **kw)
+            outcome = 'ok'
+            return result
+        finally:
+            metrics.observe('step_duration_seconds', time.time() - start,
+                            {'step': func.__name__, 'result': outcome})
+    return wrapper
+
+
+class AsyncProgram(Program):
+    """Mixin which makes calling a ``Program`` return a coroutine.
+    """
+
+    async def _acquire(self, memory, cpu):
+        """Returns the time spent waiting.
+        """
+        start = time.time()
+        loop = asyncio.get_event_loop()
+        granted = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(
+                lambda: granted.done() or granted.set_result(True))
+        if self.governor.request(memory, cpu, wake):
+            return 0
+        try:
+            await granted
+        except asyncio.CancelledError:
+            if not self.governor.withdraw(wake):
+                self.governor.release(memory, cpu)
+            raise
+        return time.time() - start
+
+    async def execute(self, cmdline, env):
+        cmdline_str = " ".join(cmdline)
+        memory, cpu = self.cost()
+        waited = await self._acquire(memory, cpu)
+        start = time.time()
+        try:
+            if sys.platform == "win32":
+                process = await asyncio.create_subprocess_shell(
+                    subprocess.list2cmdline(cmdline), env=env,
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            else:
+                process = await asyncio.create_subprocess_exec(
+                    *cmdline, env=env,
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            try:
+                stdout, stderr = await process.communicate()
+            except asyncio.CancelledError:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                raise
+        finally:
+            self.governor.release(memory, cpu)
+        # The event loop reaps the process, so there is no rusage.
+        usage = ToolUsage(
+            tool=self.__class__.__name__[len('Async'):],
+            cmdline=cmdline_str, returncode=process.returncode,
+            queue_wait=waited, wall=time.time() - start)
+        record_usage(usage)
+        self.emit_metrics(usage)
+        if process.returncode != 0:
+            raise ProgramFailedError(
+                cmdline_str, process.returncode, stdout, stderr)
+        return cmdline_str
+
+
+_async_classes = {}
+
+
+def make_async(program):
+    """Return a copy of the ``Program`` instance ``program`` which
+    runs the tool asynchronously.
+    """
+    if program is None:
+        return None
+    cls = program.__class__
+    if cls not in _async_classes:
+        _async_classes[cls] = type(
+            'Async%s' % cls.__name__, (AsyncProgram, cls), {})
+    new = object.__new__(_async_classes[cls])
+    new.__dict__.update(program.__dict__)
+    return new
+
+
+def make_sync(program):
+    """The reverse of ``make_async``.
+    """
+    if program is None or not isinstance(program, AsyncProgram):
+        return program
+    new = object.__new__(program.__class__.__bases__[1])
+    new.__dict__.update(program.__dict__)
+    return new
+
+
+class AsyncPlatformTarget(PlatformTarget):
+    """Like ``PlatformTarget``, but the build steps are coroutines.
+
+    Use ``from_platform()`` to convert an existing platform.
+    """
+
+    tools = ('dx', 'aapt', 'aidl', 'llvmRs', 'zipalign', 'apkbuilder',
+             'javac', 'ndk_build', 'ndk_clean', 'jarsigner', 'proguard')
+
+    def __init__(self, *a, **kw):
+        PlatformTarget.__init__(self, *a, **kw)
+        self._make_tools_async()
+
+    @classmethod
+    def from_platform(cls, platform):
+        new = object.__new__(cls)
+        new.__dict__.update(platform.__dict__)
+        new._make_tools_async()
+        return new
+
+    def _make_tools_async(self):
+        for name in self.tools:
+            setattr(self, name, make_async(getattr(self, name)))
+
+    def to_sync(self):
+        """Return a ``PlatformTarget`` with the same tools and
+        settings, for work which is done in a thread.
+        """
+        new = object.__new__(PlatformTarget)
+        new.__dict__.update(self.__dict__)
+        for name in self.tools:
+            setattr(new, name, make_sync(getattr(self, name)))
+        return new
+
+    async def _run_blocking(self, func, *args):
+        if contextvars:
+            # So that what happens in the thread goes into the report
+            # of the caller.
+            args = (func, ) + args
+            func = contextvars.copy_context().run
+        return await asyncio.get_event_loop().run_in_executor(
+            None, func, *args)
+
+    async def _cached(self, step, output, inputs, build, **params):
+        if not self.cache or not self.cache.enabled:
+            await build()
+            return
+        key = await self._run_blocking(
+            lambda: content_key(step, inputs, platform=self.version, **params))
+        if await self._run_blocking(self.cache.get, key, output):
+            metrics.increment('cache_requests_total',
+                              tags={'step': step, 'result': 'hit'})
+            log.info('Using cached %s for %s' % (step, output))
+            return
+        metrics.increment('cache_requests_total',
+                          tags={'step': step, 'result': 'miss'})
+        await build()
+        self.cache.put(key, output)
+
+    async def _log(self, coro):
+        log.info(await coro)
+
+    @async_build_step
+    async def generate_r(self, manifest, resource_dir, output_dir,
+                         extra_packages=[], non_constant_id=False):
+        mkdir(output_dir)
+        log.info(await self.aapt(**self._r_args(
+            manifest, resource_dir, output_dir, extra_packages,
+            non_constant_id)))
+
+    @async_build_step
+    async def compile_renderscript(self, resource_dir, source_gen_dir,
+                                   source_dirs):
+        files_list = recursive_glob(source_dirs, '*.rs')
+        if not files_list:
+            return
+        log.info(await self.llvmRs(
+            path.join(resource_dir, 'raw'),
+            source_gen_dir,
+            files_list,
+            self.rs_includes
+        ))
+
+    @async_build_step
+    async def compile_aidl(self, source_dirs, output_dir, import_dirs=[]):
+        # The files are independent of each other.
+        await asyncio.gather(*[
+            self._log(self.aidl(
+                filename,
+                preprocessed=self.framework_aidl,
+                search_path=as_list(source_dirs) + import_dirs,
+                output_folder=output_dir))
+            for filename in recursive_glob(source_dirs, '*.aidl')])
+
+    @async_build_step
+    async def compile_java(self, source_dirs, output_dir, extra_jars=[],
+                           debug=False, target='1.5', partitions=None):
+        source_files = recursive_glob(source_dirs, '*.java')
+        jar_files = await self._run_blocking(self.jars.resolve, extra_jars)
+        mkdir(output_dir, True)
+        options = dict(target=target, debug=debug)
+        if partitions:
+            stages = await self._run_blocking(lambda: partition_sources(
+                self._source_units(source_files, partitions), _cpu_count()))
+            if sum(len(chunks) for chunks in stages) > 1:
+                try:
+                    return await self._compile_stages(
+                        stages, output_dir, jar_files, options)
+                except ProgramFailedError as e:
+                    log.warning('Compiling in parts failed, compiling all '
+                                'sources together: %s' % e)
+        await self._javac(source_files, output_dir, jar_files, options)
+
+    async def _compile_stages(self, stages, output_dir, jar_files, options):
+        work_dir = tempfile.mkdtemp(
+            prefix='javac-', dir=path.dirname(path.normpath(output_dir)))
+        try:
+            classpath = list(jar_files)
+            for i, chunks in enumerate(stages):
+                stage_dir = path.join(work_dir, str(i))
+                mkdir(stage_dir)
+                await asyncio.gather(*[
+                    self._javac(files, stage_dir, classpath, options)
+                    for files in chunks])
+                classpath.append(stage_dir)
+            for stage_dir in classpath[len(jar_files):]:
+                await self._run_blocking(move_tree, stage_dir, output_dir)
+        finally:
+            shutil.rmtree(work_dir)
+
+    async def _javac(self, source_files, output_dir, classpath, options):
+        fd, argfile = tempfile.mkstemp(suffix='.javac')
+        os.close(fd)
+        try:
+            log.info(await self.javac(
+                source_files,
+                destdir=output_dir,
+                classpath=classpath,
+                bootclasspath=self.framework_library,
+                argfile=argfile,
+                **options))
+        finally:
+            os.unlink(argfile)
+
+    @async_build_step
+    async def shrink(self, manifest, class_dir, output, extra_jars=[],
+                     configs=[], optimize=False):
+        output = path.abspath(output)
+        jar_files = await self._run_blocking(self.jars.resolve, extra_jars)
+        inputs = [manifest, class_dir] + jar_files + list(configs)
+        fingerprint = await self._run_blocking(lambda: content_key(
+            'shrink', inputs, platform=self.version, optimize=optimize))
+        if is_current(output, fingerprint):
+            log.info('Shrunk code is up-to-date: %s' % output)
+            up_to_date()
+            return output
+
+        async def build():
+            keep_file = '%s.pro' % output
+            with open(keep_file, 'w') as f:
+                f.write(keep_rules(manifest, optimize=optimize))
+            try:
+                await self._log(self.proguard(
+                    [class_dir] + jar_files, output,
+                    libraryjars=[self.framework_library],
+                    configs=[keep_file] + list(configs)))
+            finally:
+                os.unlink(keep_file)
+        await self._cached('shrink', output, inputs, build,
+                           optimize=optimize)
+        set_current(output, fingerprint)
+        return output
+
+    @async_build_step
+    async def compile_native(self, project_dir):
+        log.info(await self.ndk_build(project_dir))
+
+    @async_build_step
+    async def clean_native(self, project_dir):
+        log.info(await self.ndk_clean(project_dir))
+
+    @async_build_step
+    async def dex(self, source_dir, output=None, extra_jars=[]):
+        if not output:
+            _, output = tempfile.mkstemp(suffix='.dex')
+        output = path.abspath(output)
+        jar_files = await self._run_blocking(self.jars.resolve, extra_jars)
+        await self._cached(
+            'dex', output, [source_dir] + jar_files,
+            lambda: self._log(self.dx([source_dir] + jar_files,
+                                      output=output)))
+        return CodeObj(output)
+
+    @async_build_step
+    async def compile(self, manifest, project_dir, source_dirs, resource_dir,
+                      source_gen_dir=None, class_gen_dir=None,
+                      dex_output=None, extra_jars=[], libraries=[],
+                      shrink=False, optimize=False, proguard_config=[],
+                      **kwargs):
+        to_delete = []
+        if not source_gen_dir:
+            source_gen_dir = tempfile.mkdtemp()
+            to_delete.append(source_gen_dir)
+        if not class_gen_dir:
+            class_gen_dir = tempfile.mkdtemp()
+            to_delete.append(class_gen_dir)
+        try:
+            source_dirs = as_list(source_dirs)
+            libs = self._library_args(libraries)
+            await self.compile_renderscript(
+                resource_dir, source_gen_dir, source_dirs)
+            # R.java and the AIDL interfaces do not depend on each other.
+            await asyncio.gather(
+                self.generate_r(
+                    manifest, [resource_dir] + libs['resource_dirs'],
+                    source_gen_dir, extra_packages=libs['packages']),
+                self.compile_aidl(source_dirs, source_gen_dir,
+                                  import_dirs=libs['source_dirs']))
+            if self.ndk_build is not None:
+                await self.compile_native(project_dir)
+            await self.compile_java(
+                source_dirs + [source_gen_dir], class_gen_dir,
+                extra_jars=extra_jars + libs['class_jars'], **kwargs)
+            if shrink:
+                if class_gen_dir in to_delete:
+                    shrink_dir = tempfile.mkdtemp()
+                    to_delete.append(shrink_dir)
+                else:
+                    shrink_dir = path.dirname(path.normpath(class_gen_dir))
+                shrunk = await self.shrink(
+                    manifest, class_gen_dir,
+                    path.join(shrink_dir, 'classes-shrunk.jar'),
+                    extra_jars=extra_jars + libs['class_jars'],
+                    configs=proguard_config, optimize=optimize)
+                return await self.dex(shrunk, output=dex_output)
+            return await self.dex(
+                class_gen_dir, output=dex_output,
+                extra_jars=extra_jars + libs['dex_jars'])
+        finally:
+            for d in to_delete:
+                log.info('Deleting tree: %s' % d)
+                shutil.rmtree(d)
+
+    @async_build_step
+    async def pack_resources(self, manifest, resource_dir, asset_dir=None,
+                             configurations=None, package_name=None,
+                             version_code=None, version_name=None,
+                             output=None):
+        if not output:
+            _, output = tempfile.mkstemp(suffix='.ap_')
+        output = path.abspath(output)
+        if not self._is_variant(package_name, version_code, version_name):
+            await self._pack_resources(
+                manifest, resource_dir, asset_dir, configurations, output)
+            return ResourceObj(output)
+
+        base = self._base_resources(output)
+        locks = self.__dict__.setdefault('_base_locks', {})
+        async with locks.setdefault(base, asyncio.Lock()):
+            fingerprint = await self._run_blocking(
+                self._resources_fingerprint, manifest, resource_dir,
+                asset_dir, configurations)
+            if is_current(base, fingerprint):
+                log.info('Using packaged resources %s' % base)
+                rename('derive_resources')
+            else:
+                rename('pack_base_resources')
+                await self._pack_resources(
+                    manifest, resource_dir, asset_dir, configurations, base)
+                set_current(base, fingerprint)
+        await self._run_blocking(functools.partial(
+            derive_resources, base, output, package_name, version_code,
+            version_name, date_time=self._date_time()))
+        return ResourceObj(output)
+
+    async def _pack_resources(self, manifest, resource_dir, asset_dir,
+                              configurations, output):
+        kwargs = self._package_args(
+            manifest, resource_dir, asset_dir, configurations, None,
+            None, None, output)
+        async def build():
+            await self._log(self.aapt(**kwargs))
+            await self._run_blocking(self._normalized, output)
+        await self._cached(
+            'pack_resources', output,
+            [manifest] + as_list(resource_dir) + [asset_dir],
+            build, configurations=configurations,
+            uncompressed=bool(self.deflater),
+            deterministic=self.deterministic)
+
+    @async_build_step
+    async def pack_assets(self, asset_dir, output_dir):
+        return await self._run_blocking(
+            self._pack_assets, asset_dir, output_dir)
+
+    @async_build_step
+    async def build_apk(self, output, code=None, resources=None,
+                        jar_paths=[], native_dirs=[], source_dirs=[],
+                        assets=None):
+        output = path.abspath(output)
+        kwargs = self._apkbuilder_args(
+            output, code, resources, jar_paths, native_dirs, source_dirs)
+        packed = [assets.filename if isinstance(assets, AssetPack)
+                  else assets] if assets else []
+        async def build():
+            if self.deflater:
+                await self._run_blocking(functools.partial(
+                    packaging.build_apk, deflater=self.deflater,
+                    packed=packed, date_time=self._date_time(), **kwargs))
+            else:
+                await self._log(self.apkbuilder(
+                    **dict(kwargs, zips=kwargs.get('zips', []) + packed)))
+                await self._run_blocking(self._normalized, output)
+        await self._cached('build_apk', output,
+                           self._apkbuilder_inputs(kwargs) + packed, build,
+                           deterministic=self.deterministic)
+        metrics.observe('apk_size_bytes', path.getsize(output))
+        return Apk(self, output)
+
+    @async_build_step
+    async def sign(self, apk, keystore, alias, password):
+        log.info(await self.jarsigner(
+            apk.filename if isinstance(apk, Apk) else apk,
+            keystore=keystore, alias=alias, password=password))
+
+    @async_build_step
+    async def align(self, apk, output=None):
+        infile = apk.filename if isinstance(apk, Apk) else apk
+        if output:
+            outfile = output
+        else:
+            # Next to the input, to be renamed over it; concurrent
+            # aligns of the same file each get their own.
+            fd, outfile = tempfile.mkstemp(
+                suffix='.align', dir=path.dirname(path.abspath(infile)))
+            os.close(fd)
+        try:
+            log.info(await self.zipalign(infile, outfile, align=4,
+                                         force=True))
+        except:
+            if not output and path.exists(outfile):
+                os.unlink(outfile)
+            raise
+        if not output:
+            # Not the private mode of the temporary file.
+            shutil.copymode(infile, outfile)
+            log.info('Renaming %s to %s' % (outfile, infile))
+            os.rename(outfile, infile)
+            return apk
+        return Apk(self, outfile)
+
+    @async_build_step
+    async def sign_and_align(self, apk, keystore, alias=None, password=None,
+                             output=None, digest='SHA1'):
+        infile = apk.filename if isinstance(apk, Apk) else apk
+        if not isinstance(keystore, SigningKey):
+            try:
+                keystore = load_keystore(keystore, alias, password)
+            except UnsupportedKeyError as e:
+                log.info('%s, using jarsigner' % e)
+                await self.sign(apk, keystore, alias, password)
+                return await self.align(apk, output)
+        # Hashing and RSA are CPU-bound.
+        await self._run_blocking(functools.partial(
+            sign_apk, infile, keystore, output=output, digest=digest,
+            date_time=self._date_time()))
+        if not output:
+            return apk
+        return Apk(self, output)
+
+
+def get_async_platform(*a, **kw):
+    """Like ``get_platform``, but returns an ``AsyncPlatformTarget``.
+    """
+    return AsyncPlatformTarget.from_platform(get_platform(*a, **kw))
+
+
+class AsyncAndroidProject(AndroidProject):
+    """Like ``AndroidProject``, but ``compile()`` and ``build()`` are
+    coroutines.
+    """
+
+    def __init__(self, *a, **kw):
+        AndroidProject.__init__(self, *a, **kw)
+        if not isinstance(self.platform, AsyncPlatformTarget):
+            self.platform = AsyncPlatformTarget.from_platform(self.platform)
+        self._compiling = None
+
+    async def compile(self):
+        # Libraries are compiled in a thread, as they are shared with
+        # synchronous projects.
+        sync_platform = self.platform.to_sync()
+        libraries = await self.platform._run_blocking(
+            self._compile_libraries, sync_platform)
+        self.code = await self.platform.compile(
+            libraries=libraries, **self._compile_args())
+        await self.platform._run_blocking(
+            self._shrink_resources, sync_platform, libraries)
+
+    async def _ensure_compiled(self):
+        # Concurrent build() calls should only compile once.
+        if self._compiling is None:
+            self._compiling = asyncio.ensure_future(self.compile())
+        try:
+            await asyncio.shield(self._compiling)
+        except Exception:
+            self._compiling = None
+            raise
+
+    async def build(self, output=None, config=None, package_name=None,
+                    version_code=None, version_name=None):
+        report = BuildReport(self.name)
+        try:
+            with report.activate():
+                if not hasattr(self, 'code'):
+                    await self._ensure_compiled()
+                resources = await self.platform.pack_resources(
+                    **self._resource_args(
+                        config, package_name, version_code, version_name))
+                assets = await self.platform.pack_assets(
+                    self.asset_dir, self.out_dir) \
+                    if self._use_asset_pack() else None
+                apk = await self.platform.build_apk(
+                    resources=resources, assets=assets,
+                    **self._apk_args(output))
+            self._finish_report(apk, report)
+        finally:
+            metrics.flush()
+        return apk
+
+    async def clean(self):
+        if path.exists(self.out_dir):
+            shutil.rmtree(self.out_dir)
+        if path.exists(self.gen_dir):
+            shutil.rmtree(self.gen_dir)
+        if self.platform.ndk_clean:
+            await self.platform.clean_native(self.project_dir)
@@ -0,0 +1,266 @@
+"""
+Copyright (c) 2011 Michael Elsdoerfer <michael@elsdoerfer.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Reading and writing the zip files that APKs are.
+
+Python's ``zipfile`` always decompresses, and cannot align entries. The
+classes here copy entries from one archive to another as they are, in
+their compressed form, and align uncompressed entries the way
+``zipalign`` does, so that an APK can be post-processed in a single pass.
+"""
+
+import os
+import copy
+import zlib
+import struct
+import zipfile
+
+
+__all__ = ('ApkReader', 'ApkWriter', 'ZipEntry', 'normalize',
+           'DETERMINISTIC_TIME')
+
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+END_RECORD = struct.Struct('<IHHHHIIH')
+
+LOCAL_SIGNATURE = 0x04034b50
+CENTRAL_SIGNATURE = 0x02014b50
+END_SIGNATURE = 0x06054b50
+
+STORED = zipfile.ZIP_STORED
+DEFLATED = zipfile.ZIP_DEFLATED
+
+FLAG_UTF8 = 0x800
+
+CHUNK_SIZE = 256 * 1024
+
+# What the Android platform build uses; Java misreads 1980-01-01 in
+# some timezones.
+DETERMINISTIC_TIME = (2008, 1, 1, 0, 0, 0)
+
+
+def dos_time(date_time):
+    year, month, day, hour, minute, second = date_time[:6]
+    return ((hour << 11) | (minute << 5) | (second // 2),
+            ((max(year, 1980) - 1980) << 9) | (month << 5) | day)
+
+
+class ZipEntry(object):
+    """Describes an entry to write, or one that was read.
+
+    ``compress_size`` is the size of the data as stored, ``crc`` and
+    ``file_size`` refer to the uncompressed data.
+    """
+
+    def __init__(self, name, method=DEFLATED, crc=0, compress_size=0,
+                 file_size=0, date_time=(1980, 1, 1, 0, 0, 0),
+                 external_attr=0, offset=None):
+        self.name = name
+        self.method = method
+        self.crc = crc
+        self.compress_size = compress_size
+        self.file_size = file_size
+        self.date_time = date_time
+        self.external_attr = external_attr
+        # Of the local header; set for entries read, or once written.
+        self.offset = offset
+
+    def __repr__(self):
+        return '%s <%s>' % (self.__class__.__name__, self.name)
+
+    @property
+    def is_dir(self):
+        return self.name.endswith('/')
+
+    @classmethod
+    def from_info(cls, info):
+        return cls(info.filename, info.compress_type, info.CRC,
+                   info.compress_size, info.file_size, info.date_time,
+                   info.external_attr, info.header_offset)
+
+
+class ApkReader(object):
+    """Gives access to the raw, still compressed data of the entries in
+    a zip file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with zipfile.ZipFile(filename) as archive:
+            self.entries = [ZipEntry.from_info(i) for i in archive.infolist()]
+        self.file = open(filename, 'rb')
+
+    def __repr__(self):
+        return '%s <%s>' % (self.__class__.__name__, self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def data_offset(self, entry):
+        """Return where the data of ``entry`` starts in the file.
+        """
+        self.file.seek(entry.offset)
+        header = LOCAL_HEADER.unpack(self.file.read(LOCAL_HEADER.size))
+        if header[0] != LOCAL_SIGNATURE:
+            raise ValueError('Bad local header for %s' % entry.name)
+        return entry.offset + LOCAL_HEADER.size + header[9] + header[10]
+
+    def raw_chunks(self, entry):
+        """Yield the data of ``entry`` as it is stored in the file.
+        """
+        self.file.seek(self.data_offset(entry))
+        remaining = entry.compress_size
+        while remaining:
+            chunk = self.file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise ValueError('Truncated entry %s' % entry.name)
+            remaining -= len(chunk)
+            yield chunk
+
+    def chunks(self, entry):
+        """Yield the uncompressed data of ``entry``.
+        """
+        if entry.method == STORED:
+            for chunk in self.raw_chunks(entry):
+                yield chunk
+            return
+        if entry.method != DEFLATED:
+            raise ValueError('Unsupported compression method %d for %s' % (
+                entry.method, entry.name))
+        decompressor = zlib.decompressobj(-15)
+        for chunk in self.raw_chunks(entry):
+            yield decompressor.decompress(chunk)
+        yield decompressor.flush()
+
+    def read(self, entry):
+        return b''.join(self.chunks(entry))
+
+
+class ApkWriter(object):
+    """Writes a zip file to ``file``, an object opened for writing.
+
+    Sizes and CRC always go into the local headers, never into data
+    descriptors. Uncompressed entries are aligned to ``align`` bytes by
+    padding the extra field of their local header, like ``zipalign``
+    does.
+
+    If ``date_time`` is given, all entries get this timestamp, and no
+    file permissions, regardless of what they had.
+    """
+
+    def __init__(self, file, align=4, date_time=None):
+        self.file = file
+        self.align = align
+        self.date_time = date_time
+        self.entries = []
+        self.offset = 0
+
+    def _write(self, data):
+        self.file.write(data)
+        self.offset += len(data)
+
+    def _name(self, entry):
+        try:
+            return entry.name.encode('ascii'), 0
+        except UnicodeError:
+            return entry.name.encode('utf-8'), FLAG_UTF8
+        except AttributeError:
+            # Already bytes
+            return entry.name, 0
+
+    def write_raw(self, entry, chunks):
+        """Write ``entry``, with its data given as ``chunks`` in stored
+        form; that is, compressed if the entry is. Returns the entry as
+        written.
+        """
+        # The entry may well be one that is being read.
+        entry = copy.copy(entry)
+        if self.date_time:
+            entry.date_time = self.date_time
+            entry.external_attr = 0
+        name, flags = self._name(entry)
+        extra = b''
+        if entry.method == STORED and self.align:
+            data_offset = self.offset + LOCAL_HEADER.size + len(name)
+            extra = b'\0' * ((self.align - data_offset % self.align)
+                             % self.align)
+        entry.offset = self.offset
+        time, date = dos_time(entry.date_time)
+        self._write(LOCAL_HEADER.pack(
+            LOCAL_SIGNATURE, 20, flags, entry.method, time, date,
+            entry.crc & 0xffffffff, entry.compress_size, entry.file_size,
+            len(name), len(extra)))
+        self._write(name)
+        self._write(extra)
+        written = 0
+        for chunk in chunks:
+            self._write(chunk)
+            written += len(chunk)
+        if written != entry.compress_size:
+            raise ValueError('Expected %d bytes for %s, got %d' % (
+                entry.compress_size, entry.name, written))
+        self.entries.append(entry)
+        return entry
+
+    def write(self, name, data, compress=True, **kwargs):
+        """Write ``data`` as entry ``name``.
+        """
+        entry = ZipEntry(name, DEFLATED if compress else STORED,
+                         zlib.crc32(data), file_size=len(data), **kwargs)
+        if compress:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+            data = compressor.compress(data) + compressor.flush()
+        entry.compress_size = len(data)
+        return self.write_raw(entry, [data])
+
+    def close(self):
+        """Write the central directory. Does not close ``file``.
+        """
+        start = self.offset
+        for entry in self.entries:
+            name, flags = self._name(entry)
+            time, date = dos_time(entry.date_time)
+            self._write(CENTRAL_HEADER.pack(
+                CENTRAL_SIGNATURE, 20, 20, flags, entry.method, time, date,
+                entry.crc & 0xffffffff, entry.compress_size, entry.file_size,
+                len(name), 0, 0, 0, 0, entry.external_attr, entry.offset))
+            self._write(name)
+        size = self.offset - start
+        self._write(END_RECORD.pack(
+            END_SIGNATURE, 0, 0, len(self.entries), len(self.entries),
+            size, start, 0))
+
+
+def normalize(filename, date_time=DETERMINISTIC_TIME, align=4):
+    """Rewrite the zip file ``filename`` with its entries sorted by
+    name, the same ``date_time`` for all of them and no permissions, so
+    that it only depends on the content. The entries are copied in
+    their compressed form.
+    """
+    tmp = '%s.normalize' % filename
+    with ApkReader(filename) as reader:
+        with open(tmp, 'wb') as f:
+            writer = ApkWriter(f, align, date_time)
+            for entry in sorted(reader.entries, key=lambda e: e.name):
+                writer.write_raw(entry, reader.raw_chunks(entry))
+            writer.close()
+    os.rename(tmp, filename)
@@ -0,0 +1,428 @@
+"""
+Copyright (c) 2011 Michael Elsdoerfer <michael@elsdoerfer.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Editing the compiled, binary XML that ``aapt`` turns the
+``AndroidManifest.xml`` file into.
+
+A document is parsed into a list of nodes which hold their strings
+rather than indexes into the string pool, and on writing, a new string
+pool and resource map are built. So attributes can be changed and added
+freely; see ``edit_manifest()``.
+
+The format is defined in frameworks/base: include/androidfw/ResourceTypes.h.
+"""
+
+import struct
+
+from .apkzip import ApkReader, ApkWriter
+
+
+__all__ = ('Document', 'Attribute', 'edit_manifest', 'derive_resources')
+
+
+RES_STRING_POOL_TYPE = 0x0001
+RES_XML_TYPE = 0x0003
+RES_XML_START_NAMESPACE_TYPE = 0x0100
+RES_XML_END_NAMESPACE_TYPE = 0x0101
+RES_XML_START_ELEMENT_TYPE = 0x0102
+RES_XML_END_ELEMENT_TYPE = 0x0103
+RES_XML_CDATA_TYPE = 0x0104
+RES_XML_RESOURCE_MAP_TYPE = 0x0180
+
+UTF8_FLAG = 0x100
+NO_ENTRY = 0xffffffff
+
+TYPE_STRING = 0x03
+TYPE_INT_DEC = 0x10
+
+ANDROID_NS = 'http://schemas.android.com/apk/res/android'
+
+# Resource ids of the android: attributes we may add.
+ATTRIBUTE_IDS = {
+    'name': 0x01010003,
+    'versionCode': 0x0101021b,
+    'versionName': 0x0101021c,
+}
+
+# Elements whose android:name is a class, and may be relative to the
+# package.
+COMPONENTS = ('application', 'activity', 'activity-alias', 'service',
+              'receiver', 'provider', 'instrumentation')
+CLASS_ATTRIBUTES = ('name', 'backupAgent', 'manageSpaceActivity',
+                    'targetActivity')
+
+CHUNK_HEADER = struct.Struct('<HHI')
+NODE_HEADER = struct.Struct('<HHIII')
+ELEMENT = struct.Struct('<IIHHHHHH')
+ATTRIBUTE = struct.Struct('<IIIHBBI')
+
+
+class Attribute(object):
+    """An attribute of an element. ``value`` is the typed value; a
+    string for ``TYPE_STRING``, otherwise the 32-bit ``data``.
+    """
+
+    def __init__(self, ns, name, raw, type, value, resource_id=0):
+        self.ns = ns
+        self.name = name
+        self.raw = raw
+        self.type = type
+        self.value = value
+        self.resource_id = resource_id
+
+    def __repr__(self):
+        return '%s <%s=%r>' % (self.__class__.__name__, self.name,
+                               self.value)
+
+
+class Node(object):
+    """A node of the document: ``kind`` is the chunk type, ``strings``
+    the string fields in the order they are written, ``extra`` any
+    further data.
+    """
+
+    def __init__(self, kind, line, comment, strings, extra=None):
+        self.kind = kind
+        self.line = line
+        self.comment = comment
+        self.strings = strings
+        self.extra = extra
+        self.attributes = []
+        self.special = (0, 0, 0)
+
+    @property
+    def name(self):
+        return self.strings[1]
+
+    def get(self, name, ns=ANDROID_NS):
+        for attribute in self.attributes:
+            if attribute.name == name and attribute.ns == ns:
+                return attribute
+        return None
+
+
+def _read_string_pool(data, offset):
+    (type, header_size, size, count, style_count, flags,
+     strings_start, styles_start) = struct.unpack_from('<HHIIIIII', data,
+                                                       offset)
+    utf8 = bool(flags & UTF8_FLAG)
+    offsets = struct.unpack_from('<%dI' % count, data, offset + header_size)
+    base = offset + strings_start
+    strings = []
+    for start in offsets:
+        pos = base + start
+        if utf8:
+            # The length in UTF-16 units, then in bytes.
+            for i in range(2):
+                length = ord(data[pos:pos + 1])
+                if length & 0x80:
+                    length = ((length & 0x7f) << 8) | ord(data[pos + 1:pos + 2])
+                    pos += 2
+                else:
+                    pos += 1
+            strings.append(data[pos:pos + length].decode('utf-8'))
+        else:
+            length = struct.unpack_from('<H', data, pos)[0]
+            if length & 0x8000:
+                length = ((length & 0x7fff) << 16) | \
+                    struct.unpack_from('<H', data, pos + 2)[0]
+                pos += 2
+            pos += 2
+            strings.append(data[pos:pos + length * 2].decode('utf-16-le'))
+    return strings, utf8, style_count
+
+
+def _string_bytes(string, utf8):
+    if utf8:
+        encoded = string.encode('utf-8')
+        result = b''
+        for length in (len(string.encode('utf-16-le')) // 2, len(encoded)):
+            if length > 0x7f:
+                result += struct.pack('BB', 0x80 | (length >> 8),
+                                      length & 0xff)
+            else:
+                result += struct.pack('B', length)
+        return result + encoded + b'\0'
+    encoded = string.encode('utf-16-le')
+    length = len(encoded) // 2
+    if length > 0x7fff:
+        prefix = struct.pack('<HH', 0x8000 | (length >> 16), length & 0xffff)
+    else:
+        prefix = struct.pack('<H', length)
+    return prefix + encoded + b'\0\0'
+
+
+def _pad(data):
+    return data + b'\0' * (-len(data) % 4)
+
+
+class Document(object):
+    """A binary XML document.
+    """
+
+    def __init__(self, nodes, utf8=False):
+        self.nodes = nodes
+        self.utf8 = utf8
+
+    @property
+    def root(self):
+        for node in self.nodes:
+            if node.kind == RES_XML_START_ELEMENT_TYPE:
+                return node
+
+    def elements(self):
+        return [n for n in self.nodes if n.kind == RES_XML_START_ELEMENT_TYPE]
+
+    @classmethod
+    def parse(cls, data):
+        type, header_size, size = CHUNK_HEADER.unpack_from(data, 0)
+        if type != RES_XML_TYPE:
+            raise ValueError('Not a binary XML file')
+        strings, utf8, resource_ids = [], False, ()
+        nodes = []
+
+        def string(index):
+            return None if index == NO_ENTRY else strings[index]
+
+        offset = header_size
+        while offset < size:
+            type, header_size, chunk_size = CHUNK_HEADER.unpack_from(
+                data, offset)
+            if type == RES_STRING_POOL_TYPE:
+                strings, utf8, style_count = _read_string_pool(data, offset)
+                if style_count:
+                    raise ValueError('Styled strings are not supported')
+            elif type == RES_XML_RESOURCE_MAP_TYPE:
+                resource_ids = struct.unpack_from(
+                    '<%dI' % ((chunk_size - header_size) // 4), data,
+                    offset + header_size)
+            elif RES_XML_START_NAMESPACE_TYPE <= type <= RES_XML_CDATA_TYPE:
+                line, comment = NODE_HEADER.unpack_from(data, offset)[3:]
+                body = offset + header_size
+                if type in (RES_XML_START_NAMESPACE_TYPE,
+                            RES_XML_END_NAMESPACE_TYPE,
+                            RES_XML_END_ELEMENT_TYPE):
+                    indexes = struct.unpack_from('<II', data, body)
+                    node = Node(type, line, string(comment),
+                                [string(i) for i in indexes])
+                elif type == RES_XML_CDATA_TYPE:
+                    text, size_, res0, data_type, value = \
+                        struct.unpack_from('<IHBBI', data, body)
+                    node = Node(type, line, string(comment), [string(text)],
+                                (data_type, string(value)
+                                 if data_type == TYPE_STRING else value))
+                else:
+                    (ns, name, attr_start, attr_size, count, id_index,
+                     class_index, style_index) = ELEMENT.unpack_from(
+                         data, body)
+                    node = Node(type, line, string(comment),
+                                [string(ns), string(name)])
+                    attributes = []
+                    for i in range(count):
+                        (a_ns, a_name, raw, a_size, res0, data_type,
+                         value) = ATTRIBUTE.unpack_from(
+                             data, body + attr_start + i * attr_size)
+                        attributes.append(Attribute(
+                            string(a_ns), string(a_name), string(raw),
+                            data_type, string(value)
+                            if data_type == TYPE_STRING else value,
+                            resource_ids[a_name]
+                            if a_name < len(resource_ids) else 0))
+                    node.attributes = attributes
+                    node.special = tuple(
+                        attributes[i - 1] if i else None
+                        for i in (id_index, class_index, style_index))
+                nodes.append(node)
+            else:
+                raise ValueError('Unexpected chunk type 0x%x' % type)
+            offset += chunk_size
+        return cls(nodes, utf8)
+
+    def _pool(self):
+        """Return the strings, in the order they go into the pool, and
+        the resource ids of the first of them.
+        """
+        # Attribute names with a resource id come first, so that the
+        # resource map can refer to them.
+        named = []
+        others = []
+        for node in self.nodes:
+            for attribute in node.attributes:
+                key = (attribute.name, attribute.resource_id)
+                if attribute.resource_id and not key in named:
+                    named.append(key)
+        named.sort(key=lambda k: k[1])
+
+        def add(string):
+            if string is not None and not string in others:
+                others.append(string)
+        for node in self.nodes:
+            add(node.comment)
+            for string in node.strings:
+                add(string)
+            for attribute in node.attributes:
+                add(attribute.ns)
+                if not attribute.resource_id:
+                    add(attribute.name)
+                add(attribute.raw)
+                if attribute.type == TYPE_STRING:
+                    add(attribute.value)
+            if node.extra and node.extra[0] == TYPE_STRING:
+                add(node.extra[1])
+        return [n for n, _ in named] + others, [i for _, i in named]
+
+    def to_bytes(self):
+        strings, resource_ids = self._pool()
+        named = dict(((s, i), n) for n, (s, i) in
+                     enumerate(zip(strings, resource_ids)))
+        index = {}
+        for n, string in enumerate(strings[len(resource_ids):]):
+            index.setdefault(string, n + len(resource_ids))
+
+        def ref(string):
+            return NO_ENTRY if string is None else index[string]
+
+        # String pool
+        offsets = []
+        data = b''
+        for string in strings:
+            offsets.append(len(data))
+            data += _string_bytes(string, self.utf8)
+        data = _pad(data)
+        header_size = 28
+        strings_start = header_size + 4 * len(strings)
+        pool = struct.pack(
+            '<HHIIIIII', RES_STRING_POOL_TYPE, header_size,
+            strings_start + len(data), len(strings), 0,
+            UTF8_FLAG if self.utf8 else 0, strings_start, 0) + \
+            struct.pack('<%dI' % len(strings), *offsets) + data
+
+        chunks = [pool]
+        if resource_ids:
+            chunks.append(CHUNK_HEADER.pack(
+                RES_XML_RESOURCE_MAP_TYPE, 8, 8 + 4 * len(resource_ids)) +
+                struct.pack('<%dI' % len(resource_ids), *resource_ids))
+
+        for node in self.nodes:
+            if node.kind == RES_XML_START_ELEMENT_TYPE:
+                body = ELEMENT.pack(
+                    ref(node.strings[0]), ref(node.strings[1]),
+                    ELEMENT.size, ATTRIBUTE.size, len(node.attributes),
+                    *[node.attributes.index(a) + 1
+                      if a in node.attributes else 0
+                      for a in node.special])
+                for attribute in node.attributes:
+                    if attribute.resource_id:
+                        name = named[(attribute.name, attribute.resource_id)]
+                    else:
+                        name = ref(attribute.name)
+                    value = ref(attribute.value) \
+                        if attribute.type == TYPE_STRING else attribute.value
+                    body += ATTRIBUTE.pack(
+                        ref(attribute.ns), name, ref(attribute.raw), 8, 0,
+                        attribute.type, value)
+            elif node.kind == RES_XML_CDATA_TYPE:
+                data_type, value = node.extra
+                body = struct.pack(
+                    '<IHBBI', ref(node.strings[0]), 8, 0, data_type,
+                    ref(value) if data_type == TYPE_STRING else value)
+            else:
+                body = struct.pack('<II', *[ref(s) for s in node.strings])
+            chunks.append(NODE_HEADER.pack(
+                node.kind, NODE_HEADER.size, NODE_HEADER.size + len(body),
+                node.line, ref(node.comment)) + body)
+
+        body = b''.join(chunks)
+        return CHUNK_HEADER.pack(RES_XML_TYPE, 8, 8 + len(body)) + body
+
+
+def _qualify(name, package):
+    if name.startswith('.'):
+        return package + name
+    if not '.' in name:
+        return '%s.%s' % (package, name)
+    return name
+
+
+def _set(element, name, type, value, raw=None):
+    """Set the android: attribute ``name`` of ``element``, adding it
+    if necessary, in the order ``aapt`` would have put it.
+    """
+    attribute = element.get(name)
+    if attribute is None:
+        attribute = Attribute(ANDROID_NS, name, None, type, value,
+                              ATTRIBUTE_IDS[name])
+        # Sorted by resource id, followed by those without one.
+        position = len([a for a in element.attributes
+                        if a.resource_id and
+                        a.resource_id < attribute.resource_id])
+        element.attributes.insert(position, attribute)
+    attribute.type = type
+    attribute.value = value
+    attribute.raw = raw
+
+
+def edit_manifest(data, package=None, version_code=None,
+                  version_name=None):
+    """Change the package name and version of the binary manifest
+    ``data``, returning the new one.
+
+    When the package changes, class names relative to the old one are
+    made absolute, as ``aapt --rename-manifest-package`` does.
+    """
+    document = Document.parse(data)
+    manifest = document.root
+    if package:
+        old_package = manifest.get('package', ns=None).value
+        for element in document.elements():
+            if element.name not in COMPONENTS:
+                continue
+            for attribute in element.attributes:
+                if attribute.ns == ANDROID_NS and \
+                        attribute.name in CLASS_ATTRIBUTES and \
+                        attribute.type == TYPE_STRING:
+                    attribute.value = _qualify(attribute.value, old_package)
+                    attribute.raw = attribute.value
+        attribute = manifest.get('package', ns=None)
+        attribute.value = attribute.raw = package
+    if version_code is not None:
+        _set(manifest, 'versionCode', TYPE_INT_DEC, int(version_code))
+    if version_name is not None:
+        _set(manifest, 'versionName', TYPE_STRING, version_name,
+             raw=version_name)
+    return document.to_bytes()
+
+
+def derive_resources(base, output, package=None, version_code=None,
+                     version_name=None, date_time=None):
+    """Write a copy of the resource package ``base`` to ``output``, with
+    the manifest changed by ``edit_manifest()``.
+
+    All other entries are copied as they are.
+    """
+    with ApkReader(base) as reader:
+        with open(output, 'wb') as f:
+            writer = ApkWriter(f, date_time=date_time)
+            for entry in reader.entries:
+                if entry.name != 'AndroidManifest.xml':
+                    writer.write_raw(entry, reader.raw_chunks(entry))
+                    continue
+                data = edit_manifest(reader.read(entry), package,
+                                     version_code, version_name)
+                writer.write(entry.name, data,
+                             compress=entry.method != 0,
+                             date_time=entry.date_time,
+                             external_attr=entry.external_attr)
+            writer.close()
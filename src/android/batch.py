@@ -0,0 +1,309 @@
+"""
+Copyright (c) 2011 Michael Elsdoerfer <michael@elsdoerfer.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Signing, aligning and verifying many APKs at once.
+
+``sign_batch()`` passes the APKs through a pipeline: each stage (sign,
+align, verify) has threads of its own, so that one APK can be verified
+while the next one is signed, and the disk is kept busy while another
+APK is hashed. The outputs only appear in the target directory once
+they are complete and verified.
+
+Threads only go so far: hashing releases the GIL, but the RSA
+arithmetic and the parsing of the zip files are pure Python, and run on
+one CPU at a time. Pass ``processes=True`` to have those done in a pool
+of processes instead.
+"""
+
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+import multiprocessing
+from os import path
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from .signing import (
+    SigningKey, UnsupportedKeyError, load_keystore, sign_apk, verify_apk)
+from .tools import _cpu_count
+
+
+__all__ = ('sign_batch', 'BatchResult', 'BatchSummary', 'BatchError')
+
+
+# Same logger as android.build.
+log = logging.getLogger('py-androidbuild')
+
+
+STAGE_ORDER = ('sign', 'align', 'verify', 'commit')
+
+
+class BatchError(RuntimeError):
+    """Some APKs of a batch failed. The exceptions are in ``errors``,
+    what happened to each APK in ``summary``.
+    """
+
+    def __init__(self, summary):
+        self.summary = summary
+        self.errors = [r.error for r in summary.failed]
+        RuntimeError.__init__(self, '%d of %d APKs failed; %s: %s' % (
+            len(self.errors), len(summary.results),
+            path.basename(summary.failed[0].source), self.errors[0]))
+
+
+class BatchResult(object):
+    """What happened to the APK ``source``, to be written to ``output``.
+
+    Sizes are in bytes, ``timings`` has the seconds spent in each stage.
+    If a stage failed, ``error`` is the exception, and ``output`` does
+    not exist.
+    """
+
+    fields = ('source', 'output', 'input_size', 'output_size', 'timings',
+              'error')
+
+    def __init__(self, source, output, platform=None):
+        self.source = source
+        self.output = output
+        self.platform = platform
+        self.input_size = path.getsize(source)
+        self.output_size = None
+        self.timings = {}
+        self.error = None
+
+    def __repr__(self):
+        return '%s <%s>' % (self.__class__.__name__, self.output)
+
+    @property
+    def part(self):
+        """Where the output is written to, until it is complete."""
+        return '%s.part' % self.output
+
+    @property
+    def unaligned(self):
+        return '%s.unaligned.part' % self.output
+
+    def as_dict(self):
+        result = dict((name, getattr(self, name)) for name in self.fields)
+        if self.error is not None:
+            result['error'] = '%s' % self.error
+        return result
+
+
+class BatchSummary(object):
+    """The ``BatchResult`` of each APK, in the order given, and the
+    ``wall`` time of the whole batch.
+    """
+
+    def __init__(self, results, wall):
+        self.results = results
+        self.wall = wall
+
+    def __repr__(self):
+        return '%s <%d APKs, %d failed>' % (
+            self.__class__.__name__, len(self.results), len(self.failed))
+
+    @property
+    def failed(self):
+        return [r for r in self.results if r.error is not None]
+
+    def as_dict(self):
+        return {'wall': self.wall,
+                'input_size': sum(r.input_size for r in self.results),
+                'output_size': sum(r.output_size or 0 for r in self.results),
+                'results': [r.as_dict() for r in self.results]}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.as_dict(), **kwargs)
+
+    def format(self):
+        """Return the summary as a table, for humans.
+        """
+        lines = []
+        for r in self.results:
+            timings = ', '.join('%s %.1fs' % (name, r.timings[name])
+                                for name in STAGE_ORDER if name in r.timings)
+            lines.append('%-40s %9d KB -> %9s KB  %s%s' % (
+                path.basename(r.output), r.input_size // 1024,
+                '-' if r.output_size is None else r.output_size // 1024,
+                timings, '' if r.error is None else '  FAILED: %s' % r.error))
+        lines.append('%d of %d APKs done in %.1fs' % (
+            len(self.results) - len(self.failed), len(self.results),
+            self.wall))
+        return '\n'.join(lines)
+
+
+def _pipeline(items, stages, workers):
+    """Pass each of ``items`` through ``stages``, a list of ``(name,
+    func)`` tuples, in order. Every stage has ``workers`` threads of its
+    own.
+
+    The time ``func`` takes goes into the ``timings`` of the item. Once
+    it raises an exception, that becomes the ``error`` of the item,
+    which then skips the remaining stages.
+    """
+    queues = [Queue() for _ in stages]
+
+    def worker(index):
+        name, func = stages[index]
+        while True:
+            item = queues[index].get()
+            if item is None:
+                return
+            if item.error is None:
+                start = time.time()
+                try:
+                    func(item)
+                except Exception as e:
+                    log.warning('Failed to %s %s: %s' % (
+                        name, item.source, e))
+                    item.error = e
+                item.timings[name] = time.time() - start
+            if index + 1 < len(stages):
+                queues[index + 1].put(item)
+
+    threads = [[threading.Thread(target=worker, args=(index,))
+                for _ in range(workers)] for index in range(len(stages))]
+    for stage_threads in threads:
+        for t in stage_threads:
+            t.daemon = True
+            t.start()
+    for item in items:
+        queues[0].put(item)
+    # A stage is told to stop once the one before it has finished.
+    for index, stage_threads in enumerate(threads):
+        for _ in stage_threads:
+            queues[index].put(None)
+        for t in stage_threads:
+            t.join()
+
+
+def _sync(platform):
+    # The tools of an AsyncPlatformTarget are coroutines.
+    return platform.to_sync() if hasattr(platform, 'to_sync') else platform
+
+
+def _delete(*filenames):
+    for filename in filenames:
+        if path.exists(filename):
+            os.unlink(filename)
+
+
+def sign_batch(apks, output_dir, keystore, alias=None, password=None,
+               digest='SHA1', verify=True, workers=None, platform=None,
+               processes=False):
+    """Sign and align ``apks`` into ``output_dir``, where each keeps its
+    file name; with ``verify``, the signature and alignment of the
+    result are checked before it is put there. Returns a
+    ``BatchSummary``.
+
+    ``apks`` are ``Apk`` objects, or file names if a ``platform`` is
+    given. ``keystore``, ``alias``, ``password`` and ``digest`` are as
+    for ``PlatformTarget.sign_and_align()``; the key is only read once.
+    For keystores it cannot read, ``jarsigner`` and ``zipalign`` are run
+    instead.
+
+    Each stage has ``workers`` threads, by default one per CPU. With
+    ``processes``, the signing and verifying is done by a pool of
+    ``workers`` processes, which the threads wait for; use it for large
+    batches, as only the hashing runs in parallel in threads. The key
+    is sent to the processes, and on Windows, the calling module must
+    be importable without side effects (see ``multiprocessing``).
+
+    An APK which fails does not stop the others; at the end, a
+    ``BatchError`` is raised.
+    """
+    start = time.time()
+    results = []
+    for apk in apks:
+        filename = getattr(apk, 'filename', apk)
+        results.append(BatchResult(
+            filename, path.join(path.abspath(output_dir),
+                                path.basename(filename)),
+            _sync(getattr(apk, 'platform', None) or platform)))
+    names = [r.output for r in results]
+    for name in names:
+        if names.count(name) > 1:
+            raise ValueError('More than one APK named %s' % (
+                path.basename(name)))
+    if not path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    key = keystore
+    if not isinstance(keystore, SigningKey):
+        try:
+            key = load_keystore(keystore, alias, password)
+        except UnsupportedKeyError as e:
+            log.info('%s, using jarsigner' % e)
+            key = None
+
+    workers = workers or _cpu_count()
+    pool = multiprocessing.Pool(workers) if processes else None
+
+    def run(func, *args, **kwargs):
+        if pool is None:
+            return func(*args, **kwargs)
+        return pool.apply(func, args, kwargs)
+
+    def sign(result):
+        if key is not None:
+            date_time = result.platform._date_time() \
+                if result.platform else None
+            run(sign_apk, result.source, key, output=result.part,
+                digest=digest, date_time=date_time)
+            return
+        shutil.copyfile(result.source, result.unaligned)
+        log.info(result.platform.jarsigner(
+            result.unaligned, keystore=keystore, alias=alias,
+            password=password))
+
+    def align(result):
+        log.info(result.platform.zipalign(
+            result.unaligned, result.part, align=4, force=True))
+        os.unlink(result.unaligned)
+
+    def check(result):
+        run(verify_apk, result.part)
+
+    def commit(result):
+        os.rename(result.part, result.output)
+        result.output_size = path.getsize(result.output)
+
+    stages = [('sign', sign)]
+    if key is None:
+        stages.append(('align', align))
+    if verify:
+        stages.append(('verify', check))
+    stages.append(('commit', commit))
+    try:
+        _pipeline(results, stages, workers)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for result in results:
+            if result.error is not None:
+                _delete(result.part, result.unaligned)
+
+    summary = BatchSummary(results, time.time() - start)
+    log.info(summary.format())
+    if summary.failed:
+        raise BatchError(summary)
+    return summary
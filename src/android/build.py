@@ -16,6 +16,9 @@ limitations under the License.
 
 import os, sys
 import time
+import hashlib
+import threading
+import functools
 import fnmatch
 from os import path
 import shutil
@@ -23,11 +26,28 @@ import tempfile
 import logging
 import pkg_resources
 
-from tools import *
-
-
-__all__ = ('AndroidProject', 'PlatformTarget', 'get_platform',
-           'ProgramFailedError')
+from .tools import *
+from .tools import _cpu_count
+from .workspace import Workspace
+from .cache import content_key
+from .signing import (
+    SigningKey, UnsupportedKeyError, load_keystore, sign_apk)
+from .report import (
+    BuildReport, step as report_step, up_to_date as report_up_to_date,
+    rename as report_rename, bind as report_bind)
+from .plan import StepHistory, BuildPlan
+from . import packaging
+from .apkzip import ApkWriter, normalize, DETERMINISTIC_TIME
+from .jars import JarConflictError, catalog as jar_catalog
+from .shrinking import keep_rules
+from . import shrinking
+from .sources import package_units, partition_sources
+from .axml import derive_resources
+from . import metrics
+
+
+__all__ = ('AndroidProject', 'LibraryProject', 'PlatformTarget',
+           'get_platform', 'ProgramFailedError', 'JarConflictError')
 
 
 # Setup a logger for this library.
@@ -40,6 +60,25 @@ class NullHandler(logging.Handler):
 log.addHandler(NullHandler())
 
 
+def build_step(func):
+    """Report the tools run by ``func`` as a step of the active
+    ``BuildReport``, named after the function.
+    """
+    @functools.wraps(func)
+    def wrapper(*a, **kw):
+        start = time.time()
+        outcome = 'failed'
+        try:
+            with report_step(func.__name__):
+                result = func(*a, **kw)
+            outcome = 'ok'
+            return result
+        finally:
+            metrics.observe('step_duration_seconds', time.time() - start,
+                            {'step': func.__name__, 'result': outcome})
+    return wrapper
+
+
 class File(object):
     """To provide a common delete() method for subclasses.
     """
@@ -63,6 +102,30 @@ class ResourceObj(File):
     """Represents a packed resource package."""
 
 
+class LibraryObj(File):
+    """The compiled code of a library project, as returned by
+    ``LibraryProject.compile()``: ``filename`` is a jar of the class
+    files, ``dex_jar`` the same code already dexed.
+
+    The library's R classes are not included; they are generated for
+    each app, as only then are the final resource ids known.
+    """
+
+    def __init__(self, library, filename, dex_jar, fingerprint):
+        File.__init__(self, filename)
+        self.library = library
+        self.dex_jar = dex_jar
+        self.fingerprint = fingerprint
+
+    @property
+    def package(self):
+        return self.library.package
+
+
+class AssetPack(File):
+    """Represents an archive of assets, made by ``pack_assets``."""
+
+
 class Apk(File):
     """Represents an APK file.
 
@@ -78,6 +141,20 @@ class Apk(File):
     def align(self, *a, **kw):
         return self.platform.align(self, *a, **kw)
 
+    def sign_and_align(self, *a, **kw):
+        return self.platform.sign_and_align(self, *a, **kw)
+
+    @property
+    def sha256(self):
+        """Hash of the file content; with ``deterministic`` builds, the
+        same for the same input.
+        """
+        hash = hashlib.sha256()
+        with open(self.filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                hash.update(chunk)
+        return hash.hexdigest()
+
 
 def ext(filename, windows_ext):
     return '%s%s' % (filename, windows_ext) \
@@ -158,6 +235,27 @@ class PlatformTarget(object):
 
     The tools and files we need to use as part of the build process
     are partly different in each version.
+
+    If you assign a ``RemoteCache`` instance to the ``cache`` attribute,
+    the output of the ``dex``, ``pack_resources`` and ``build_apk`` steps
+    will be looked up there before running the tools, and uploaded
+    after running them.
+
+    If you assign a ``Deflater`` (see ``android.packaging``) to the
+    ``deflater`` attribute, the APK is assembled in Python rather than
+    by ``apkbuilder``, compressing the entries on all CPUs; ``aapt``
+    is then told not to compress anything itself.
+
+    Set the ``deterministic`` attribute to make the ``.ap_`` and APK
+    files depend only on their content: entries are sorted, or in an
+    order that only depends on the input, and have a fixed timestamp
+    and no permissions. This does not apply to ``sign()``, as
+    ``jarsigner`` adds its own timestamps; use ``sign_and_align()``.
+
+    The jars given to ``compile_java``, ``dex`` and ``build_apk`` are
+    looked up in the ``JarCatalog`` in the ``jars`` attribute: jars with
+    the same content are only used once, and a ``JarConflictError`` is
+    raised if two of them contain the same class.
     """
 
     def __init__(self, version, sdk_dir, ndk_dir, platform_dir, custom_paths={}):
@@ -173,6 +271,10 @@ class PlatformTarget(object):
             # Java tools
             jarsigner=ext('jarsigner', '.exe'),
             javac=ext('javac', '.exe'),
+            # Included in the SDK
+            proguard=path.join(sdk_dir, 'tools', 'proguard', 'bin',
+                               'proguard.bat' if sys.platform == 'win32'
+                               else 'proguard.sh'),
         )
         # Get the most recent build-tools
         paths.update(BuildTools.get(sdk_dir).paths)
@@ -189,6 +291,7 @@ class PlatformTarget(object):
         self.zipalign = ZipAlign(paths['zipalign'])
         self.apkbuilder = ApkBuilder(paths['apkbuilder'], self)
         self.javac = JavaC(paths['javac'])
+        self.proguard = ProGuard(paths['proguard'])
         if ndk_dir is not None:
             self.ndk_build = NdkBuild(paths['ndk_build'])
             self.ndk_clean = NdkClean(paths['ndk_build'])
@@ -201,27 +304,69 @@ class PlatformTarget(object):
         self.framework_aidl = path.join(platform_dir, 'framework.aidl')
         self.rs_includes = [paths['lib_rs'], paths['lib_rs_clang']]
 
+        self.cache = None
+        self.deflater = None
+        self.deterministic = False
+        self.jars = jar_catalog
+
     def __repr__(self):
         return 'Platform %s <%s>' % (self.version, self.platform_dir)
 
-    def generate_r(self, manifest, resource_dir, output_dir):
+    def _cached(self, step, output, inputs, build, **params):
+        """Run ``build`` to create ``output``, unless the remote cache
+        has a copy of it for the given ``inputs`` and ``params``.
+        """
+        if not self.cache or not self.cache.enabled:
+            build()
+            return
+        key = content_key(step, inputs, platform=self.version, **params)
+        if self.cache.get(key, output):
+            metrics.increment('cache_requests_total',
+                              tags={'step': step, 'result': 'hit'})
+            log.info('Using cached %s for %s' % (step, output))
+            return
+        metrics.increment('cache_requests_total',
+                          tags={'step': step, 'result': 'miss'})
+        build()
+        self.cache.put(key, output)
+
+    @build_step
+    def generate_r(self, manifest, resource_dir, output_dir,
+                   extra_packages=[], non_constant_id=False):
         """Generate the R.java file in ``output_dir``, based
         on ``resource_dir``.
 
+        ``resource_dir`` may be a list, in which case the directories
+        after the first one are overlays, like the resources of library
+        projects. An R.java with the same ids is generated for each of
+        the ``extra_packages``.
+
         Final call will look something like this::
 
             $ aapt package -m -J gen/ -M AndroidManifest.xml -S res/
                 -I android.jar
         """
         mkdir(output_dir)
-        log.info(self.aapt(
+        log.info(self.aapt(**self._r_args(
+            manifest, resource_dir, output_dir, extra_packages,
+            non_constant_id)))
+
+    def _r_args(self, manifest, resource_dir, output_dir, extra_packages,
+                non_constant_id):
+        """The ``aapt`` arguments for ``generate_r``.
+        """
+        return dict(
             command='package',
             make_dirs=True,
             manifest=manifest,
             resource_dir=resource_dir,
+            auto_add_overlay=len(as_list(resource_dir)) > 1,
+            extra_packages=extra_packages,
+            non_constant_id=non_constant_id,
             r_output=output_dir,
-            include=[self.framework_library]))
+            include=[self.framework_library])
 
+    @build_step
     def compile_renderscript(self, resource_dir, source_gen_dir, source_dirs):
         """
         compile renderscript files before aapt packaging
@@ -241,10 +386,14 @@ class PlatformTarget(object):
             self.rs_includes
         ))
 
-    def compile_aidl(self, source_dirs, output_dir):
+    @build_step
+    def compile_aidl(self, source_dirs, output_dir, import_dirs=[]):
         """Compile .aidl definitions found in ``source_dirs`` into
         Java files, and put them into ``output_dir``.
 
+        ``import_dirs`` are searched for imported definitions as well,
+        but not compiled.
+
         Final calls will look something like this::
 
             $ aidl -pframework.aidl -Isrc/ -ogen/ Foo.aidl
@@ -253,41 +402,136 @@ class PlatformTarget(object):
             log.info(self.aidl(
                 filename,
                 preprocessed=self.framework_aidl,
-                search_path=source_dirs,
+                search_path=as_list(source_dirs) + import_dirs,
                 output_folder=output_dir,
             ))
 
-    def _collect_jars(self, paths):
-        jar_files = []
-        for item in paths:
-            if path.isdir(item):
-                jar_files += recursive_glob(item, '*.jar')
-            else:
-                jar_files.append(item)
-        return jar_files
-
+    @build_step
     def compile_java(self, source_dirs, output_dir, extra_jars=[],
-                     debug=False, target='1.5'):
+                     debug=False, target='1.5', partitions=None):
         """Compile all *.java files in ``source_dirs`` (a list of
         directories) and store the class files in ``output_dir``.
 
         ``extra_jars`` will be added to the classpath. The list may
         include both .jar files as well as directories, which will
         recursively be searched for .jar files.
+
+        To compile on more than one CPU, set ``partitions`` to
+        ``'packages'``, or to a list of modules, each a list of source
+        directories; the sources in none of them form another module.
+        The packages or modules are compiled in parallel where they do
+        not refer to each other, see ``android.sources``. Should that
+        fail, all sources are compiled together.
         """
         # Collect all files to be compiled
         source_files = recursive_glob(source_dirs, '*.java')
-        jar_files = self._collect_jars(extra_jars)
+        jar_files = self.jars.resolve(extra_jars)
         # TODO: check if files are up-to-date?
         mkdir(output_dir, True)
-        log.info(self.javac(
-            source_files,
-            target=target,
-            debug=debug,
-            destdir=output_dir,
-            classpath=jar_files,
-            bootclasspath=self.framework_library))
+        options = dict(target=target, debug=debug)
+        if partitions:
+            stages = partition_sources(
+                self._source_units(source_files, partitions), _cpu_count())
+            if sum(len(chunks) for chunks in stages) > 1:
+                try:
+                    return self._compile_stages(
+                        stages, output_dir, jar_files, options)
+                except ProgramFailedError as e:
+                    log.warning('Compiling in parts failed, compiling all '
+                                'sources together: %s' % e)
+        self._javac(source_files, output_dir, jar_files, options)
+
+    def _source_units(self, source_files, partitions):
+        if partitions == 'packages':
+            return package_units(source_files)
+        units = []
+        for i, module in enumerate(partitions):
+            files = recursive_glob(module, '*.java')
+            units.append(('module %d' % i, files))
+        assigned = set(f for name, files in units for f in files)
+        units.append(('other', [f for f in source_files
+                                if not f in assigned]))
+        return units
+
+    def _compile_stages(self, stages, output_dir, jar_files, options):
+        """Compile the chunks of each of the ``stages`` concurrently,
+        against the classes of the earlier stages, and move the classes
+        into ``output_dir`` once all are compiled.
+        """
+        work_dir = tempfile.mkdtemp(
+            prefix='javac-', dir=path.dirname(path.normpath(output_dir)))
+        try:
+            classpath = list(jar_files)
+            for i, chunks in enumerate(stages):
+                stage_dir = path.join(work_dir, str(i))
+                mkdir(stage_dir)
+                run_all(report_bind(lambda files: self._javac(
+                    files, stage_dir, classpath, options)), chunks)
+                classpath.append(stage_dir)
+            for stage_dir in classpath[len(jar_files):]:
+                move_tree(stage_dir, output_dir)
+        finally:
+            shutil.rmtree(work_dir)
+
+    def _javac(self, source_files, output_dir, classpath, options):
+        fd, argfile = tempfile.mkstemp(suffix='.javac')
+        os.close(fd)
+        try:
+            log.info(self.javac(
+                source_files,
+                destdir=output_dir,
+                classpath=classpath,
+                bootclasspath=self.framework_library,
+                argfile=argfile,
+                **options))
+        finally:
+            os.unlink(argfile)
 
+    @build_step
+    def shrink(self, manifest, class_dir, output, extra_jars=[],
+               configs=[], optimize=False):
+        """Run ProGuard on the class files in ``class_dir`` and on
+        ``extra_jars``, putting only what is reachable from the
+        components in ``manifest`` into the jar ``output``.
+
+        ``configs`` are additional ProGuard configuration files, like
+        ``proguard-project.txt``. The code is not obfuscated, and only
+        optimized if ``optimize`` is set.
+
+        ProGuard is only run again if any of the inputs changed.
+
+        Final call will look something like this::
+
+            $ proguard.sh -injars bin/classes:libs/foo.jar
+                -outjars bin/classes-shrunk.jar -libraryjars android.jar
+                @bin/keep.pro @proguard-project.txt
+        """
+        output = path.abspath(output)
+        jar_files = self.jars.resolve(extra_jars)
+        inputs = [manifest, class_dir] + jar_files + list(configs)
+        fingerprint = content_key(
+            'shrink', inputs, platform=self.version, optimize=optimize)
+        if is_current(output, fingerprint):
+            log.info('Shrunk code is up-to-date: %s' % output)
+            report_up_to_date()
+            return output
+
+        def build():
+            keep_file = '%s.pro' % output
+            with open(keep_file, 'w') as f:
+                f.write(keep_rules(manifest, optimize=optimize))
+            try:
+                log.info(self.proguard(
+                    [class_dir] + jar_files, output,
+                    libraryjars=[self.framework_library],
+                    configs=[keep_file] + list(configs)))
+            finally:
+                os.unlink(keep_file)
+        self._cached('shrink', output, inputs, build, optimize=optimize)
+        set_current(output, fingerprint)
+        return output
+
+    @build_step
     def compile_native(self, project_dir):
         """Shortcut for building native code
         """
@@ -296,6 +540,7 @@ class PlatformTarget(object):
         ))
         self.ndk_build(project_dir)
 
+    @build_step
     def clean_native(self, project_dir):
         """Shortcut for cleaning native code
         """
@@ -304,6 +549,7 @@ class PlatformTarget(object):
         ))
         self.ndk_clean(project_dir)
 
+    @build_step
     def dex(self, source_dir, output=None, extra_jars=[]):
         """Dexing is the process of converting Java bytecode to Dalvik
         bytecode.
@@ -318,18 +564,32 @@ class PlatformTarget(object):
         if not output:
             _, output = tempfile.mkstemp(suffix='.dex')
         output = path.abspath(output)
-        jar_files = self._collect_jars(extra_jars)
-        log.info(self.dx([source_dir] + jar_files, output=output))
+        jar_files = self.jars.resolve(extra_jars)
+        self._cached(
+            'dex', output, [source_dir] + jar_files,
+            lambda: log.info(self.dx([source_dir] + jar_files, output=output)))
         return CodeObj(output)
 
+    @build_step
     def compile(self, manifest, project_dir, source_dirs, resource_dir,
                 source_gen_dir=None, class_gen_dir=None,
-                dex_output=None, extra_jars=[], **kwargs):
+                dex_output=None, extra_jars=[], libraries=[],
+                shrink=False, optimize=False, proguard_config=[], **kwargs):
         """Shortcut for the whole process until dexing into a code
         object that we can pack into an APK.
 
         For directories that you do not specifiy a tenmporary directory
         will be used and deleted after the build.
+
+        ``libraries`` is a list of compiled library projects (see
+        ``LibraryProject.compile()``). Their pre-dexed code is merged
+        into the output, and the R classes for their packages are
+        generated along with the project's own.
+
+        With ``shrink``, the code is run through ``shrink()`` before
+        dexing, together with ``extra_jars`` and the code of the
+        libraries, using the configuration files ``proguard_config``;
+        ``optimize`` is passed on.
         """
         to_delete = []
         if not source_gen_dir:
@@ -340,22 +600,116 @@ class PlatformTarget(object):
             to_delete.append(class_gen_dir)
         try:
             source_dirs = as_list(source_dirs)
+            libs = self._library_args(libraries)
             self.compile_renderscript(resource_dir, source_gen_dir, source_dirs)
-            self.generate_r(manifest, resource_dir, source_gen_dir)
+            self.generate_r(manifest, [resource_dir] + libs['resource_dirs'],
+                            source_gen_dir,
+                            extra_packages=libs['packages'])
             # TODO: check args for RS
-            self.compile_aidl(source_dirs, source_gen_dir)
+            self.compile_aidl(source_dirs, source_gen_dir,
+                              import_dirs=libs['source_dirs'])
             if self.ndk_build is not None:
                 self.compile_native(project_dir)
             self.compile_java(source_dirs+ [source_gen_dir],
-                              class_gen_dir, extra_jars=extra_jars,
+                              class_gen_dir,
+                              extra_jars=extra_jars + libs['class_jars'],
                               **kwargs)
+            if shrink:
+                # Next to the class files, unless those are temporary.
+                if class_gen_dir in to_delete:
+                    shrink_dir = tempfile.mkdtemp()
+                    to_delete.append(shrink_dir)
+                else:
+                    shrink_dir = path.dirname(path.normpath(class_gen_dir))
+                shrunk = self.shrink(
+                    manifest, class_gen_dir,
+                    path.join(shrink_dir, 'classes-shrunk.jar'),
+                    extra_jars=extra_jars + libs['class_jars'],
+                    configs=proguard_config, optimize=optimize)
+                return self.dex(shrunk, output=dex_output)
             return self.dex(class_gen_dir, output=dex_output,
-                            extra_jars=extra_jars)
+                            extra_jars=extra_jars + libs['dex_jars'])
         finally:
             for d in to_delete:
                 log.info('Deleting tree: %s' % d)
                 shutil.rmtree(d)
 
+    def _library_args(self, libraries):
+        """What the compiled ``libraries`` contribute to the build
+        steps of a project using them.
+        """
+        args = dict(resource_dirs=[], packages=[], source_dirs=[],
+                    class_jars=[], dex_jars=[])
+        for lib in libraries:
+            lib_jars = only_existing([lib.library.lib_dir])
+            args['resource_dirs'] += only_existing([lib.library.resource_dir])
+            args['packages'].append(lib.package)
+            args['source_dirs'] += only_existing([lib.library.source_dir])
+            args['class_jars'] += [lib.filename] + lib_jars
+            args['dex_jars'] += [lib.dex_jar] + lib_jars
+        return args
+
+    @build_step
+    def shrink_resources(self, manifest, resource_dir, code, r_dir,
+                         output_dir, extra_packages=[]):
+        """Return a copy of ``resource_dir`` (or of a list of them) in
+        ``output_dir``, in which the files of the resources that the
+        compiled ``code`` does not use are replaced by placeholders.
+
+        ``code`` is a list of class file directories and jars, and
+        ``r_dir`` where ``generate_r`` wrote the R.java file the code
+        was compiled against. The ids of the copy are checked against
+        it; should they differ, ``resource_dir`` is returned as it is.
+        The R classes of the app, and of the libraries whose packages
+        are in ``extra_packages``, do not count as using a resource.
+
+        Nothing is done if none of the inputs changed.
+        """
+        from xml.etree import ElementTree
+        package = ElementTree.parse(manifest).getroot().attrib['package']
+        r_java = path.join(r_dir, package.replace('.', os.sep), 'R.java')
+        resource_dirs = as_list(resource_dir)
+        output_dir = path.abspath(output_dir)
+        fingerprint = content_key(
+            'shrink_resources', [manifest, r_java] + resource_dirs + code,
+            platform=self.version, packages=sorted(extra_packages))
+
+        def result(shrunk):
+            return shrunk if isinstance(resource_dir, (list, tuple)) \
+                else shrunk[0]
+        if is_current(output_dir, fingerprint):
+            log.info('Shrunk resources are up-to-date: %s' % output_dir)
+            report_up_to_date()
+            shrunk = [path.join(output_dir, str(i))
+                      for i in range(len(resource_dirs))]
+            # An empty output_dir means the ids did not match.
+            return result(shrunk) if path.exists(shrunk[0]) else resource_dir
+
+        ids = shrinking.parse_r(r_java)
+        reachable = shrinking.reachable_resources(
+            manifest, resource_dirs, shrinking.code_references(
+                code, ids, [package] + list(extra_packages)))
+        shrunk, saved = shrinking.shrink_resources(
+            resource_dirs, output_dir, reachable)
+        check_dir = tempfile.mkdtemp()
+        try:
+            self.generate_r(manifest, shrunk, check_dir)
+            same = shrinking.parse_r(path.join(
+                check_dir, package.replace('.', os.sep), 'R.java')) == ids
+        finally:
+            shutil.rmtree(check_dir)
+        if not same:
+            log.warning('Resource ids change without the unused '
+                        'resources, keeping them all')
+            shutil.rmtree(output_dir)
+            os.makedirs(output_dir)
+            set_current(output_dir, fingerprint)
+            return resource_dir
+        log.info('Replaced unused resources, saving %d bytes' % saved)
+        set_current(output_dir, fingerprint)
+        return result(shrunk)
+
+    @build_step
     def pack_resources(self, manifest, resource_dir, asset_dir=None,
                        configurations=None, package_name=None,
                        version_code=None, version_name=None, output=None):
@@ -365,16 +719,97 @@ class PlatformTarget(object):
         included. For example: "de" to make a German-only build, or
         "port,land,en_US". By default, all configurations are built.
 
+        ``resource_dir`` may be a list, as for ``generate_r``.
+
+        To change the ``package_name`` and version, ``aapt`` is not
+        run again: the resources are packaged once, without changes,
+        into a file next to ``output``, whose manifest is then rewritten
+        for each variant (see ``android.axml``). Such a build is reported
+        as the step ``derive_resources``, or ``pack_base_resources`` if
+        the resources had to be packaged first.
+
             $ aapt package -f -M AndroidManifest.xml -S res/
                 -A assets/ -I android.jar -F out/BASE-CONFIG.ap_
         """
         if not output:
             _, output = tempfile.mkstemp(suffix='.ap_')
         output = path.abspath(output)
+        if not self._is_variant(package_name, version_code, version_name):
+            self._pack_resources(
+                manifest, resource_dir, asset_dir, configurations, output)
+            return ResourceObj(output)
+
+        base = self._base_resources(output)
+        with _lock_for(base):
+            fingerprint = self._resources_fingerprint(
+                manifest, resource_dir, asset_dir, configurations)
+            if is_current(base, fingerprint):
+                log.info('Using packaged resources %s' % base)
+                report_rename('derive_resources')
+            else:
+                report_rename('pack_base_resources')
+                self._pack_resources(
+                    manifest, resource_dir, asset_dir, configurations, base)
+                set_current(base, fingerprint)
+        derive_resources(base, output, package_name, version_code,
+                         version_name, date_time=self._date_time())
+        return ResourceObj(output)
+
+    def _pack_resources(self, manifest, resource_dir, asset_dir,
+                        configurations, output):
+        kwargs = self._package_args(
+            manifest, resource_dir, asset_dir, configurations, None,
+            None, None, output)
+        def build():
+            log.info(self.aapt(**kwargs))
+            self._normalized(output)
+        self._cached(
+            'pack_resources', output,
+            [manifest] + as_list(resource_dir) + [asset_dir],
+            build, configurations=configurations,
+            uncompressed=bool(self.deflater),
+            deterministic=self.deterministic)
+
+    def _is_variant(self, package_name, version_code, version_name):
+        return package_name is not None or version_code is not None or \
+            version_name is not None
+
+    def _base_resources(self, output):
+        """Where to put the resources that variants of ``output`` are
+        derived from.
+        """
+        root, ext = path.splitext(output)
+        return '%s.base%s' % (root, ext)
+
+    def _resources_fingerprint(self, manifest, resource_dir, asset_dir,
+                               configurations):
+        return content_key(
+            'pack_resources',
+            [manifest] + as_list(resource_dir) + [asset_dir],
+            platform=self.version, configurations=configurations,
+            uncompressed=bool(self.deflater),
+            deterministic=self.deterministic)
+
+    def _date_time(self):
+        return DETERMINISTIC_TIME if self.deterministic else None
+
+    def _normalized(self, output):
+        """In deterministic mode, normalize a zip file written by one
+        of the tools.
+        """
+        if self.deterministic:
+            normalize(output)
+
+    def _package_args(self, manifest, resource_dir, asset_dir,
+                      configurations, package_name, version_code,
+                      version_name, output):
+        """The ``aapt`` arguments for ``pack_resources``.
+        """
         kwargs = dict(
             command='package',
             manifest=manifest,
             resource_dir=resource_dir,
+            auto_add_overlay=len(as_list(resource_dir)) > 1,
             include=[self.framework_library],
             apk_output=output,
             configurations=configurations,
@@ -387,15 +822,83 @@ class PlatformTarget(object):
             overwrite=True)
         if asset_dir:
             kwargs['asset_dir'] = asset_dir
-        log.info(self.aapt(**kwargs))
-        return ResourceObj(output)
-
+        if self.deflater:
+            # Compressed later, by the deflater.
+            kwargs['no_compress'] = ['']
+        return kwargs
+
+    @build_step
+    def pack_assets(self, asset_dir, output_dir):
+        """Package the files in ``asset_dir`` into an archive in
+        ``output_dir``, to be passed to ``build_apk``.
+
+        The archive is named after a fingerprint of the names, sizes
+        and modification times of the files, so as long as they do not
+        change, the existing archive is returned.
+        """
+        return self._pack_assets(asset_dir, output_dir)
+
+    def _pack_assets(self, asset_dir, output_dir):
+        deflater = self.deflater or packaging.Deflater()
+        output = self._asset_pack_name(asset_dir, output_dir, deflater)
+        # Outdated packs in the same directory are deleted, so variants
+        # built at the same time take turns.
+        with _lock_for(path.dirname(output)):
+            if path.exists(output):
+                log.info('Assets unchanged, using %s' % output)
+                report_up_to_date()
+                return AssetPack(output)
+            mkdir(output_dir, recursive=True)
+            for filename in os.listdir(output_dir):
+                if filename.startswith('assets-') and \
+                        filename.endswith('.zip'):
+                    log.info('Deleting outdated %s' % filename)
+                    os.unlink(path.join(output_dir, filename))
+            packaging.build_asset_pack(asset_dir, output, deflater,
+                                       date_time=self._date_time())
+        return AssetPack(output)
+
+    def _asset_pack_name(self, asset_dir, output_dir, deflater=None):
+        fingerprint = packaging.asset_fingerprint(
+            asset_dir, deflater or self.deflater or packaging.Deflater())
+        return path.join(path.abspath(output_dir),
+                         'assets-%s.zip' % fingerprint)
+
+    @build_step
     def build_apk(self, output, code=None, resources=None,
-                  jar_paths=[], native_dirs=[], source_dirs=[]):
+                  jar_paths=[], native_dirs=[], source_dirs=[], assets=None):
         """Build an APK file, using the given code and resource files.
+
+        ``assets`` is an ``AssetPack``; with a ``deflater``, its entries
+        are copied into the APK as they are, without compressing them
+        again.
         """
         output = path.abspath(output)
-        kwargs = dict(outputfile=output, jar_paths=jar_paths,
+        kwargs = self._apkbuilder_args(
+            output, code, resources, jar_paths, native_dirs, source_dirs)
+        packed = [assets.filename if isinstance(assets, AssetPack)
+                  else assets] if assets else []
+        def build():
+            if self.deflater:
+                packaging.build_apk(
+                    deflater=self.deflater, packed=packed,
+                    date_time=self._date_time(), **kwargs)
+            else:
+                log.info(self.apkbuilder(
+                    **dict(kwargs, zips=kwargs.get('zips', []) + packed)))
+                self._normalized(output)
+        self._cached('build_apk', output,
+                     self._apkbuilder_inputs(kwargs) + packed, build,
+                     deterministic=self.deterministic)
+        metrics.observe('apk_size_bytes', path.getsize(output))
+        return Apk(self, output)
+
+    def _apkbuilder_args(self, output, code, resources, jar_paths,
+                         native_dirs, source_dirs):
+        """The ``apkbuilder`` arguments for ``build_apk``.
+        """
+        kwargs = dict(outputfile=output,
+                      jar_paths=self.jars.resolve(jar_paths),
                       native_dirs=native_dirs, source_dirs=source_dirs)
         if code:
             kwargs['dex'] = code.filename \
@@ -403,9 +906,14 @@ class PlatformTarget(object):
         if resources:
             kwargs['zips'] = [resources.filename \
                   if isinstance(resources, ResourceObj) else resources]
-        log.info(self.apkbuilder(**kwargs))
-        return Apk(self, output)
+        return kwargs
+
+    def _apkbuilder_inputs(self, kwargs):
+        return [kwargs.get('dex')] + kwargs.get('zips', []) + \
+            list(kwargs['jar_paths']) + list(kwargs['native_dirs']) + \
+            list(kwargs['source_dirs'])
 
+    @build_step
     def sign(self, apk, keystore, alias, password):
         """Sign an APK file.
         """
@@ -413,16 +921,45 @@ class PlatformTarget(object):
             apk.filename if isinstance(apk, Apk) else apk,
             keystore=keystore, alias=alias, password=password))
 
+    @build_step
+    def sign_and_align(self, apk, keystore, alias=None, password=None,
+                       output=None, digest='SHA1'):
+        """Sign and align an APK file in one go, without running
+        ``jarsigner`` or ``zipalign``.
+
+        ``keystore`` is either the filename of a ``JKS`` keystore, or a
+        ``SigningKey`` (see ``android.signing.load_pem``). For keystores
+        in other formats, this falls back to ``sign()`` and ``align()``.
+
+        If ``output`` is not given, the APK is replaced.
+        """
+        infile = apk.filename if isinstance(apk, Apk) else apk
+        if not isinstance(keystore, SigningKey):
+            try:
+                keystore = load_keystore(keystore, alias, password)
+            except UnsupportedKeyError as e:
+                log.info('%s, using jarsigner' % e)
+                self.sign(apk, keystore, alias, password)
+                return self.align(apk, output)
+        sign_apk(infile, keystore, output=output, digest=digest,
+                 date_time=self._date_time())
+        if not output:
+            return apk
+        return Apk(self, output)
+
+    @build_step
     def align(self, apk, output=None):
         """Align an APK file.
 
-        If ``outfile`` is not given, the APK is align in place.
+        If ``output`` is not given, the APK is align in place.
         """
         infile = apk.filename if isinstance(apk, Apk) else apk
         if not output:
             # Or should tempfile be used? Might be on another
             # filesystem though.
             outfile = "%s.align.%s" % (infile, time.time())
+        else:
+            outfile = output
         log.info(self.zipalign(infile, outfile, align=4, force=True))
 
         if not output:
@@ -485,9 +1022,68 @@ def mkdir(directory, recursive=False):
             os.mkdir(directory)
 
 
+def is_current(output, fingerprint):
+    """Whether ``output`` exists, and was built from inputs with the
+    given ``fingerprint``, as recorded by ``set_current()``.
+    """
+    stamp = '%s.fingerprint' % output
+    if not path.exists(output) or not path.exists(stamp):
+        return False
+    with open(stamp) as f:
+        return f.read().strip() == fingerprint
+
+
+def set_current(output, fingerprint):
+    with open('%s.fingerprint' % output, 'w') as f:
+        f.write(fingerprint)
+
+
+# Locks for files which concurrent builds may want to create.
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def _lock_for(filename):
+    with _locks_lock:
+        return _locks.setdefault(filename, threading.Lock())
+
+
+def run_all(func, items):
+    """Call ``func`` for each of ``items``, each in a thread of its
+    own. The first exception raised is raised again, once all are done.
+    """
+    errors = []
+    def run(item):
+        try:
+            func(item)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(item,))
+               for item in items]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+
+def move_tree(source, target):
+    """Move the files in ``source`` into ``target``, replacing those
+    which exist.
+    """
+    for base, dirs, files in os.walk(source):
+        target_base = path.join(target, path.relpath(base, source))
+        mkdir(target_base, recursive=True)
+        for f in files:
+            if path.exists(path.join(target_base, f)):
+                os.unlink(path.join(target_base, f))
+            os.rename(path.join(base, f), path.join(target_base, f))
+
+
 def only_existing(paths):
     """Return only those paths that actually exists."""
-    return filter(lambda p: path.exists(p), paths)
+    return [p for p in paths if path.exists(p)]
 
 
 def as_list(o):
@@ -499,6 +1095,230 @@ def as_list(o):
     return o
 
 
+def read_project_properties(project_dir):
+    """Return the settings in the ``project.properties`` (or, in older
+    projects, ``default.properties``) file in ``project_dir`` as a dict.
+    """
+    for name in ('project.properties', 'default.properties'):
+        filename = path.join(project_dir, name)
+        if path.exists(filename):
+            break
+    else:
+        return {}
+    properties = {}
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('#') or not '=' in line:
+                continue
+            key, value = [s.strip() for s in line.split('=', 1)]
+            properties[key] = value.replace('\\\\', '\\')
+    return properties
+
+
+def read_library_references(project_dir):
+    """Return the library projects referenced by the project in
+    ``project_dir``, as ``android.library.reference.N`` entries in its
+    properties file, the way the SDK's Ant rules define them.
+    """
+    prefix = 'android.library.reference.'
+    references = []
+    for key, value in read_project_properties(project_dir).items():
+        if not key.startswith(prefix):
+            continue
+        try:
+            number = int(key[len(prefix):])
+        except ValueError:
+            continue
+        references.append((number, path.normpath(
+            path.join(project_dir, value.replace('\\', '/')))))
+    return [LibraryProject(p) for n, p in sorted(references)]
+
+
+def read_proguard_config(project_dir, sdk_dir):
+    """Return the ProGuard configuration files given as
+    ``proguard.config`` in the properties file of the project in
+    ``project_dir``.
+    """
+    value = read_project_properties(project_dir).get('proguard.config')
+    if not value:
+        return []
+    value = value.replace('${sdk.dir}', sdk_dir)\
+        .replace('${user.home}', path.expanduser('~'))
+    return [path.join(project_dir, p) for p in value.split(os.pathsep)]
+
+
+# Compiled libraries, shared by all projects in this process.
+_compiled_libraries = {}
+
+
+class LibraryProject(object):
+    """A library project, referenced by an ``AndroidProject``.
+
+    It is expected to have the same directory layout as an
+    ``AndroidProject``; the libraries it depends on in turn are read
+    from its ``project.properties`` file, unless given as
+    ``libraries``.
+
+    A library is compiled only once, no matter how many projects use
+    it: see ``compile()``.
+    """
+
+    def __init__(self, project_dir, libraries=None):
+        self.project_dir = path.abspath(project_dir)
+        self.manifest = path.join(self.project_dir, 'AndroidManifest.xml')
+        self.resource_dir = path.join(self.project_dir, 'res')
+        self.source_dir = path.join(self.project_dir, 'src')
+        self.lib_dir = path.join(self.project_dir, 'libs')
+        self.out_dir = path.join(self.project_dir, 'bin')
+        if libraries is None:
+            libraries = read_library_references(self.project_dir)
+        self.libraries = libraries
+
+    def __repr__(self):
+        return '%s <%s>' % (self.__class__.__name__, self.project_dir)
+
+    @property
+    def package(self):
+        if not hasattr(self, '_package'):
+            from xml.etree import ElementTree
+            self._package = ElementTree.parse(
+                self.manifest).getroot().attrib['package']
+        return self._package
+
+    def fingerprint(self, platform, dependencies=[]):
+        return self._fingerprint(
+            platform, [d.fingerprint for d in dependencies])
+
+    def _fingerprint(self, platform, dependencies):
+        return content_key(
+            'library', [self.manifest, self.source_dir, self.resource_dir,
+                        self.lib_dir],
+            platform=platform.version, dependencies=dependencies)
+
+    def _current_fingerprint(self, platform):
+        """The fingerprint ``compile()`` would find, without compiling
+        the dependencies.
+        """
+        return self._fingerprint(
+            platform, [lib._current_fingerprint(platform)
+                       for lib in self.libraries])
+
+    def is_current(self, platform):
+        """Whether ``compile()`` would reuse the compiled library,
+        rather than compile it.
+        """
+        fingerprint = self._current_fingerprint(platform)
+        if (self.project_dir, fingerprint) in _compiled_libraries:
+            return True
+        return self._is_compiled(fingerprint)
+
+    def _is_compiled(self, fingerprint):
+        stamp = path.join(self.out_dir, 'library.fingerprint')
+        if not (path.exists(stamp) and
+                path.exists(path.join(self.out_dir, 'classes.jar')) and
+                path.exists(path.join(self.out_dir, 'classes-dex.jar'))):
+            return False
+        with open(stamp) as f:
+            return f.read().strip() == fingerprint
+
+    def compile(self, platform):
+        """Compile the library, and the libraries it depends on, unless
+        that has already happened; returns a ``LibraryObj``.
+
+        The result is kept for as long as the process runs, and in
+        ``./bin`` of the library project, as long as the library and its
+        dependencies do not change. The code is also looked up in the
+        platform's remote cache, if it has one.
+        """
+        dependencies = [lib.compile(platform) for lib in self.libraries]
+        # Other projects may well be waiting for this library.
+        with _lock_for(self.project_dir):
+            fingerprint = self.fingerprint(platform, dependencies)
+            key = (self.project_dir, fingerprint)
+            if key not in _compiled_libraries:
+                with report_step('compile_library'):
+                    _compiled_libraries[key] = self._compile(
+                        platform, dependencies, fingerprint)
+            return _compiled_libraries[key]
+
+    def _compile(self, platform, dependencies, fingerprint):
+        classes_jar = path.join(self.out_dir, 'classes.jar')
+        dex_jar = path.join(self.out_dir, 'classes-dex.jar')
+        stamp = path.join(self.out_dir, 'library.fingerprint')
+        if self._is_compiled(fingerprint):
+            log.info('Library %s is up-to-date' % self.project_dir)
+            report_up_to_date()
+            return LibraryObj(self, classes_jar, dex_jar, fingerprint)
+        mkdir(self.out_dir, recursive=True)
+        platform._cached(
+            'compile_library', classes_jar,
+            [self.manifest, self.source_dir, self.resource_dir,
+             self.lib_dir],
+            lambda: self._compile_classes(platform, dependencies,
+                                          classes_jar),
+            dependencies=[d.fingerprint for d in dependencies])
+        platform.dex(classes_jar, output=dex_jar)
+        with open(stamp, 'w') as f:
+            f.write(fingerprint)
+        return LibraryObj(self, classes_jar, dex_jar, fingerprint)
+
+    def _compile_classes(self, platform, dependencies, classes_jar):
+        """Compile the library into ``classes_jar``, without R classes.
+        """
+        libs = platform._library_args(dependencies)
+        gen_dir = tempfile.mkdtemp()
+        class_dir = tempfile.mkdtemp()
+        try:
+            source_dirs = only_existing([self.source_dir])
+            platform.compile_renderscript(
+                self.resource_dir, gen_dir, source_dirs)
+            # The ids are only final once an app is built; the code must
+            # not inline them.
+            platform.generate_r(
+                self.manifest,
+                only_existing([self.resource_dir]) + libs['resource_dirs'],
+                gen_dir, extra_packages=libs['packages'],
+                non_constant_id=True)
+            platform.compile_aidl(source_dirs, gen_dir,
+                                  import_dirs=libs['source_dirs'])
+            platform.compile_java(
+                source_dirs + [gen_dir], class_dir,
+                extra_jars=only_existing([self.lib_dir]) + libs['class_jars'])
+            write_jar(class_dir, classes_jar, exclude=[
+                package.replace('.', '/') for package in
+                [self.package] + libs['packages']])
+        finally:
+            shutil.rmtree(gen_dir)
+            shutil.rmtree(class_dir)
+
+
+def write_jar(directory, filename, exclude=[]):
+    """Put the class files in ``directory`` into the jar ``filename``,
+    except for the R classes of the packages (as paths) in ``exclude``.
+    """
+    excluded = set(exclude)
+    files = []
+    for base, dirs, names in os.walk(directory):
+        package = path.relpath(base, directory).replace(os.sep, '/')
+        for name in names:
+            if package in excluded and (
+                    name == 'R.class' or name.startswith('R$')):
+                continue
+            files.append(name if package == '.' else
+                         '%s/%s' % (package, name))
+    # Written next to the jar and renamed; the jar may be hardlinked
+    # into a snapshot.
+    tmp = '%s.tmp' % filename
+    with open(tmp, 'wb') as f:
+        writer = ApkWriter(f, align=0, date_time=DETERMINISTIC_TIME)
+        for name in sorted(files):
+            with open(path.join(directory, name), 'rb') as source:
+                writer.write(name, source.read())
+        writer.close()
+    os.rename(tmp, filename)
+
+
 class AndroidProject(object):
     """Represents an Android project to be built.
 
@@ -534,6 +1354,36 @@ class AndroidProject(object):
              place within ./lib. You'll use this to reference things
              like the Android Compatibility Support Libraries.
 
+        ``history_file``
+             A file to which the ``BuildReport`` of every ``build()``
+             is appended, as a line of JSON. ``plan()`` estimates
+             durations from it.
+
+        ``libraries``
+             The library projects used, as ``LibraryProject``
+             instances. By default, the references in the
+             ``project.properties`` file.
+
+        ``shrink``
+             Remove unused code with ProGuard before dexing, see
+             ``PlatformTarget.shrink()``. Set ``optimize`` as well to
+             have ProGuard optimize the code.
+
+        ``proguard_config``
+             Additional ProGuard configuration files. By default,
+             those in ``proguard.config`` of ``project.properties``.
+
+        ``java_partitions``
+             Compile the Java sources on all CPUs, in parts which do
+             not refer to each other; ``'packages'``, or a list of
+             modules. See ``PlatformTarget.compile_java()``.
+
+        ``shrink_resources``
+             Replace the resources which the code does not use with
+             tiny placeholders, see ``PlatformTarget.shrink_resources()``.
+             Resources looked up by a name which is only assembled at
+             runtime are not detected, and are lost.
+
     When constructing a ``AndroidProject`` instance, you either need to
     pass a platform that you have aquired yourself using ``get_platform``,
     or you need to give the path to the Android SDK in ``sdk_dir``.
@@ -574,6 +1424,15 @@ class AndroidProject(object):
         # Optional values
         self.extra_source_dirs = []
         self.extra_jars = []
+        self.history_file = None
+        self.libraries = read_library_references(self.project_dir)
+        self.shrink = False
+        self.optimize = False
+        self.proguard_config = read_proguard_config(
+            self.project_dir, self.platform.sdk_dir)
+        self.shrink_resources = False
+        self.shrunk_resource_dirs = None
+        self.java_partitions = None
 
         # if no name is given, inspect the manifest
         self.name = name or self.manifest_parsed.attrib['package']
@@ -587,8 +1446,53 @@ class AndroidProject(object):
 
     def compile(self):
         """Force a recompile of the project.
+
+        Library projects are only compiled if they changed.
         """
-        kwargs = dict(
+        libraries = self._compile_libraries()
+        self.code = self.platform.compile(
+            libraries=libraries, **self._compile_args())
+        self._shrink_resources(self.platform, libraries)
+
+    def _shrink_resources(self, platform, libraries):
+        self.shrunk_resource_dirs = None
+        if not self.shrink_resources:
+            return
+        args = self._compile_args()
+        if self.shrink:
+            # Only what ProGuard left over.
+            code = [path.join(self.out_dir, 'classes-shrunk.jar')]
+        else:
+            code = [args['class_gen_dir']] + args['extra_jars'] + \
+                [lib.filename for lib in libraries]
+        self.shrunk_resource_dirs = platform.shrink_resources(
+            self.manifest, self._resource_dirs(), code, self.gen_dir,
+            path.join(self.out_dir, 'res-shrunk'),
+            extra_packages=[lib.package for lib in libraries])
+
+    def _resource_dirs(self):
+        return [self.resource_dir] + only_existing(
+            [lib.resource_dir for lib in self._all_libraries()])
+
+    def _all_libraries(self):
+        """All library projects, including those used by other
+        libraries, in order of their resource priority.
+        """
+        result = []
+        def add(libraries):
+            for lib in libraries:
+                if not lib.project_dir in [l.project_dir for l in result]:
+                    result.append(lib)
+                    add(lib.libraries)
+        add(self.libraries)
+        return result
+
+    def _compile_libraries(self, platform=None):
+        platform = platform or self.platform
+        return [lib.compile(platform) for lib in self._all_libraries()]
+
+    def _compile_args(self):
+        return dict(
             dex_output=path.join(self.out_dir, 'classes.dex'),
             manifest=self.manifest,
             project_dir = self.project_dir,
@@ -596,9 +1500,12 @@ class AndroidProject(object):
             resource_dir=self.resource_dir,
             source_gen_dir=self.gen_dir,
             class_gen_dir=path.join(self.out_dir, 'classes'),
-            extra_jars=only_existing([self.lib_dir])+self.extra_jars
+            extra_jars=only_existing([self.lib_dir])+self.extra_jars,
+            shrink=self.shrink,
+            optimize=self.optimize,
+            proguard_config=self.proguard_config,
+            partitions=self.java_partitions,
         )
-        self.code = self.platform.compile(**kwargs)
 
     def build(self, output=None, config=None, package_name=None,
               version_code=None, version_name=None):
@@ -607,12 +1514,107 @@ class AndroidProject(object):
         ``package_name`` and ``version`` can be used to change these
         properties without needing to modify the AndroidManifest.xml
         file.
+
+        The ``report`` attribute of the returned ``Apk`` is a
+        ``BuildReport`` with the time, CPU, memory and I/O used by
+        each tool, grouped by build step.
         """
-        # Make sure the code is compiled
-        if not hasattr(self, 'code'):
-            self.compile()
+        report = BuildReport(self.name)
+        try:
+            with report.activate():
+                # Make sure the code is compiled
+                if not hasattr(self, 'code'):
+                    self.compile()
+
+                # Package the resources
+                resources = self.platform.pack_resources(
+                    **self._resource_args(
+                        config, package_name, version_code, version_name))
+                assets = self.platform.pack_assets(
+                    self.asset_dir, self.out_dir) \
+                    if self._use_asset_pack() else None
+
+                # Put everything into an APK.
+                apk = self.platform.build_apk(
+                    resources=resources, assets=assets,
+                    **self._apk_args(output))
+            self._finish_report(apk, report)
+        finally:
+            # Failed builds are worth a look on the dashboard, too.
+            metrics.flush()
+        return apk
+
+    def plan(self, output=None, config=None, package_name=None,
+             version_code=None, version_name=None, history=None):
+        """Return a ``BuildPlan`` of the steps ``build()`` would run
+        with the same arguments, and of those it would skip as their
+        output is up-to-date, without running anything.
 
-        # Package the resources
+        The durations are estimated from ``history``, a ``StepHistory``,
+        by default read from ``history_file``. Pass one in to plan many
+        variants without reading the file for each.
+        """
+        if history is None:
+            history = StepHistory(self.history_file)
+        plan = BuildPlan(self.name, history)
+        platform = self.platform
+        compiling = not hasattr(self, 'code')
+        if compiling:
+            for lib in self._all_libraries():
+                if lib.is_current(platform):
+                    plan.add('compile_library', lib.project_dir, False,
+                             'up-to-date')
+                else:
+                    plan.add('compile_library', lib.project_dir, True,
+                             'changed')
+            plan.add('compile', self.project_dir, True, 'not compiled')
+            if self.shrink_resources:
+                plan.add('shrink_resources', self.resource_dir, True,
+                         'after compiling')
+        else:
+            plan.add('compile', self.project_dir, False, 'compiled')
+
+        kwargs = self._resource_args(
+            config, package_name, version_code, version_name)
+        output_ap = path.abspath(kwargs['output'])
+        if not platform._is_variant(package_name, version_code,
+                                    version_name):
+            plan.add('pack_resources', output_ap, True, 'always')
+        else:
+            base = platform._base_resources(output_ap)
+            if compiling and self.shrink_resources:
+                # Packaged from resources which do not exist yet.
+                current = False
+            else:
+                current = is_current(base, platform._resources_fingerprint(
+                    kwargs['manifest'], kwargs['resource_dir'],
+                    kwargs.get('asset_dir'), config))
+            # Named like the steps the build reports, as they take
+            # very different times.
+            if current:
+                plan.add('derive_resources', output_ap, True,
+                         'variant of up-to-date base')
+            else:
+                plan.add('pack_base_resources', output_ap, True,
+                         'variant of new base')
+        if self._use_asset_pack():
+            assets = platform._asset_pack_name(self.asset_dir, self.out_dir)
+            if path.exists(assets):
+                plan.add('pack_assets', assets, False, 'up-to-date')
+            else:
+                plan.add('pack_assets', assets, True, 'assets changed')
+        plan.add('build_apk', path.abspath(
+            output or path.join(self.out_dir, '%s.apk' % self.name)),
+            True, 'always')
+        return plan
+
+    def _finish_report(self, apk, report):
+        apk.report = report
+        if self.history_file:
+            report.append_to(self.history_file)
+
+    def _resource_args(self, config, package_name, version_code,
+                       version_name):
         if not config:
             resource_filename = path.join(
                 self.out_dir, '%s.ap_' % (self.name))
@@ -621,27 +1623,92 @@ class AndroidProject(object):
                 self.out_dir, '%s.%s.ap_' % (self.name, config))
         kwargs = dict(
             manifest=self.manifest,
-            resource_dir=self.resource_dir,
+            resource_dir=self.shrunk_resource_dirs or self._resource_dirs(),
             configurations=config,
             output=resource_filename,
             package_name=package_name,
             version_code=version_code,
             version_name=version_name,
         )
-        if path.exists(self.asset_dir):
+        if path.exists(self.asset_dir) and not self._use_asset_pack():
             kwargs.update({'asset_dir': self.asset_dir})
-        resources = self.platform.pack_resources(**kwargs)
+        return kwargs
 
-        # Put everything into an APK.
+    def _use_asset_pack(self):
+        """With a deflater, the assets are packed once, rather than by
+        ``aapt`` for each build.
+        """
+        return bool(self.platform.deflater) and path.exists(self.asset_dir)
+
+    def _apk_args(self, output):
         if not output:
             output = path.join(self.out_dir, '%s.apk' % self.name)
-        apk = self.platform.build_apk(
-            output,
-            code=self.code, resources=resources,
-            jar_paths=only_existing([self.lib_dir])+self.extra_jars,
-            native_dirs=only_existing([self.lib_dir]),
-            source_dirs=only_existing([self.source_dir]))
-        return apk
+        libraries = self._all_libraries()
+        lib_dirs = only_existing(
+            [self.lib_dir] + [lib.lib_dir for lib in libraries])
+        return dict(
+            output=output,
+            code=self.code,
+            jar_paths=lib_dirs+self.extra_jars,
+            native_dirs=lib_dirs,
+            source_dirs=only_existing(
+                [self.source_dir] + [lib.source_dir for lib in libraries]))
+
+    def snapshot(self, directory=None, hook=None):
+        """Return a new ``AndroidProject`` operating on a lightweight
+        copy of the project directory (see ``Workspace``), so that
+        variants which require source modifications can be built
+        in parallel from a single checkout.
+
+        ``hook``, if given, is called with the ``Workspace`` instance
+        and can make the variant-specific changes; remember to go
+        through ``Workspace.open()`` or ``Workspace.writable()`` when
+        modifying a file in-place.
+
+        The workspace is available as the ``workspace`` attribute of
+        the returned project; call ``workspace.delete()`` when done.
+        """
+        # Native builds write into libs/, so that needs a real copy.
+        workspace = Workspace(
+            self.project_dir, directory,
+            copy=('libs', ) if self.platform.ndk_build else ())
+
+        def rebase(p):
+            relpath = path.relpath(p, self.project_dir)
+            if relpath.startswith(os.pardir):
+                return p
+            return workspace.path(relpath)
+
+        project = self.__class__(
+            rebase(self.manifest), name=self.name, platform=self.platform,
+            ndk_dir=self.ndk_dir, project_dir=workspace.directory)
+        project.extra_source_dirs = [rebase(p) for p in self.extra_source_dirs]
+        project.extra_jars = [rebase(p) for p in self.extra_jars]
+        project.libraries = [
+            lib if rebase(lib.project_dir) == lib.project_dir
+            else LibraryProject(rebase(lib.project_dir))
+            for lib in self.libraries]
+        project.shrink = self.shrink
+        project.optimize = self.optimize
+        project.proguard_config = [rebase(p) for p in self.proguard_config]
+        project.shrink_resources = self.shrink_resources
+        # Not rebased: the history should outlive the workspace.
+        project.history_file = self.history_file
+        project.java_partitions = self.java_partitions if \
+            self.java_partitions in (None, 'packages') else \
+            [[rebase(d) for d in module] for module in self.java_partitions]
+        project.workspace = workspace
+        # llvm-rs-cc writes into res/raw, in place.
+        for resource_dir in project._resource_dirs():
+            raw_dir = path.join(resource_dir, 'raw')
+            if path.isdir(raw_dir) and \
+                    raw_dir.startswith(workspace.directory + os.sep):
+                for filename in os.listdir(raw_dir):
+                    if filename.endswith('.bc'):
+                        workspace.writable(path.join(raw_dir, filename))
+        if hook:
+            hook(workspace)
+        return project
 
     def clean(self):
         """Deletes both ``self.out_dir`` and ``self.gen_dir``.
@@ -0,0 +1,391 @@
+"""
+Copyright (c) 2011 Michael Elsdoerfer <michael@elsdoerfer.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+A build cache shared between machines.
+
+Step outputs are stored under a key derived from the content of their
+inputs. The protocol is plain HTTP:
+
+    GET /<key>      200 with the file as the body, or 404.
+    PUT /<key>      Stores the body, answers 201.
+
+Both directions send an ``X-Content-SHA256`` header with the hex digest
+of the body, which the receiving side verifies.
+
+``CacheServer`` is a simple reference implementation of the server side,
+storing the files in a local directory.
+"""
+
+import os
+import sys
+import socket
+import hashlib
+import logging
+import tempfile
+import threading
+from os import path
+try:
+    from urlparse import urlsplit
+    from httplib import HTTPConnection, HTTPException
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from Queue import Queue
+except ImportError:
+    from urllib.parse import urlsplit
+    from http.client import HTTPConnection, HTTPException
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from queue import Queue
+
+
+__all__ = ('RemoteCache', 'CacheServer', 'content_key')
+
+
+# Same logger as android.build, which imports us.
+log = logging.getLogger('py-androidbuild')
+
+
+HASH_HEADER = 'X-Content-SHA256'
+CHUNK_SIZE = 64 * 1024
+
+
+# Digests of files we already hashed, by (path, size, mtime).
+_file_digests = {}
+
+
+def file_digest(filename):
+    """Return the SHA-256 hex digest of ``filename``.
+    """
+    stat = os.stat(filename)
+    cache_key = (filename, stat.st_size, stat.st_mtime)
+    if cache_key not in _file_digests:
+        h = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                h.update(chunk)
+        _file_digests[cache_key] = h.hexdigest()
+    return _file_digests[cache_key]
+
+
+def content_key(step, inputs=[], **params):
+    """Compute a cache key for the build step ``step``.
+
+    ``inputs`` is a list of files and directories, whose content is
+    what the key is based on; their location is not relevant, except
+    for the relative paths within a directory. ``params`` are any
+    additional settings which influence the output.
+    """
+    h = hashlib.sha256()
+    h.update(('step:%s\n' % step).encode('utf-8'))
+    for name in sorted(params):
+        h.update(('param:%s=%r\n' % (name, params[name])).encode('utf-8'))
+    for item in inputs:
+        if item is None:
+            h.update(b'none\n')
+        elif path.isdir(item):
+            h.update(b'dir\n')
+            for base, dirs, files in sorted(os.walk(item)):
+                for f in sorted(files):
+                    filename = path.join(base, f)
+                    h.update(('%s:%s\n' % (
+                        path.relpath(filename, item).replace(os.sep, '/'),
+                        file_digest(filename))).encode('utf-8'))
+        elif path.exists(item):
+            h.update(('file:%s\n' % file_digest(item)).encode('utf-8'))
+        else:
+            h.update(b'missing\n')
+    return h.hexdigest()
+
+
+def run_concurrently(func, items, workers):
+    """Call ``func`` for each element in ``items``, using up to
+    ``workers`` threads. Returns the results in order.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    queue = Queue()
+    for i, item in enumerate(items):
+        queue.put((i, item))
+
+    def worker():
+        while True:
+            try:
+                i, item = queue.get_nowait()
+            except Exception:
+                return
+            results[i] = func(item)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(workers, len(items)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+class RemoteCache(object):
+    """Client for a remote build cache at ``url``.
+
+    The cache never causes a build to fail: network problems or corrupt
+    downloads are logged and treated as a cache miss. After
+    ``max_failures`` connection errors, the cache disables itself for
+    the remaining lifetime of the object.
+
+    Uploads happen in the background; use ``wait()`` to make sure they
+    are finished before the process exits.
+    """
+
+    def __init__(self, url, timeout=10, max_failures=3, workers=4,
+                 read_only=False):
+        parts = urlsplit(url)
+        self.url = url
+        self.host = parts.netloc
+        self.base_path = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.workers = workers
+        self.read_only = read_only
+        self.failures = 0
+        self.hits = self.misses = 0
+        self._uploads = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '%s <%s>' % (self.__class__.__name__, self.url)
+
+    @property
+    def enabled(self):
+        return self.failures < self.max_failures
+
+    def _request(self, method, key, body=None, headers={}):
+        conn = HTTPConnection(self.host, timeout=self.timeout)
+        try:
+            conn.request(method, '%s/%s' % (self.base_path, key),
+                         body, headers)
+            return conn, conn.getresponse()
+        except:
+            conn.close()
+            raise
+
+    def _failed(self, what, e):
+        with self._lock:
+            self.failures += 1
+            if not self.enabled:
+                log.warning('Remote cache %s disabled after %d errors' % (
+                    self.url, self.failures))
+        log.warning('Remote cache %s failed: %s' % (what, e))
+
+    def get(self, key, filename):
+        """Download the file stored under ``key`` to ``filename``.
+
+        Returns ``True`` if the file was found, ``False`` if not.
+        """
+        if not self.enabled:
+            return False
+        tmp = None
+        try:
+            conn, response = self._request('GET', key)
+            try:
+                if response.status != 200:
+                    with self._lock:
+                        self.misses += 1
+                    return False
+                expected = response.getheader(HASH_HEADER)
+                fd, tmp = tempfile.mkstemp(
+                    dir=path.dirname(path.abspath(filename)))
+                h = hashlib.sha256()
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                        h.update(chunk)
+                        f.write(chunk)
+            finally:
+                conn.close()
+        except (socket.error, HTTPException) as e:
+            if tmp and path.exists(tmp):
+                os.unlink(tmp)
+            self._failed('GET %s' % key, e)
+            return False
+
+        if not expected or h.hexdigest() != expected:
+            os.unlink(tmp)
+            log.warning('Remote cache returned corrupt data for %s' % key)
+            with self._lock:
+                self.misses += 1
+            return False
+        if path.exists(filename) and sys.platform == 'win32':
+            os.unlink(filename)
+        os.rename(tmp, filename)
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def get_many(self, items):
+        """Fetch multiple ``(key, filename)`` pairs concurrently.
+
+        Returns a list of booleans, like ``get()``.
+        """
+        return run_concurrently(
+            lambda item: self.get(*item), items, self.workers)
+
+    def put(self, key, filename, wait=False):
+        """Upload ``filename`` under ``key``.
+
+        Happens in a background thread, unless ``wait`` is set.
+        """
+        if not self.enabled or self.read_only:
+            return
+        if wait:
+            return self._put(key, filename)
+        # Read the file now; the caller is free to modify it afterwards.
+        with open(filename, 'rb') as f:
+            data = f.read()
+        thread = threading.Thread(target=self._put, args=(key, None, data))
+        thread.daemon = True
+        thread.start()
+        with self._lock:
+            self._uploads = [t for t in self._uploads if t.is_alive()]
+            self._uploads.append(thread)
+
+    def _put(self, key, filename, data=None):
+        if data is None:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        headers = {HASH_HEADER: hashlib.sha256(data).hexdigest(),
+                   'Content-Type': 'application/octet-stream'}
+        try:
+            conn, response = self._request('PUT', key, data, headers)
+            conn.close()
+        except (socket.error, HTTPException) as e:
+            self._failed('PUT %s' % key, e)
+            return False
+        if response.status not in (200, 201, 204):
+            log.warning('Remote cache rejected %s: %s %s' % (
+                key, response.status, response.reason))
+            return False
+        return True
+
+    def wait(self):
+        """Wait for all pending uploads to finish.
+        """
+        for thread in list(self._uploads):
+            thread.join()
+
+
+class _CacheRequestHandler(BaseHTTPRequestHandler):
+
+    def _key(self):
+        key = self.path.strip('/')
+        # Keys are hex digests; refuse anything that could escape the
+        # storage directory.
+        if not key or not all(c in '0123456789abcdef' for c in key):
+            self.send_error(400, 'Invalid key')
+            return None
+        return key
+
+    def do_GET(self):
+        key = self._key()
+        if not key:
+            return
+        filename = path.join(self.server.directory, key)
+        if not path.exists(filename):
+            self.send_error(404)
+            return
+        with open(filename, 'rb') as f:
+            data = f.read()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header(HASH_HEADER, hashlib.sha256(data).hexdigest())
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_PUT(self):
+        key = self._key()
+        if not key:
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length)
+        if hashlib.sha256(data).hexdigest() != self.headers.get(HASH_HEADER):
+            self.send_error(400, 'Checksum mismatch')
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.server.directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path.join(self.server.directory, key))
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        log.debug('Cache server: ' + format % args)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class CacheServer(object):
+    """A minimal cache server storing files in ``directory``.
+
+    Meant to be run locally, or as a starting point; it does not do
+    any authentication or eviction. If ``port`` is 0, a free port is
+    chosen; see the ``url`` attribute.
+    """
+
+    def __init__(self, directory, host='127.0.0.1', port=0):
+        if not path.exists(directory):
+            os.makedirs(directory)
+        self.httpd = _ThreadingHTTPServer((host, port), _CacheRequestHandler)
+        self.httpd.directory = path.abspath(directory)
+        self.url = 'http://%s:%d' % self.httpd.server_address[:2]
+        self._thread = None
+
+    def __repr__(self):
+        return '%s <%s>' % (self.__class__.__name__, self.url)
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def start(self):
+        """Serve in a background thread.
+        """
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread:
+            self._thread.join()
+
+
+def main(argv):
+    if len(argv) not in (1, 2):
+        print("Usage: python -m android.cache DIRECTORY [PORT]")
+        return 1
+    server = CacheServer(argv[0], host='0.0.0.0',
+                         port=int(argv[1]) if len(argv) > 1 else 8080)
+    print("Serving build cache on %s" % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]) or 0)
@@ -0,0 +1,582 @@
+"""
+Copyright (c) 2011 Michael Elsdoerfer <michael@elsdoerfer.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+A long-running process which rebuilds a project whenever it changes.
+
+The daemon watches the sources, resources, assets, libraries and the
+manifest of an ``AndroidProject``, and after a change only runs the
+build steps affected by it. The most recent APK is kept ready (signed
+and aligned, if a key is given). Clients can connect to ask for a build
+and wait for the result, see ``request_build()``.
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import select
+import shutil
+import socket
+import struct
+import logging
+import threading
+from os import path
+try:
+    from SocketServer import ThreadingTCPServer, StreamRequestHandler
+except ImportError:
+    from socketserver import ThreadingTCPServer, StreamRequestHandler
+
+from .tools import ProgramFailedError
+from .report import BuildReport
+from . import metrics
+
+
+__all__ = ('BuildDaemon', 'BuildTimeout', 'InotifyWatcher',
+           'PollingWatcher', 'request_build')
+
+
+# Same logger as android.build.
+log = logging.getLogger('py-androidbuild')
+
+
+def _ignored(filename):
+    """Editor backup and swap files."""
+    name = path.basename(filename)
+    return name.startswith('.') or name.endswith('~') or \
+        name.startswith('#')
+
+
+class BuildTimeout(RuntimeError):
+    """The daemon did not finish a requested build in time.
+    """
+
+
+class PollingWatcher(object):
+    """Detects changes by comparing the modification times of all files
+    below ``paths`` every ``interval`` seconds.
+    """
+
+    def __init__(self, paths, interval=1.0):
+        self.paths = paths
+        self.interval = interval
+        self._state = self._scan()
+
+    def _scan(self):
+        state = {}
+        for item in self.paths:
+            if path.isfile(item):
+                files = [item]
+            else:
+                files = [path.join(base, f)
+                         for base, dirs, names in os.walk(item)
+                         for f in names]
+            for filename in files:
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                state[filename] = (stat.st_mtime, stat.st_size)
+        return state
+
+    def wait(self, timeout):
+        """Return the set of paths which changed, or an empty set if
+        nothing changed within ``timeout`` seconds.
+        """
+        deadline = time.time() + timeout
+        while True:
+            state = self._scan()
+            changed = set(
+                f for f in set(state) | set(self._state)
+                if state.get(f) != self._state.get(f) and not _ignored(f))
+            self._state = state
+            if changed or time.time() >= deadline:
+                return changed
+            time.sleep(min(self.interval, max(0, deadline - time.time())))
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Uses Linux' inotify to watch ``paths`` (files, or directories,
+    which are watched recursively). Directories which do not exist yet
+    are watched for once they are created.
+
+    Raises ``OSError`` if inotify is not available.
+    """
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0x80000
+
+    mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+        IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, paths):
+        import ctypes
+        import ctypes.util
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify requires Linux')
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True)
+        self.fd = self._libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._watches = {}
+        self._roots = []
+        # Single files are watched through their directory.
+        self._files = set()
+        for item in paths:
+            if path.isdir(item):
+                self._roots.append(item)
+                self._watch_tree(item)
+            elif path.exists(item):
+                self._files.add(item)
+                self._watch(path.dirname(item))
+            else:
+                # Like assets/ or jni/, which may be added any time.
+                self._roots.append(item)
+                parent = path.dirname(item)
+                while not path.isdir(parent):
+                    parent = path.dirname(parent)
+                self._watch(parent)
+
+    def _watch(self, directory):
+        wd = self._libc.inotify_add_watch(
+            self.fd, directory.encode(sys.getfilesystemencoding()),
+            self.mask)
+        if wd >= 0:
+            self._watches[wd] = directory
+
+    def _watch_tree(self, directory):
+        """Watch ``directory`` and those below it; returns the files
+        already in there.
+        """
+        self._watch(directory)
+        found = set()
+        for base, dirs, files in os.walk(directory):
+            for d in dirs:
+                self._watch(path.join(base, d))
+            found.update(path.join(base, f) for f in files)
+        return found
+
+    def _leads_to_root(self, directory):
+        return any(root.startswith(directory + os.sep)
+                   for root in self._roots)
+
+    def _is_relevant(self, filename):
+        if _ignored(filename):
+            return False
+        return filename in self._files or any(
+            filename.startswith(root + os.sep) for root in self._roots)
+
+    def _read_events(self):
+        data = os.read(self.fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from(
+                'iIII', data, offset)
+            offset += 16
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            filename = path.join(
+                directory, name.decode(sys.getfilesystemencoding()))
+            if mask & self.IN_ISDIR:
+                if not mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    continue
+                if filename in self._roots or self._is_relevant(filename):
+                    # Files may have been added before the watch was.
+                    changed.update(f for f in self._watch_tree(filename)
+                                   if self._is_relevant(f))
+                elif self._leads_to_root(filename):
+                    self._watch(filename)
+                continue
+            if self._is_relevant(filename):
+                changed.add(filename)
+        return changed
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        return self._read_events()
+
+    def close(self):
+        os.close(self.fd)
+
+
+def get_watcher(paths):
+    """Return an ``InotifyWatcher`` if possible, a ``PollingWatcher``
+    otherwise.
+    """
+    try:
+        return InotifyWatcher(paths)
+    except (OSError, AttributeError) as e:
+        log.info('Falling back to polling for changes: %s' % e)
+        return PollingWatcher(paths)
+
+
+class BuildResult(object):
+    """The outcome of a build done by the daemon.
+    """
+
+    def __init__(self, number, apk=None, error=None, steps=(),
+                 duration=None):
+        self.number = number
+        self.apk = apk
+        self.error = error
+        self.steps = steps
+        self.duration = duration
+        self.time = time.time()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def as_dict(self):
+        return {'number': self.number, 'ok': self.ok, 'apk': self.apk,
+                'error': self.error, 'steps': list(self.steps),
+                'duration': self.duration, 'time': self.time}
+
+
+class _ClientHandler(StreamRequestHandler):
+
+    def handle(self):
+        daemon = self.server.daemon
+        for line in iter(self.rfile.readline, b''):
+            request = json.loads(line.decode('utf-8'))
+            result = daemon.last_result
+            response = None
+            if request.get('command') == 'build':
+                try:
+                    result = daemon.request_build(request.get('timeout'))
+                except BuildTimeout as e:
+                    # Rather than pass off the last result as current.
+                    response = {'ok': False, 'timeout': True,
+                                'error': '%s' % e}
+            if response is None:
+                response = result.as_dict() if result else {'ok': None}
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+class BuildDaemon(object):
+    """Rebuilds ``project`` whenever its files change.
+
+    If ``keystore`` is given, as a ``(keystore, alias, password)`` tuple,
+    the APK is signed and aligned after each build. The latest APK
+    that built successfully is always available at ``output``.
+
+    Changes are collected until the files have been quiet for
+    ``debounce`` seconds, to not build in the middle of a checkout.
+    """
+
+    address_file = 'daemon.address'
+
+    def __init__(self, project, output=None, keystore=None, debounce=0.5,
+                 host='127.0.0.1', port=0, watcher=None):
+        self.project = project
+        self.output = output or path.join(
+            project.out_dir, '%s-latest.apk' % project.name)
+        self.keystore = keystore
+        self.debounce = debounce
+        self.watcher = watcher or get_watcher(self.watched_paths())
+
+        self.last_result = None
+        self._number = 0
+        # Build requests are numbered; all up to _checked were served.
+        self._requests = 0
+        self._checked = 0
+        self._failed_steps = set()
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+
+        self.server = ThreadingTCPServer(
+            (host, port), _ClientHandler, bind_and_activate=False)
+        self.server.daemon_threads = True
+        self.server.allow_reuse_address = True
+        self.server.server_bind()
+        self.server.server_activate()
+        self.server.daemon = self
+        self.address = self.server.server_address[:2]
+
+    def __repr__(self):
+        return '%s <%s:%s>' % (self.__class__.__name__,
+                               self.address[0], self.address[1])
+
+    def watched_paths(self):
+        p = self.project
+        return [p.source_dir, p.resource_dir, p.asset_dir, p.lib_dir,
+                p.manifest, path.join(p.project_dir, 'jni')] + \
+            list(p.extra_source_dirs) + \
+            [lib.project_dir for lib in p._all_libraries()]
+
+    def affected_steps(self, changed):
+        """Return the set of build steps to run after ``changed`` files
+        were modified.
+        """
+        p = self.project
+
+        def inside(filename, directory):
+            return filename == directory or \
+                filename.startswith(directory + os.sep)
+
+        libraries = p._all_libraries()
+        steps = set()
+        for filename in changed:
+            ext = path.splitext(filename)[1]
+            if ext == '.bc' and any(inside(filename, d) for d in
+                    [p.resource_dir] + [l.resource_dir for l in libraries]):
+                # Written by compile_renderscript itself.
+                continue
+            if any(inside(filename, l.out_dir) for l in libraries):
+                # Written by the library build itself.
+                continue
+            if any(inside(filename, l.project_dir) for l in libraries):
+                # The library itself is only rebuilt if it changed.
+                steps |= set(['generate_r', 'compile_java', 'dex',
+                              'pack_resources', 'build_apk'])
+            elif filename == p.manifest or inside(filename, p.resource_dir):
+                steps |= set(['generate_r', 'compile_java', 'dex',
+                              'pack_resources', 'build_apk'])
+            elif inside(filename, p.asset_dir):
+                steps |= set(['pack_resources', 'build_apk'])
+            elif inside(filename, p.lib_dir):
+                steps |= set(['compile_java', 'dex', 'build_apk'])
+            elif inside(filename, path.join(p.project_dir, 'jni')):
+                steps |= set(['compile_native', 'build_apk'])
+            elif any(inside(filename, d)
+                     for d in [p.source_dir] + list(p.extra_source_dirs)):
+                if ext == '.aidl':
+                    steps.add('compile_aidl')
+                elif ext == '.rs':
+                    steps |= set(['compile_renderscript', 'pack_resources'])
+                if ext in ('.java', '.aidl', '.rs'):
+                    steps |= set(['compile_java', 'dex'])
+                # Java resources are packaged from the source folder.
+                steps.add('build_apk')
+        return steps
+
+    def run_steps(self, steps):
+        """Run the given build steps of the project, in order. Returns
+        the ``Apk``.
+        """
+        p = self.project
+        platform = p.platform
+        args = p._compile_args()
+        source_dirs = args['source_dirs']
+        libraries = []
+        if steps & set(['generate_r', 'compile_aidl', 'compile_java', 'dex']):
+            libraries = p._compile_libraries()
+        libs = platform._library_args(libraries)
+        if 'compile_renderscript' in steps:
+            platform.compile_renderscript(
+                p.resource_dir, p.gen_dir, source_dirs)
+        if 'generate_r' in steps:
+            platform.generate_r(
+                p.manifest, [p.resource_dir] + libs['resource_dirs'],
+                p.gen_dir, extra_packages=libs['packages'])
+        if 'compile_aidl' in steps:
+            platform.compile_aidl(source_dirs, p.gen_dir,
+                                  import_dirs=libs['source_dirs'])
+        if 'compile_native' in steps and platform.ndk_build:
+            platform.compile_native(p.project_dir)
+        if 'compile_java' in steps:
+            platform.compile_java(
+                source_dirs + [p.gen_dir], args['class_gen_dir'],
+                extra_jars=args['extra_jars'] + libs['class_jars'],
+                partitions=args['partitions'])
+        if 'dex' in steps and p.shrink:
+            # Like PlatformTarget.compile(), next to the class files.
+            shrunk = platform.shrink(
+                p.manifest, args['class_gen_dir'],
+                path.join(path.dirname(path.normpath(args['class_gen_dir'])),
+                          'classes-shrunk.jar'),
+                extra_jars=args['extra_jars'] + libs['class_jars'],
+                configs=args['proguard_config'], optimize=args['optimize'])
+            p.code = platform.dex(shrunk, output=args['dex_output'])
+        elif 'dex' in steps:
+            p.code = platform.dex(
+                args['class_gen_dir'], output=args['dex_output'],
+                extra_jars=args['extra_jars'] + libs['dex_jars'])
+        if 'dex' in steps and p.shrink_resources:
+            p._shrink_resources(platform, libraries)
+            # The resources to pack may have changed with the code.
+            steps = steps | set(['pack_resources'])
+        if 'pack_resources' in steps or not hasattr(self, '_resources'):
+            self._resources = platform.pack_resources(
+                **p._resource_args(None, None, None, None))
+        assets = platform.pack_assets(p.asset_dir, p.out_dir) \
+            if p._use_asset_pack() else None
+        apk = platform.build_apk(
+            resources=self._resources, assets=assets,
+            **p._apk_args(path.join(p.out_dir, '%s-daemon.apk' % p.name)))
+        if self.keystore:
+            apk.sign_and_align(*self.keystore)
+        return apk
+
+    def build(self, steps=None):
+        """Run a build, the full one unless ``steps`` are given, and
+        publish the result.
+        """
+        start = time.time()
+        self._number += 1
+        if steps is None or not hasattr(self.project, 'code'):
+            steps = set(['compile_renderscript', 'generate_r',
+                         'compile_aidl', 'compile_native', 'compile_java',
+                         'dex', 'pack_resources', 'build_apk'])
+        # Whatever did not succeed last time needs to be redone.
+        steps = set(steps) | self._failed_steps
+        log.info('Build #%d: %s' % (self._number, ', '.join(sorted(steps))))
+        report = BuildReport(self.project.name)
+        try:
+            with report.activate():
+                apk = self.run_steps(steps)
+        except ProgramFailedError as e:
+            log.error('Build #%d failed: %s' % (self._number, e))
+            output = e.stderr or e.stdout or b''
+            if isinstance(output, bytes):
+                output = output.decode('utf-8', 'replace')
+            error = '%s\n%s' % (e, output)
+        except Exception as e:
+            # Keep the daemon alive, whatever happens.
+            log.exception('Build #%d failed' % self._number)
+            error = '%s: %s' % (e.__class__.__name__, e)
+        else:
+            error = None
+        finally:
+            metrics.flush()
+        if error:
+            self._failed_steps = steps
+            result = BuildResult(self._number, error=error, steps=steps,
+                                 duration=time.time() - start)
+        else:
+            self._failed_steps = set()
+            self.project._finish_report(apk, report)
+            tmp = '%s.tmp' % self.output
+            shutil.copyfile(apk.filename, tmp)
+            os.rename(tmp, self.output)
+            result = BuildResult(self._number, apk=self.output, steps=steps,
+                                 duration=time.time() - start)
+            log.info('Build #%d done in %.1fs' % (
+                self._number, result.duration))
+        with self._condition:
+            self.last_result = result
+            self._condition.notify_all()
+        return result
+
+    def request_build(self, timeout=None):
+        """Wait until all changes made so far are built, and return the
+        ``BuildResult``. If nothing changed, that is the last result.
+
+        Raises ``BuildTimeout`` if that takes more than ``timeout``
+        seconds, by default an hour.
+        """
+        deadline = time.time() + (timeout or 3600)
+        with self._condition:
+            self._requests += 1
+            request = self._requests
+            while self._checked < request:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise BuildTimeout(
+                        'No build after %.0f seconds' % (timeout or 3600))
+                self._condition.wait(min(1, remaining))
+            return self.last_result
+
+    def _collect(self, changed):
+        # Wait until things have calmed down.
+        while True:
+            more = self.watcher.wait(self.debounce)
+            if not more:
+                return changed
+            changed |= more
+
+    def serve_forever(self):
+        """Do a full build, then keep rebuilding on changes.
+        """
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self._write_address()
+        try:
+            self.build()
+            while not self._stopped.is_set():
+                # Changes made before a request are queued up in the
+                # watcher, so are picked up during this round; later
+                # requests wait for the next one.
+                with self._condition:
+                    requested = self._requests
+                pending = requested > self._checked
+                changed = self.watcher.wait(0 if pending else 0.2)
+                if changed:
+                    steps = self.affected_steps(self._collect(changed))
+                    if steps:
+                        self.build(steps)
+                if pending:
+                    with self._condition:
+                        self._checked = requested
+                        self._condition.notify_all()
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+            self.watcher.close()
+            if path.exists(self._address_file()):
+                os.unlink(self._address_file())
+
+    def stop(self):
+        self._stopped.set()
+
+    def _address_file(self):
+        return path.join(self.project.out_dir, self.address_file)
+
+    def _write_address(self):
+        if not path.exists(self.project.out_dir):
+            os.makedirs(self.project.out_dir)
+        with open(self._address_file(), 'w') as f:
+            f.write('%s:%d' % self.address)
+
+
+def request_build(address, timeout=None):
+    """Ask the daemon at ``address`` for a build and wait for it.
+    ``address`` may also be the project's output directory, in which
+    case the address the daemon wrote there is used.
+
+    Returns a dict with the result: ``ok``, ``apk``, ``error``...
+    If the build took longer than ``timeout``, ``ok`` is false and
+    ``timeout`` true.
+    """
+    if not isinstance(address, tuple):
+        with open(path.join(address, BuildDaemon.address_file)) as f:
+            host, port = f.read().strip().rsplit(':', 1)
+        address = (host, int(port))
+    sock = socket.create_connection(address)
+    try:
+        request = {'command': 'build', 'timeout': timeout}
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        f = sock.makefile('rb')
+        return json.loads(f.readline().decode('utf-8'))
+    finally:
+        sock.close()
@@ -42,4 +42,4 @@ if exist %frameworkdir%%jarfile% goto JarFileOk
 
 set jarpath=%frameworkdir%%jarfile%
 
-call %java_exe% -classpath %jarpath% com.android.sdklib.build.ApkBuilderMain %*
+call %java_exe% %APKBUILDER_JAVA_OPTS% -classpath %jarpath% com.android.sdklib.build.ApkBuilderMain %*
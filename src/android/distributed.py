@@ -0,0 +1,532 @@
+"""
+Copyright (c) 2011 Michael Elsdoerfer <michael@elsdoerfer.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Build the variants of a project on multiple machines.
+
+The code is compiled once, on the coordinator. Then the compiled code
+and the inputs needed to package it (manifest, resources, assets, jars)
+are sent to each worker, once, after which the workers package as many
+variants as they are asked to, and send back the finished APK files.
+
+Every message is a 4-byte length, a JSON header of that length and,
+if the header contains a ``size`` key, that many bytes of payload.
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import shutil
+import socket
+import struct
+import tarfile
+import logging
+import tempfile
+import threading
+from os import path
+try:
+    from SocketServer import ThreadingTCPServer, BaseRequestHandler
+    from Queue import Queue, Empty
+except ImportError:
+    from socketserver import ThreadingTCPServer, BaseRequestHandler
+    from queue import Queue, Empty
+
+from .tools import ProgramFailedError
+from .cache import content_key
+from .plan import StepHistory
+
+
+__all__ = ('Coordinator', 'Worker')
+
+
+# Same logger as android.build, which imports us.
+log = logging.getLogger('py-androidbuild')
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _send(sock, header, filename=None):
+    """Send a message, with the content of ``filename`` as payload.
+    """
+    if filename:
+        header = dict(header, size=os.path.getsize(filename))
+    data = json.dumps(header).encode('utf-8')
+    sock.sendall(struct.pack('>I', len(data)) + data)
+    if filename:
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                sock.sendall(chunk)
+
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), CHUNK_SIZE))
+        if not chunk:
+            raise EOFError('Connection closed')
+        data += chunk
+    return data
+
+
+def _recv(sock, filename=None):
+    """Receive a message; the payload, if any, is written to
+    ``filename``.
+    """
+    size, = struct.unpack('>I', _recv_exactly(sock, 4))
+    header = json.loads(_recv_exactly(sock, size).decode('utf-8'))
+    remaining = header.get('size', 0)
+    if remaining:
+        if not filename:
+            raise ValueError('Unexpected payload')
+        with open(filename, 'wb') as f:
+            while remaining:
+                chunk = sock.recv(min(remaining, CHUNK_SIZE))
+                if not chunk:
+                    raise EOFError('Connection closed')
+                f.write(chunk)
+                remaining -= len(chunk)
+    return header
+
+
+def _text(s):
+    if isinstance(s, bytes):
+        return s.decode('utf-8', 'replace')
+    return s
+
+
+def variant_name(variant):
+    """Name a variant (a dict of ``AndroidProject.build`` arguments)
+    for the purpose of the build history.
+    """
+    if variant.get('output'):
+        return path.basename(variant['output'])
+    return ','.join('%s=%s' % (k, variant[k]) for k in sorted(variant))
+
+
+def _add_tree(tar, directory, arcname, exclude_ext=()):
+    for base, dirs, files in os.walk(directory):
+        for f in files:
+            if path.splitext(f)[1] in exclude_ext:
+                continue
+            filename = path.join(base, f)
+            tar.add(filename, path.join(
+                arcname, path.relpath(filename, directory)))
+
+
+def _settings(platform):
+    """The settings of ``platform`` which affect the APK, for a worker
+    to build the same one.
+    """
+    deflater = platform.deflater
+    return {'deterministic': platform.deterministic,
+            'deflater': deflater and {'level': deflater.level,
+                                      'store': sorted(deflater.store),
+                                      'probe': deflater.probe}}
+
+
+def create_bundle(project, filename):
+    """Pack everything a worker needs to build variants of ``project``
+    into the tar file ``filename``. Returns the content key.
+    """
+    jars = project.platform.jars.resolve(project.extra_jars)
+    settings = _settings(project.platform)
+    # The shrunk resources, as the worker has no class files to do it.
+    shrunk = project.shrunk_resource_dirs or []
+    dirs = [('shrunk/%d' % i, d) for i, d in enumerate(shrunk)]
+    dirs += [('project/res', project.resource_dir),
+             ('project/assets', project.asset_dir),
+             ('project/libs', project.lib_dir),
+             ('project/src', project.source_dir)]
+    # Of library projects, the code is already in classes.dex.
+    libraries = project._all_libraries()
+    for i, lib in enumerate(libraries):
+        dirs += [('libraries/%d/res' % i, lib.resource_dir),
+                 ('libraries/%d/libs' % i, lib.lib_dir),
+                 ('libraries/%d/src' % i, lib.source_dir)]
+    key = content_key(
+        'bundle', [project.code.filename, project.manifest] +
+                  [lib.manifest for lib in libraries] +
+                  [d for _, d in dirs] + jars,
+        name=project.name, platform=project.platform.version,
+        settings=json.dumps(settings, sort_keys=True))
+
+    with tarfile.open(filename, 'w:gz') as tar:
+        tar.add(project.code.filename, 'classes.dex')
+        tar.add(project.manifest, 'project/AndroidManifest.xml')
+        for i, lib in enumerate(libraries):
+            tar.add(lib.manifest, 'libraries/%d/AndroidManifest.xml' % i)
+        for name, directory in dirs:
+            if path.exists(directory):
+                # Only the Java resources are needed from src/.
+                _add_tree(tar, directory, name,
+                          exclude_ext=('.java', '.aidl', '.rs')
+                                      if name.endswith('/src') else ())
+        jar_names = []
+        for i, jar in enumerate(jars):
+            jar_names.append('jars/%d-%s' % (i, path.basename(jar)))
+            tar.add(jar, jar_names[-1])
+        meta = json.dumps(dict(settings, name=project.name, jars=jar_names,
+                               libraries=len(libraries),
+                               shrunk_resources=len(shrunk),
+                               platform=project.platform.version))
+        fd, meta_file = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write(meta)
+        tar.add(meta_file, 'bundle.json')
+        os.unlink(meta_file)
+    return key
+
+
+def _delete(filename):
+    if path.exists(filename):
+        os.unlink(filename)
+
+
+class _Progress(object):
+    """The number of variants of a build which are not done yet.
+    """
+
+    def __init__(self, count):
+        self.remaining = count
+        self._lock = threading.Lock()
+
+    def done(self):
+        with self._lock:
+            self.remaining -= 1
+
+
+class Coordinator(object):
+    """Distributes the variants of a project to a list of workers,
+    given as ``(host, port)`` tuples.
+
+    Variants are dicts of arguments to ``AndroidProject.build()``,
+    including ``output``, which is where the APK will be placed locally.
+    They are handed out longest-first, based on the durations in
+    ``history_file`` (see ``plan.StepHistory``; it may be the project's
+    own), with each worker picking up the next variant as soon as it
+    is done with the previous one. Variants never built before go
+    first.
+
+    If a worker cannot be reached or drops out, its variants are
+    picked up by the others.
+    """
+
+    def __init__(self, workers, history_file=None, timeout=600):
+        self.workers = workers
+        self.history = StepHistory(history_file)
+        self.timeout = timeout
+
+    def build(self, project, variants):
+        """Build all ``variants`` of ``project``; returns a list of
+        ``Apk`` objects, in the same order.
+        """
+        from .build import Apk
+
+        if not hasattr(project, 'code'):
+            project.compile()
+
+        fd, bundle = tempfile.mkstemp(suffix='.tar.gz')
+        os.close(fd)
+        try:
+            key = create_bundle(project, bundle)
+            log.info('Created bundle %s for %s' % (key, project.name))
+
+            queue = Queue()
+            estimates = [self.history.estimate(variant_name(v))
+                         for v in variants]
+            longest = max([e for e in estimates if e is not None] or [0])
+            order = sorted(
+                range(len(variants)), reverse=True,
+                key=lambda i: longest if estimates[i] is None
+                else estimates[i])
+            for i in order:
+                queue.put(i)
+            results = {}
+            errors = []
+            progress = _Progress(len(variants))
+
+            threads = [threading.Thread(
+                target=self._run_worker,
+                args=(worker, key, bundle, variants, queue, results, errors,
+                      progress))
+                for worker in self.workers]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            os.unlink(bundle)
+
+        if errors:
+            raise errors[0]
+        if len(results) != len(variants):
+            raise RuntimeError('No worker available to build %d variants' % (
+                len(variants) - len(results)))
+        return [Apk(project.platform, results[i])
+                for i in range(len(variants))]
+
+    def _run_worker(self, worker, key, bundle, variants, queue, results,
+                    errors, progress):
+        try:
+            sock = socket.create_connection(worker, self.timeout)
+        except socket.error as e:
+            log.warning('Cannot connect to worker %s:%s: %s' % (
+                worker[0], worker[1], e))
+            return
+
+        try:
+            _send(sock, {'op': 'has', 'key': key})
+            if not _recv(sock)['present']:
+                log.info('Sending bundle to %s:%s' % worker)
+                _send(sock, {'op': 'upload', 'key': key}, bundle)
+                _recv(sock)
+
+            while not errors:
+                try:
+                    i = queue.get(timeout=1)
+                except Empty:
+                    # A variant may still come back from a worker that
+                    # drops out.
+                    if progress.remaining:
+                        continue
+                    break
+                variant = variants[i]
+                output = path.abspath(variant['output'])
+                options = dict((k, v) for k, v in variant.items()
+                               if k != 'output')
+                try:
+                    _send(sock, {'op': 'build', 'key': key,
+                                 'variant': options})
+                    response = _recv(sock, '%s.part' % output)
+                except (socket.error, EOFError):
+                    _delete('%s.part' % output)
+                    # Let another worker do it.
+                    queue.put(i)
+                    raise
+
+                if not response['ok']:
+                    _delete('%s.part' % output)
+                    if 'cmdline' in response:
+                        errors.append(ProgramFailedError(
+                            response['cmdline'], response['returncode'],
+                            response['stdout'], response['stderr']))
+                    else:
+                        errors.append(RuntimeError('%s:%s: %s' % (
+                            worker[0], worker[1], response['error'])))
+                    break
+                os.rename('%s.part' % output, output)
+                results[i] = output
+                progress.done()
+                self.history.record(
+                    variant_name(variant), response['duration'])
+                log.info('%s:%s built %s in %.1fs' % (
+                    worker[0], worker[1], output, response['duration']))
+        except (socket.error, EOFError) as e:
+            log.warning('Lost worker %s:%s: %s' % (worker[0], worker[1], e))
+        finally:
+            sock.close()
+
+
+class _WorkerHandler(BaseRequestHandler):
+
+    def handle(self):
+        worker = self.server.worker
+        upload = path.join(worker.directory, 'upload-%d.part' % id(self))
+        while True:
+            try:
+                request = _recv(self.request, upload)
+            except (EOFError, socket.error):
+                return
+            try:
+                response, filename = worker.handle(request, upload)
+            except Exception as e:
+                log.exception('Failed to handle %s' % request)
+                response, filename = {'ok': False, 'error': str(e)}, None
+            _send(self.request, response, filename)
+            if filename:
+                os.unlink(filename)
+
+
+class Worker(object):
+    """Builds variants on behalf of a ``Coordinator``.
+
+    Uses the Android SDK in ``sdk_dir``; the platform is chosen to
+    match the one used by the coordinator. Bundles are kept in
+    ``directory`` for as long as the worker runs, as is the output
+    directory of each project, so that what is up-to-date there, like
+    the resources variants are derived from, is not built again.
+
+    Workers do not authenticate coordinators; only listen on an
+    address other than the default ``host`` in a trusted network.
+    """
+
+    def __init__(self, sdk_dir, host='127.0.0.1', port=0, directory=None,
+                 ndk_dir=None):
+        self.sdk_dir = sdk_dir
+        self.ndk_dir = ndk_dir
+        self.directory = directory or tempfile.mkdtemp(prefix='androidbuild-')
+        self.server = ThreadingTCPServer((host, port), _WorkerHandler,
+                                         bind_and_activate=False)
+        self.server.allow_reuse_address = True
+        self.server.daemon_threads = True
+        self.server.server_bind()
+        self.server.server_activate()
+        self.server.worker = self
+        self.address = self.server.server_address[:2]
+        self._platforms = {}
+        self._projects = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '%s <%s:%s>' % (self.__class__.__name__,
+                               self.address[0], self.address[1])
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def start(self):
+        """Serve in a background thread.
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_platform(self, target):
+        from .build import get_platform
+        with self._lock:
+            if target not in self._platforms:
+                self._platforms[target] = get_platform(
+                    self.sdk_dir, self.ndk_dir, target)
+            return self._platforms[target]
+
+    def _project_dir(self, name):
+        """Return the output directory for the project ``name``, and
+        the lock to hold while building in it.
+        """
+        with self._lock:
+            if name not in self._projects:
+                self._projects[name] = (tempfile.mkdtemp(
+                    prefix='out-', dir=self.directory), threading.Lock())
+            return self._projects[name]
+
+    def handle(self, request, upload):
+        """Process a request, with the payload stored in ``upload``;
+        returns the response header, and the filename of the payload
+        to send back, if any.
+        """
+        key = request.get('key') or ''
+        # Keys are hex digests; refuse anything that could escape the
+        # bundle directory.
+        if not key or not all(c in '0123456789abcdef' for c in key):
+            raise ValueError('Invalid key')
+        bundle_dir = path.join(self.directory, key)
+        if request['op'] == 'has':
+            return {'ok': True, 'present': path.exists(bundle_dir)}, None
+        elif request['op'] == 'upload':
+            self._extract(upload, bundle_dir)
+            return {'ok': True}, None
+        elif request['op'] == 'build':
+            return self._build(bundle_dir, request['variant'])
+        raise ValueError('Unknown operation: %s' % request['op'])
+
+    def _extract(self, filename, target):
+        with tarfile.open(filename) as tar:
+            for member in tar.getmembers():
+                if member.name.startswith('/') or '..' in member.name.split('/'):
+                    raise ValueError('Invalid bundle entry: %s' % member.name)
+                # No links or devices, which could point outside.
+                if not (member.isfile() or member.isdir()):
+                    raise ValueError('Invalid bundle entry: %s' % member.name)
+            tmp = tempfile.mkdtemp(dir=self.directory)
+            tar.extractall(tmp)
+        os.unlink(filename)
+        if path.exists(target):
+            # Some other connection was faster.
+            shutil.rmtree(tmp)
+        else:
+            os.rename(tmp, target)
+
+    def _build(self, bundle_dir, variant):
+        from .build import AndroidProject, LibraryProject, CodeObj
+        from .packaging import Deflater
+
+        with open(path.join(bundle_dir, 'bundle.json')) as f:
+            meta = json.load(f)
+        # The settings are those of the coordinator; the platform is
+        # shared by all of them.
+        platform = copy.copy(self.get_platform(meta['platform']))
+        platform.deterministic = meta.get('deterministic', False)
+        if meta.get('deflater'):
+            options = meta['deflater']
+            platform.deflater = Deflater(
+                level=options['level'], store=tuple(options['store']),
+                probe=options['probe'],
+                cache_dir=path.join(self.directory, 'deflated'))
+        project = AndroidProject(
+            path.join(bundle_dir, 'project', 'AndroidManifest.xml'),
+            name=meta['name'], platform=platform)
+        project.code = CodeObj(path.join(bundle_dir, 'classes.dex'))
+        project.extra_jars = [path.join(bundle_dir, j) for j in meta['jars']]
+        project.libraries = [
+            LibraryProject(path.join(bundle_dir, 'libraries', str(i)),
+                           libraries=[])
+            for i in range(meta.get('libraries', 0))]
+        project.shrunk_resource_dirs = [
+            path.join(bundle_dir, 'shrunk', str(i))
+            for i in range(meta.get('shrunk_resources', 0))] or None
+        project.out_dir, lock = self._project_dir(meta['name'])
+        fd, result = tempfile.mkstemp(dir=self.directory)
+        os.close(fd)
+        start = time.time()
+        # Variants may be requested concurrently by different
+        # coordinators, and share intermediate files.
+        with lock:
+            try:
+                project.build(result, **dict(
+                    (str(k), v) for k, v in variant.items()))
+            except ProgramFailedError as e:
+                os.unlink(result)
+                return {'ok': False, 'cmdline': _text(e.cmdline),
+                        'returncode': e.returncode,
+                        'stdout': _text(e.stdout),
+                        'stderr': _text(e.stderr)}, None
+            except Exception:
+                os.unlink(result)
+                raise
+        return {'ok': True, 'duration': time.time() - start}, result
+
+
+def main(argv):
+    if len(argv) not in (1, 2, 3):
+        print("Usage: python -m android.distributed SDK_DIR [PORT [HOST]]")
+        return 1
+    worker = Worker(argv[0], host=argv[2] if len(argv) > 2 else '127.0.0.1',
+                    port=int(argv[1]) if len(argv) > 1 else 7410)
+    print("Worker listening on %s:%s" % worker.address)
+    try:
+        worker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]) or 0)
@@ -0,0 +1,163 @@
+"""
+Copyright (c) 2011 Michael Elsdoerfer <michael@elsdoerfer.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Working out the set of jars a project is compiled against.
+
+Projects commonly end up with the same jar more than once, say a support
+library in both ``libs/`` of the app and of a library project. Passed
+twice, ``javac`` does the work twice, and ``dx`` fails with a duplicate
+class error at the very end. The catalog here identifies jars by their
+content, uses each only once, and checks that no class is defined by
+two different jars before any tool runs.
+"""
+
+import os
+import logging
+import threading
+import zipfile
+from os import path
+
+from .cache import file_digest
+
+
+__all__ = ('JarCatalog', 'JarConflictError', 'catalog')
+
+
+# Same logger as android.build.
+log = logging.getLogger('py-androidbuild')
+
+
+class JarConflictError(ValueError):
+    """Two different jars contain the same class.
+    """
+
+    def __init__(self, classname, jars, identical):
+        self.classname = classname
+        self.jars = jars
+        self.identical = identical
+        ValueError.__init__(self, 'Class %s is in both %s and %s (%s)' % (
+            classname, jars[0], jars[1],
+            'identical' if identical else 'different versions'))
+
+
+class JarInfo(object):
+    """The content hash of a jar, and the CRCs of the classes in it,
+    by class name.
+    """
+
+    def __init__(self, filename, digest, classes):
+        self.filename = filename
+        self.digest = digest
+        self.classes = classes
+
+    def __repr__(self):
+        return '%s <%s>' % (self.__class__.__name__, self.filename)
+
+
+def _read_classes(filename):
+    try:
+        with zipfile.ZipFile(filename) as archive:
+            infos = archive.infolist()
+    except (zipfile.BadZipfile, IOError):
+        # Leave it to the tools to complain.
+        return {}
+    classes = {}
+    for info in infos:
+        name = info.filename
+        if not name.endswith('.class') or name.startswith('META-INF/') \
+                or name.endswith('module-info.class'):
+            continue
+        classes[name[:-len('.class')].replace('/', '.')] = info.CRC
+    return classes
+
+
+class JarCatalog(object):
+    """Knows the content of the jars it was asked about; a jar is only
+    read again once its size or modification time changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jars = {}
+
+    def get(self, filename):
+        """Return a ``JarInfo`` for ``filename``, or ``None`` if it
+        does not exist.
+        """
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        key = (stat.st_size, stat.st_mtime)
+        with self._lock:
+            cached = self._jars.get(filename)
+        if cached and cached[0] == key:
+            return cached[1]
+        info = JarInfo(filename, file_digest(filename),
+                       _read_classes(filename))
+        with self._lock:
+            self._jars[filename] = (key, info)
+        return info
+
+    def expand(self, paths):
+        """The jar files in ``paths``, which may include directories to
+        be searched recursively.
+        """
+        jar_files = []
+        for item in paths:
+            if path.isdir(item):
+                found = []
+                for base, dirs, files in os.walk(item):
+                    found += [path.join(base, f) for f in files
+                              if f.endswith('.jar')]
+                # Sorted, as the file system order may vary.
+                jar_files += sorted(found)
+            else:
+                jar_files.append(item)
+        return jar_files
+
+    def resolve(self, paths):
+        """Return the jars in ``paths`` (see ``expand()``), each with a
+        different content, in the order given.
+
+        Raises ``JarConflictError`` if a class is in more than one of
+        them.
+        """
+        result = []
+        digests = {}
+        index = {}
+        for filename in self.expand(paths):
+            info = self.get(filename)
+            if info is None:
+                result.append(filename)
+                continue
+            if info.digest in digests:
+                log.info('Skipping %s, same as %s' % (
+                    filename, digests[info.digest]))
+                continue
+            for name, crc in sorted(info.classes.items()):
+                if name in index:
+                    other = index[name]
+                    raise JarConflictError(
+                        name, [other.filename, filename],
+                        other.classes[name] == crc)
+                index[name] = info
+            digests[info.digest] = filename
+            result.append(filename)
+        return result
+
+
+# Shared by all platforms in the process.
+catalog = JarCatalog()
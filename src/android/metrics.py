@@ -0,0 +1,239 @@
+"""
+Copyright (c) 2011 Michael Elsdoerfer <michael@elsdoerfer.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Counters and histograms about the build, sent to a pluggable sink.
+
+The following metrics are emitted:
+
+    step_duration_seconds{step,result}  histogram, result is ok or failed
+    tool_duration_seconds{tool}         histogram
+    tool_queue_wait_seconds{tool}       histogram
+    tool_failures_total{tool}           counter
+    cache_requests_total{step,result}   counter, result is hit or miss
+    apk_size_bytes                      histogram
+
+Nothing is sent anywhere until you call ``set_sink()``.
+"""
+
+import os
+import socket
+import logging
+import tempfile
+import threading
+from os import path
+
+
+__all__ = ('MetricsSink', 'PrometheusTextFile', 'StatsdSink', 'MultiSink',
+           'set_sink', 'get_sink')
+
+
+# Same logger as android.build, which imports us.
+log = logging.getLogger('py-androidbuild')
+
+
+class MetricsSink(object):
+    """Base class for sinks; also the default, which discards
+    everything.
+
+    ``tags`` is a dict of label names and values.
+    """
+
+    def increment(self, name, value=1, tags=None):
+        pass
+
+    def observe(self, name, value, tags=None):
+        pass
+
+    def flush(self):
+        pass
+
+
+def _tag_key(tags):
+    return tuple(sorted((tags or {}).items()))
+
+
+class PrometheusTextFile(MetricsSink):
+    """Writes all metrics in the Prometheus text format to ``filename``
+    on every ``flush()``; meant for the node exporter's textfile
+    collector.
+    """
+
+    time_buckets = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+    size_buckets = (1e5, 1e6, 5e6, 1e7, 2.5e7, 5e7, 1e8, 2.5e8)
+
+    def __init__(self, filename, prefix='androidbuild_'):
+        self.filename = filename
+        self.prefix = prefix
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '%s <%s>' % (self.__class__.__name__, self.filename)
+
+    def _buckets(self, name):
+        return self.size_buckets if name.endswith('_bytes') \
+            else self.time_buckets
+
+    def increment(self, name, value=1, tags=None):
+        key = (name, _tag_key(tags))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, tags=None):
+        key = (name, _tag_key(tags))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = {
+                    'buckets': [0] * len(self._buckets(name)),
+                    'sum': 0, 'count': 0}
+            histogram = self.histograms[key]
+            for i, bound in enumerate(self._buckets(name)):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def _labels(self, tags, **extra):
+        items = list(tags) + sorted(extra.items())
+        if not items:
+            return ''
+        return '{%s}' % ','.join(
+            '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in items)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name in sorted(set(n for n, _ in self.counters)):
+                lines.append('# TYPE %s%s counter' % (self.prefix, name))
+                for (n, tags), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append('%s%s%s %s' % (
+                            self.prefix, name, self._labels(tags), value))
+            for name in sorted(set(n for n, _ in self.histograms)):
+                lines.append('# TYPE %s%s histogram' % (self.prefix, name))
+                for (n, tags), h in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    full = self.prefix + name
+                    for bound, count in zip(self._buckets(name),
+                                            h['buckets']):
+                        lines.append('%s_bucket%s %s' % (
+                            full, self._labels(tags, le=repr(float(bound))),
+                            count))
+                    lines.append('%s_bucket%s %s' % (
+                        full, self._labels(tags, le='+Inf'), h['count']))
+                    lines.append('%s_sum%s %s' % (
+                        full, self._labels(tags), h['sum']))
+                    lines.append('%s_count%s %s' % (
+                        full, self._labels(tags), h['count']))
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        # Write atomically, so the collector never sees a partial file.
+        fd, tmp = tempfile.mkstemp(
+            dir=path.dirname(path.abspath(self.filename)))
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.render())
+        # mkstemp() makes it private; the collector may run as another
+        # user.
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, self.filename)
+
+
+class StatsdSink(MetricsSink):
+    """Sends metrics over UDP to a StatsD daemon.
+
+    StatsD has no labels, so the tag values are appended to the metric
+    name: ``androidbuild.step_duration_seconds.ok.dex``. Durations are sent
+    as timers, in milliseconds.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='androidbuild.'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __repr__(self):
+        return '%s <%s:%s>' % (self.__class__.__name__,
+                               self.address[0], self.address[1])
+
+    def _name(self, name, tags):
+        parts = [self.prefix + name] + [
+            str(v).replace('.', '_').replace(':', '_')
+            for _, v in _tag_key(tags)]
+        return '.'.join(parts)
+
+    def _send(self, data):
+        try:
+            self.socket.sendto(data.encode('utf-8'), self.address)
+        except socket.error as e:
+            log.debug('Failed to send metric: %s' % e)
+
+    def increment(self, name, value=1, tags=None):
+        self._send('%s:%s|c' % (self._name(name, tags), value))
+
+    def observe(self, name, value, tags=None):
+        if name.endswith('_seconds'):
+            self._send('%s:%d|ms' % (self._name(name, tags), value * 1000))
+        else:
+            self._send('%s:%s|h' % (self._name(name, tags), value))
+
+
+class MultiSink(MetricsSink):
+    """Sends metrics to multiple sinks.
+    """
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def increment(self, *a, **kw):
+        for sink in self.sinks:
+            sink.increment(*a, **kw)
+
+    def observe(self, *a, **kw):
+        for sink in self.sinks:
+            sink.observe(*a, **kw)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+
+_sink = MetricsSink()
+
+
+def set_sink(sink):
+    """Send all metrics of this process to ``sink``.
+    """
+    global _sink
+    _sink = sink or MetricsSink()
+
+
+def get_sink():
+    return _sink
+
+
+def increment(name, value=1, tags=None):
+    _sink.increment(name, value, tags)
+
+
+def observe(name, value, tags=None):
+    _sink.observe(name, value, tags)
+
+
+def flush():
+    _sink.flush()
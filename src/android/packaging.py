@@ -0,0 +1,391 @@
+"""
+Copyright (c) 2011 Michael Elsdoerfer <michael@elsdoerfer.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Assembles APK files in Python, as a replacement for ``apkbuilder``.
+
+The entries are compressed by a ``Deflater``, concurrently on all CPUs
+(zlib does not hold the GIL while compressing). Files which do not
+compress well, such as images and audio, are stored as they are.
+Entries which are already compressed in one of the input archives are
+copied without being decompressed.
+"""
+
+import os
+import time
+import zlib
+import hashlib
+import logging
+import tempfile
+from os import path
+
+from .apkzip import ApkReader, ApkWriter, ZipEntry, STORED, DEFLATED
+from .cache import run_concurrently
+from .tools import _cpu_count
+
+
+__all__ = ('Deflater', 'build_apk', 'build_asset_pack', 'asset_fingerprint',
+           'NO_COMPRESS_EXTENSIONS')
+
+
+# Same logger as android.build.
+log = logging.getLogger('py-androidbuild')
+
+
+# The list aapt uses, plus a few more archive and media formats.
+# resources.arsc is memory-mapped by Android, and must be stored.
+NO_COMPRESS_EXTENSIONS = (
+    '.arsc',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.wav', '.mp2', '.mp3',
+    '.ogg', '.aac', '.mpg', '.mpeg', '.mid', '.midi', '.smf', '.jet',
+    '.rtttl', '.imy', '.xmf', '.mp4', '.m4a', '.m4v', '.3gp', '.3gpp',
+    '.3g2', '.3gpp2', '.amr', '.awb', '.wma', '.wmv', '.webm', '.mkv',
+    '.zip', '.jar', '.apk', '.gz', '.bz2', '.xz', '.7z')
+
+
+class Deflater(object):
+    """Compresses APK entries, using ``workers`` threads.
+
+    Entries are stored uncompressed if their extension is in ``store``,
+    or, with ``probe`` enabled, if compressing a sample of their data
+    does not save at least 5%.
+
+    If ``cache_dir`` is given, compressed data is kept there, keyed by
+    the content, and reused by later builds.
+    """
+
+    probe_size = 64 * 1024
+    # Smaller entries are faster to compress than to look up.
+    min_cache_size = 16 * 1024
+
+    def __init__(self, workers=None, level=9, store=NO_COMPRESS_EXTENSIONS,
+                 probe=True, cache_dir=None):
+        self.workers = workers or _cpu_count()
+        self.level = level
+        self.store = store
+        self.probe = probe
+        self.cache_dir = cache_dir
+
+    def __repr__(self):
+        return '%s <%d workers, level %d>' % (
+            self.__class__.__name__, self.workers, self.level)
+
+    def stores_extension(self, name):
+        return path.splitext(name)[1].lower() in self.store
+
+    def should_store(self, name, data):
+        """Whether the entry ``name`` with ``data`` should not be
+        compressed.
+        """
+        if not data or self.stores_extension(name):
+            return True
+        if self.probe and len(data) > 4096:
+            sample = data[:self.probe_size]
+            return len(zlib.compress(sample, 1)) > len(sample) * 0.95
+        return False
+
+    def _cache_file(self, data):
+        digest = hashlib.sha1(data).hexdigest()
+        return path.join(self.cache_dir, digest[:2],
+                         '%s-%d.z' % (digest, self.level))
+
+    def _deflate(self, data):
+        use_cache = self.cache_dir and len(data) >= self.min_cache_size
+        if use_cache:
+            filename = self._cache_file(data)
+            try:
+                with open(filename, 'rb') as f:
+                    return f.read()
+            except IOError:
+                pass
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        blob = compressor.compress(data) + compressor.flush()
+        if use_cache:
+            directory = path.dirname(filename)
+            if not path.exists(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # Another thread was faster.
+                    pass
+            fd, tmp = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(blob)
+            os.rename(tmp, filename)
+        return blob
+
+    def compress(self, name, data, date_time=(1980, 1, 1, 0, 0, 0)):
+        """Return a ``ZipEntry`` for ``data``, and the data to write.
+        """
+        entry = ZipEntry(name, STORED, zlib.crc32(data), len(data),
+                         len(data), date_time)
+        if self.should_store(name, data):
+            return entry, data
+        blob = self._deflate(data)
+        if len(blob) >= len(data):
+            return entry, data
+        entry.method = DEFLATED
+        entry.compress_size = len(blob)
+        return entry, blob
+
+    def settings(self):
+        """What, besides the data, determines the output.
+        """
+        return (self.level, sorted(self.store), self.probe)
+
+    def compress_all(self, items):
+        """Compress ``(name, data, date_time)`` tuples concurrently.
+        Returns the results of ``compress()``, in order.
+        """
+        return run_concurrently(
+            lambda item: self.compress(*item), items, self.workers)
+
+
+# What apkbuilder does not package from source folders and jars.
+_IGNORED_FOLDERS = ('cvs', '.svn', 'sccs', 'meta-inf')
+_IGNORED_EXTENSIONS = ('.aidl', '.rs', '.rsh', '.d', '.java', '.scala',
+                       '.class', '.scc', '.swp')
+_IGNORED_FILES = ('thumbs.db', 'picasa.ini', 'package.html',
+                  'overview.html')
+
+
+def is_java_resource(name):
+    """Whether ``name``, a path relative to a source folder or inside
+    a jar, is packaged as a Java resource.
+    """
+    parts = name.replace(os.sep, '/').split('/')
+    for folder in parts[:-1]:
+        if folder.lower() in _IGNORED_FOLDERS or folder.startswith('_'):
+            return False
+    filename = parts[-1]
+    return not (
+        not filename or filename.startswith('.') or filename.endswith('~')
+        or path.splitext(filename)[1].lower() in _IGNORED_EXTENSIONS
+        or filename.lower() in _IGNORED_FILES)
+
+
+def is_asset(name):
+    """Whether ``name``, relative to the asset folder, is packaged;
+    follows the default ignore pattern of ``aapt``.
+    """
+    parts = name.replace(os.sep, '/').split('/')
+    for folder in parts[:-1]:
+        if folder.startswith(('.', '_')) or folder.lower() == 'cvs':
+            return False
+    filename = parts[-1].lower()
+    return not (filename.startswith('.') or filename.endswith(('~', '.scc'))
+                or filename in ('cvs', 'thumbs.db', 'picasa.ini'))
+
+
+def _asset_files(asset_dir):
+    for base, dirs, files in os.walk(asset_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            full = path.join(base, filename)
+            name = path.relpath(full, asset_dir).replace(os.sep, '/')
+            if is_asset(name):
+                yield name, full
+
+
+def asset_fingerprint(asset_dir, deflater):
+    """Identifies the state of ``asset_dir``, by the names, sizes and
+    modification times of the files, without reading them.
+    """
+    hash = hashlib.sha1(repr(deflater.settings()).encode('utf-8'))
+    for name, filename in _asset_files(asset_dir):
+        stat = os.stat(filename)
+        hash.update(('%s\0%d\0%r\0' % (
+            name, stat.st_size, stat.st_mtime)).encode('utf-8'))
+    return hash.hexdigest()
+
+
+def _source_files(source_dir):
+    for base, dirs, files in os.walk(source_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            full = path.join(base, filename)
+            name = path.relpath(full, source_dir).replace(os.sep, '/')
+            if is_java_resource(name):
+                yield name, full
+
+
+def _jar_files(jar_paths):
+    for item in jar_paths:
+        if path.isdir(item):
+            for filename in sorted(os.listdir(item)):
+                if filename.endswith('.jar'):
+                    yield path.join(item, filename)
+        else:
+            yield item
+
+
+def _native_files(native_dir):
+    for abi in sorted(os.listdir(native_dir)):
+        abi_dir = path.join(native_dir, abi)
+        if not path.isdir(abi_dir):
+            continue
+        for filename in sorted(os.listdir(abi_dir)):
+            if filename.endswith('.so'):
+                yield 'lib/%s/%s' % (abi, filename), \
+                    path.join(abi_dir, filename)
+
+
+def _file_time(filename):
+    return time.localtime(os.stat(filename).st_mtime)[:6]
+
+
+class _Packer(object):
+    """Writes entries in batches: within a batch, entries which need to
+    be compressed are compressed concurrently; then all of them are
+    written, in order.
+    """
+
+    batch_size = 32 * 1024 * 1024
+
+    def __init__(self, writer, deflater):
+        self.writer = writer
+        self.deflater = deflater
+        self.names = set()
+        self.batch = []
+        self.batch_bytes = 0
+
+    def _check(self, name):
+        if name in self.names:
+            raise ValueError('Duplicate entry in APK: %s' % name)
+        self.names.add(name)
+
+    def add_raw(self, reader, entry, as_is=False):
+        """Copy ``entry`` from ``reader``, unless it is stored but should
+        be compressed. With ``as_is``, it is always copied.
+        """
+        if not as_is and entry.method == STORED and entry.file_size and \
+                not self.deflater.stores_extension(entry.name):
+            self.add(entry.name, reader.read(entry), entry.date_time)
+            return
+        self._check(entry.name)
+        self.batch.append((reader, entry))
+
+    def add(self, name, data, date_time=(1980, 1, 1, 0, 0, 0)):
+        self._check(name)
+        self.batch.append((name, data, date_time))
+        self.batch_bytes += len(data)
+        if self.batch_bytes >= self.batch_size:
+            self.flush()
+
+    def add_file(self, name, filename):
+        with open(filename, 'rb') as f:
+            self.add(name, f.read(), _file_time(filename))
+
+    def flush(self):
+        pending = [item for item in self.batch if len(item) == 3]
+        compressed = iter(self.deflater.compress_all(pending))
+        for item in self.batch:
+            if len(item) == 2:
+                reader, entry = item
+                self.writer.write_raw(entry, reader.raw_chunks(entry))
+            else:
+                entry, data = next(compressed)
+                self.writer.write_raw(entry, [data])
+        self.batch = []
+        self.batch_bytes = 0
+
+
+def _temp_file(filename):
+    """Create a file next to ``filename``, to be renamed to it once it
+    is complete; returns the file descriptor and name, as ``mkstemp``.
+    """
+    fd, tmp = tempfile.mkstemp(dir=path.dirname(path.abspath(filename)),
+                               prefix='%s.' % path.basename(filename),
+                               suffix='.tmp')
+    # Rather than private, as mkstemp() makes it.
+    os.chmod(tmp, 0o644)
+    return fd, tmp
+
+
+def build_apk(outputfile, dex=None, zips=[], source_dirs=[], jar_paths=[],
+              native_dirs=[], deflater=None, packed=[], date_time=None):
+    """Build an unsigned APK, with the same arguments as the
+    ``ApkBuilder`` tool.
+
+    The entries of the archives in ``packed``, made by
+    ``build_asset_pack()`` for example, are copied as they are.
+
+    The order of the entries only depends on the input. If ``date_time``
+    is given, it is used for all of them, instead of the modification
+    times of the files; see ``ApkWriter``.
+    """
+    deflater = deflater or Deflater()
+    fd, tmp = _temp_file(outputfile)
+    readers = []
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            writer = ApkWriter(f, date_time=date_time)
+            packer = _Packer(writer, deflater)
+            for zip in zips:
+                reader = ApkReader(zip)
+                readers.append(reader)
+                for entry in reader.entries:
+                    packer.add_raw(reader, entry)
+            for zip in packed:
+                reader = ApkReader(zip)
+                readers.append(reader)
+                for entry in reader.entries:
+                    packer.add_raw(reader, entry, as_is=True)
+            if dex:
+                packer.add_file('classes.dex', dex)
+            for source_dir in source_dirs:
+                for name, filename in _source_files(source_dir):
+                    packer.add_file(name, filename)
+            for jar in _jar_files(jar_paths):
+                reader = ApkReader(jar)
+                readers.append(reader)
+                for entry in reader.entries:
+                    if not entry.is_dir and is_java_resource(entry.name):
+                        packer.add_raw(reader, entry)
+            for native_dir in native_dirs:
+                for name, filename in _native_files(native_dir):
+                    packer.add_file(name, filename)
+            packer.flush()
+            writer.close()
+        os.rename(tmp, outputfile)
+    finally:
+        for reader in readers:
+            reader.close()
+        if path.exists(tmp):
+            os.unlink(tmp)
+    log.info('Packaged %d entries into %s' % (
+        len(writer.entries), outputfile))
+    return outputfile
+
+
+def build_asset_pack(asset_dir, outputfile, deflater=None, date_time=None):
+    """Write the files in ``asset_dir`` to a zip archive, compressed
+    by ``deflater``, as entries below ``assets/``.
+    """
+    deflater = deflater or Deflater()
+    fd, tmp = _temp_file(outputfile)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            writer = ApkWriter(f, date_time=date_time)
+            packer = _Packer(writer, deflater)
+            for name, filename in _asset_files(asset_dir):
+                packer.add_file('assets/%s' % name, filename)
+            packer.flush()
+            writer.close()
+        os.rename(tmp, outputfile)
+    finally:
+        if path.exists(tmp):
+            os.unlink(tmp)
+    log.info('Packed %d assets into %s' % (len(writer.entries), outputfile))
+    return outputfile
@@ -0,0 +1,194 @@
+"""
+Copyright (c) 2011 Michael Elsdoerfer <michael@elsdoerfer.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+What a build would do, and how long it would take.
+
+``AndroidProject.plan()`` works out which steps of a build would run,
+and which would find their output up-to-date, without running any of
+them. The duration of each step is estimated from the reports of
+earlier builds, as appended to ``AndroidProject.history_file``; see
+``StepHistory``.
+"""
+
+import json
+import threading
+from collections import deque
+
+
+__all__ = ('StepHistory', 'PlannedStep', 'BuildPlan')
+
+
+class StepHistory(object):
+    """The durations of the build steps in the JSON lines file
+    ``filename``, which holds a ``BuildReport`` per line.
+
+    Only the last ``limit`` runs of each step are considered, and
+    those which did no work because their output was up-to-date are
+    left out. Steps within other steps are accounted for by the outer
+    step.
+
+    Other durations, like those of the variants built by a
+    ``distributed.Coordinator``, can be kept in the same way with
+    ``record()``.
+    """
+
+    def __init__(self, filename=None, limit=20):
+        self.filename = filename
+        self.limit = limit
+        self.durations = {}
+        self._lock = threading.Lock()
+        if filename:
+            self.read(filename, limit)
+
+    def __repr__(self):
+        return '%s <%s>' % (self.__class__.__name__, self.filename)
+
+    def read(self, filename, limit=20):
+        try:
+            f = open(filename)
+        except IOError:
+            return
+        with f:
+            for line in f:
+                try:
+                    report = json.loads(line)
+                except ValueError:
+                    # Say, a line cut short by a build that was killed.
+                    continue
+                for step in report.get('steps', []):
+                    if step.get('parent') or step.get('up_to_date') or \
+                            step.get('wall') is None:
+                        continue
+                    self.durations.setdefault(
+                        step['name'], deque(maxlen=limit)).append(
+                            step['wall'])
+
+    def record(self, name, wall):
+        """Add a run of ``name`` which took ``wall`` seconds; it is
+        appended to ``filename``, if any, as a report of its own.
+        """
+        with self._lock:
+            self.durations.setdefault(
+                name, deque(maxlen=self.limit)).append(wall)
+            if self.filename:
+                with open(self.filename, 'a') as f:
+                    f.write(json.dumps(
+                        {'name': name, 'wall': wall,
+                         'steps': [{'name': name, 'wall': wall}]},
+                        sort_keys=True) + '\n')
+
+    def estimate(self, name):
+        """Return the median duration of the step ``name`` in seconds,
+        or ``None`` if it never ran.
+        """
+        durations = sorted(self.durations.get(name, []))
+        if not durations:
+            return None
+        middle = len(durations) // 2
+        if len(durations) % 2:
+            return durations[middle]
+        return (durations[middle - 1] + durations[middle]) / 2.0
+
+
+class PlannedStep(object):
+    """A step of a ``BuildPlan``: whether it would ``run`` on ``target``
+    and why not, or why, and its ``estimate`` in seconds (``None`` if
+    unknown).
+    """
+
+    fields = ('name', 'target', 'run', 'reason', 'estimate')
+
+    def __init__(self, name, target, run, reason, estimate=None):
+        self.name = name
+        self.target = target
+        self.run = run
+        self.reason = reason
+        self.estimate = estimate
+
+    def __repr__(self):
+        return '%s <%s %s>' % (
+            self.__class__.__name__, self.name,
+            'run' if self.run else 'skip')
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.fields)
+
+
+class BuildPlan(object):
+    """The steps a build would run, in order, with their estimated
+    durations taken from ``history`` (a ``StepHistory``).
+    """
+
+    def __init__(self, name=None, history=None):
+        self.name = name
+        self.history = history or StepHistory()
+        self.steps = []
+
+    def __repr__(self):
+        return '%s <%s, %d of %d steps>' % (
+            self.__class__.__name__, self.name, len(self.to_run),
+            len(self.steps))
+
+    def add(self, name, target, run, reason):
+        step = PlannedStep(name, target, run, reason,
+                           self.history.estimate(name) if run else 0)
+        self.steps.append(step)
+        return step
+
+    @property
+    def to_run(self):
+        return [s for s in self.steps if s.run]
+
+    @property
+    def unknown(self):
+        """The steps to run for which there is no estimate."""
+        return [s for s in self.to_run if s.estimate is None]
+
+    @property
+    def estimate(self):
+        """The estimated duration of the build in seconds, not counting
+        the ``unknown`` steps.
+        """
+        return sum(s.estimate for s in self.to_run
+                   if s.estimate is not None)
+
+    def as_dict(self):
+        return {'name': self.name, 'estimate': self.estimate,
+                'unknown': len(self.unknown),
+                'steps': [s.as_dict() for s in self.steps]}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.as_dict(), **kwargs)
+
+    def format(self):
+        """Return the plan as a table, for humans.
+        """
+        lines = []
+        for s in self.steps:
+            if not s.run:
+                duration = '-'
+            elif s.estimate is None:
+                duration = '?'
+            else:
+                duration = '%.1fs' % s.estimate
+            lines.append('%-4s %-19s %7s  %s (%s)' % (
+                'run' if s.run else 'skip', s.name, duration, s.target,
+                s.reason))
+        total = 'Estimated: %.1fs' % self.estimate
+        if self.unknown:
+            total += ', not counting %d steps without history' % (
+                len(self.unknown))
+        lines.append(total)
+        return '\n'.join(lines)
@@ -0,0 +1,245 @@
+"""
+Copyright (c) 2011 Michael Elsdoerfer <michael@elsdoerfer.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Records what the external tools cost in terms of time, CPU, memory
+and I/O, grouped by build step.
+
+A ``BuildReport`` collects the usage of all tools run while it is
+active (in the current thread, or asyncio task). ``AndroidProject.build``
+does this automatically, and attaches the report to the returned ``Apk``.
+"""
+
+import time
+import json
+import threading
+from contextlib import contextmanager
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+
+__all__ = ('ToolUsage', 'StepReport', 'BuildReport', 'step',
+           'up_to_date', 'bind')
+
+
+if contextvars:
+    _active = contextvars.ContextVar('androidbuild_report', default=None)
+
+    def _get_active():
+        return _active.get()
+
+    def _set_active(value):
+        previous = _active.get()
+        _active.set(value)
+        return previous
+else:
+    _local = threading.local()
+
+    def _get_active():
+        return getattr(_local, 'active', None)
+
+    def _set_active(value):
+        previous = _get_active()
+        _local.active = value
+        return previous
+
+
+class ToolUsage(object):
+    """Resource usage of a single tool invocation.
+
+    Times are in seconds, ``max_rss`` in KB and I/O in bytes. Values
+    which could not be determined on this platform are ``None``.
+    """
+
+    fields = ('tool', 'cmdline', 'returncode', 'queue_wait', 'wall',
+              'user', 'sys', 'max_rss', 'read_bytes', 'write_bytes')
+
+    def __init__(self, **kwargs):
+        for name in self.fields:
+            setattr(self, name, kwargs.get(name))
+
+    def __repr__(self):
+        return '%s <%s %.2fs>' % (
+            self.__class__.__name__, self.tool, self.wall or 0)
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.fields)
+
+
+def _sum(usages, field):
+    values = [getattr(u, field) for u in usages
+              if getattr(u, field) is not None]
+    return sum(values) if values else None
+
+
+def _totals(usages):
+    totals = dict((field, _sum(usages, field)) for field in
+                  ('queue_wait', 'user', 'sys', 'read_bytes', 'write_bytes'))
+    rss = [u.max_rss for u in usages if u.max_rss is not None]
+    totals['max_rss'] = max(rss) if rss else None
+    totals['invocations'] = len(usages)
+    return totals
+
+
+class StepReport(object):
+    """The tools run during one build step.
+
+    ``wall`` covers the whole step, including the time spent in Python;
+    the other totals only the tools. ``up_to_date`` is set if the step
+    found its output up-to-date, and did no work.
+    """
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent
+        self.tools = []
+        self.start = time.time()
+        self.wall = None
+        self.up_to_date = False
+
+    def __repr__(self):
+        return '%s <%s>' % (self.__class__.__name__, self.name)
+
+    def as_dict(self):
+        result = {'name': self.name, 'parent': self.parent,
+                  'start': self.start, 'wall': self.wall,
+                  'up_to_date': self.up_to_date,
+                  'tools': [u.as_dict() for u in self.tools]}
+        result.update(_totals(self.tools))
+        return result
+
+
+class BuildReport(object):
+    """Collects ``StepReport`` instances for a build.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.steps = []
+        self.start = time.time()
+        self.wall = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '%s <%s, %d steps>' % (
+            self.__class__.__name__, self.name, len(self.steps))
+
+    @contextmanager
+    def activate(self):
+        """Record all tools run within the block into this report.
+        """
+        previous = _set_active((self, None))
+        try:
+            yield self
+        finally:
+            _set_active(previous)
+            self.wall = time.time() - self.start
+
+    @contextmanager
+    def step(self, name):
+        parent = _get_active()
+        report = StepReport(
+            name, parent[1].name if parent and parent[1] else None)
+        with self._lock:
+            self.steps.append(report)
+        previous = _set_active((self, report))
+        try:
+            yield report
+        finally:
+            _set_active(previous)
+            report.wall = time.time() - report.start
+
+    def record(self, usage, step=None):
+        if step is None:
+            step = StepReport(usage.tool)
+            step.wall = usage.wall
+            with self._lock:
+                self.steps.append(step)
+        step.tools.append(usage)
+
+    @property
+    def tools(self):
+        return [u for s in self.steps for u in s.tools]
+
+    def as_dict(self):
+        result = {'name': self.name, 'start': self.start,
+                  'wall': self.wall,
+                  'steps': [s.as_dict() for s in self.steps]}
+        result.update(_totals(self.tools))
+        return result
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.as_dict(), **kwargs)
+
+    def append_to(self, filename):
+        """Append the report as a single line to a JSONL file.
+        """
+        with open(filename, 'a') as f:
+            f.write(self.to_json(sort_keys=True) + '\n')
+
+
+@contextmanager
+def step(name):
+    """Group the tools run within the block into a step of the active
+    report; does nothing if there is no active report.
+    """
+    active = _get_active()
+    if not active:
+        yield None
+        return
+    with active[0].step(name) as report:
+        yield report
+
+
+def up_to_date():
+    """Note that the current step of the active report found its
+    output up-to-date.
+    """
+    active = _get_active()
+    if active and active[1]:
+        active[1].up_to_date = True
+
+
+def rename(name):
+    """Change the name of the current step of the active report; for a
+    step which does more or less work depending on what it finds, so
+    that the durations of each kind are kept apart.
+    """
+    active = _get_active()
+    if active and active[1]:
+        active[1].name = name
+
+
+def bind(func):
+    """Return a function which calls ``func`` with the report, and
+    step, which are active now; for running it in another thread.
+    """
+    active = _get_active()
+    def wrapper(*a, **kw):
+        previous = _set_active(active)
+        try:
+            return func(*a, **kw)
+        finally:
+            _set_active(previous)
+    return wrapper
+
+
+def record_usage(usage):
+    """Called for every tool invocation.
+    """
+    active = _get_active()
+    if active:
+        active[0].record(usage, active[1])
@@ -17,15 +17,31 @@ limitations under the License.
 import sys
 from os import path
 import logging
+from optparse import OptionParser
 
 from build import AndroidProject, ProgramFailedError, LOGGER_NAME
+from daemon import BuildDaemon, request_build
 
 
 def main(argv):
-     scriptname = path.basename(sys.argv[0])
-     if len(argv) != 1:
-          print "Builds the Android project in the current directory."
-          print "Usage: %s PATH_TO_SDK" % scriptname
+     parser = OptionParser(
+          usage="%prog [options] PATH_TO_SDK",
+          description="Builds the Android project in the current directory.")
+     parser.add_option("--daemon", action="store_true",
+          help="keep running, and rebuild whenever the project changes")
+     parser.add_option("--request-build", action="store_true",
+          help="ask a running daemon for a build, and wait for it")
+     parser.add_option("--dry-run", action="store_true",
+          help="show what a build would do, and how long it would take")
+     parser.add_option("--history", metavar="FILE",
+          help="record the steps of each build in FILE, to estimate "
+               "the duration of later ones")
+     options, args = parser.parse_args(argv)
+
+     if options.request_build:
+          return client(path.abspath('bin'))
+     if len(args) != 1:
+          parser.print_help()
           return 1
 
      # Setup logging
@@ -34,15 +50,29 @@ def main(argv):
      sh.setFormatter(logging.Formatter("> %(message)s"))
      log.addHandler(sh)
 
-     p = AndroidProject('AndroidManifest.xml', sdk_dir=argv[0])
+     p = AndroidProject('AndroidManifest.xml', sdk_dir=args[0])
+     p.history_file = options.history
+     if options.dry_run:
+          print p.plan().format()
+          return
+     keystore = path.expanduser('~/.android/debug.keystore')
+     if options.daemon:
+          daemon = BuildDaemon(p, keystore=(
+               (keystore, 'androiddebugkey', 'android')
+               if path.exists(keystore) else None))
+          print "Watching for changes, latest build: %s" % daemon.output
+          try:
+               daemon.serve_forever()
+          except KeyboardInterrupt:
+               pass
+          return
+
      try:
           apk = p.build()
 
-          keystore = path.expanduser('~/.android/debug.keystore')
           if path.exists(keystore):
                print "Signing with debug key..."
-               apk.sign(keystore, 'androiddebugkey', 'android')
-               apk.align()
+               apk.sign_and_align(keystore, 'androiddebugkey', 'android')
           else:
                print "Note: Package will be unsigned!"
 
@@ -60,6 +90,18 @@ def main(argv):
                print e.stderr
 
 
+def client(out_dir):
+     try:
+          result = request_build(out_dir)
+     except (IOError, OSError), e:
+          print "ERROR: No daemon running for this project (%s)" % e
+          return 1
+     if not result['ok']:
+          print u"ERROR: %s" % result['error']
+          return 1
+     print "Created: %s" % result['apk']
+
+
 def run():
      sys.exit(main(sys.argv[1:]) or 0)
 
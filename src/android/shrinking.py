@@ -0,0 +1,385 @@
+"""
+Copyright (c) 2011 Michael Elsdoerfer <michael@elsdoerfer.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Removing what an app does not use.
+
+The entry points of an app are the components in its manifest, which
+Android instantiates by name; ``keep_rules()`` turns them into a
+ProGuard configuration.
+
+Resources are reachable when the compiled code, the manifest, or the
+values files refer to them, or another reachable resource file does.
+``shrink_resources()`` replaces the other resource files with tiny
+placeholders, rather than leaving them out, so that every resource
+keeps its id; the code was compiled against those.
+"""
+
+import os
+import re
+import shutil
+import struct
+import zipfile
+from os import path
+from xml.etree import ElementTree
+
+
+__all__ = ('component_classes', 'keep_rules', 'parse_r',
+           'code_references', 'reachable_resources', 'shrink_resources')
+
+
+ANDROID_NS = '{http://schemas.android.com/apk/res/android}'
+
+# Elements whose android:name is a class instantiated by the system.
+COMPONENTS = ('application', 'activity', 'service', 'receiver',
+              'provider', 'instrumentation')
+
+# What Android and the framework access by reflection, from the SDK's
+# tools/proguard/proguard-android.txt.
+BASE_RULES = """\
+-dontpreverify
+-dontobfuscate
+-keepattributes *Annotation*,Signature,InnerClasses,EnclosingMethod
+-keepclasseswithmembernames class * {
+    native <methods>;
+}
+-keep public class * extends android.view.View {
+    public <init>(android.content.Context);
+    public <init>(android.content.Context, android.util.AttributeSet);
+    public <init>(android.content.Context, android.util.AttributeSet, int);
+    public void set*(...);
+}
+-keepclassmembers class * extends android.app.Activity {
+    public void *(android.view.View);
+}
+-keepclassmembers enum * {
+    public static **[] values();
+    public static ** valueOf(java.lang.String);
+}
+-keepclassmembers class * implements android.os.Parcelable {
+    public static final android.os.Parcelable$Creator CREATOR;
+}
+-keepclassmembers class **.R$* {
+    public static <fields>;
+}
+"""
+
+OPTIMIZE_RULES = """\
+-optimizations !code/simplification/arithmetic,!code/simplification/cast,!field/*,!class/merging/*
+-optimizationpasses 5
+-allowaccessmodification
+"""
+
+
+def qualify(name, package):
+    """Resolve a class name from the manifest, which may be relative to
+    the package.
+    """
+    if name.startswith('.'):
+        return package + name
+    if not '.' in name:
+        return '%s.%s' % (package, name)
+    return name
+
+
+def component_classes(manifest):
+    """Return the fully qualified names of the classes the manifest
+    file ``manifest`` refers to.
+    """
+    root = ElementTree.parse(manifest).getroot()
+    package = root.attrib['package']
+    classes = []
+    for element in root.iter():
+        names = []
+        if element.tag in COMPONENTS:
+            names.append(element.get(ANDROID_NS + 'name'))
+        if element.tag == 'application':
+            names.append(element.get(ANDROID_NS + 'backupAgent'))
+        for name in names:
+            if name:
+                name = qualify(name, package)
+                if not name in classes:
+                    classes.append(name)
+    return classes
+
+
+def keep_rules(manifest, optimize=False):
+    """Return a ProGuard configuration which keeps the components in
+    ``manifest``, and whatever else the platform needs.
+
+    The code is not obfuscated.
+    """
+    rules = [BASE_RULES]
+    if optimize:
+        rules.append(OPTIMIZE_RULES)
+    else:
+        rules.append('-dontoptimize\n')
+    for name in component_classes(manifest):
+        rules.append('-keep class %s {\n    <init>();\n}\n' % name)
+    return ''.join(rules)
+
+
+# The smallest valid PNG: 1x1, transparent.
+PLACEHOLDER_PNG = (
+    b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00'
+    b'\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89\x00\x00\x00\rIDAT'
+    b'x\x9cc\x00\x01\x00\x00\x05\x00\x01\r\n-\xb4\x00\x00\x00\x00IEND'
+    b'\xaeB`\x82')
+
+R_CLASS = re.compile(r'public static (?:final )?class (\w+)')
+R_FIELD = re.compile(r'public static (?:final )?int (\w+)\s*=\s*(0x[0-9a-fA-F]+);')
+text_type = type(u'')
+
+XML_REFERENCE = re.compile(r'@\+?(?:([\w.]+):)?(\w+)/([\w.]+)')
+NEW_ID = re.compile(r'@\+id/([\w.]+)')
+
+
+def parse_r(filename):
+    """Return the ids in the R.java file ``filename``, as a dict of
+    ``(type, name)`` tuples to ids.
+    """
+    ids = {}
+    type = None
+    with open(filename) as f:
+        for line in f:
+            match = R_CLASS.search(line)
+            if match:
+                type = match.group(1)
+                continue
+            match = R_FIELD.search(line)
+            if match and type:
+                ids[(type, match.group(1))] = int(match.group(2), 16)
+    return ids
+
+
+def _class_constants(data):
+    """Yield the integer, string and field reference constants in the
+    constant pool of the class file ``data``.
+
+    Integers are yielded as ``int``, strings as text, and field
+    references as ``(class, field)`` tuples.
+    """
+    if data[:4] != b'\xca\xfe\xba\xbe':
+        return
+    count = struct.unpack('>H', data[8:10])[0]
+    entries = [None] * count
+    fieldrefs = []
+    offset = 10
+    index = 1
+    while index < count:
+        tag = ord(data[offset:offset + 1])
+        if tag == 1:
+            length = struct.unpack('>H', data[offset + 1:offset + 3])[0]
+            entries[index] = data[offset + 3:offset + 3 + length].decode(
+                'utf-8', 'replace')
+            offset += 3 + length
+        elif tag == 3:
+            yield struct.unpack('>I', data[offset + 1:offset + 5])[0]
+            offset += 5
+        elif tag in (5, 6):
+            # Longs and doubles take up two entries.
+            offset += 9
+            index += 1
+        elif tag in (7, 8, 16, 19, 20):
+            entries[index] = struct.unpack(
+                '>H', data[offset + 1:offset + 3])[0]
+            offset += 3
+        elif tag == 15:
+            offset += 4
+        elif tag in (4, 10, 11, 17, 18):
+            offset += 5
+        elif tag in (9, 12):
+            entries[index] = struct.unpack(
+                '>HH', data[offset + 1:offset + 5])
+            if tag == 9:
+                fieldrefs.append(index)
+            offset += 5
+        else:
+            raise ValueError('Unknown constant pool tag %d' % tag)
+        index += 1
+    for value in entries:
+        if isinstance(value, text_type):
+            yield value
+    for index in fieldrefs:
+        class_index, name_and_type = entries[index]
+        yield (entries[entries[class_index]],
+               entries[entries[name_and_type][0]])
+
+
+def _class_files(paths):
+    """Yield the name, like ``com/foo/Bar.class``, and the content of
+    the class files in ``paths``, which may be directories or jars.
+    """
+    for item in paths:
+        if path.isdir(item):
+            for base, dirs, files in os.walk(item):
+                for f in files:
+                    if f.endswith('.class'):
+                        filename = path.join(base, f)
+                        with open(filename, 'rb') as fp:
+                            yield (path.relpath(filename, item).replace(
+                                os.sep, '/'), fp.read())
+        elif zipfile.is_zipfile(item):
+            with zipfile.ZipFile(item) as archive:
+                for name in archive.namelist():
+                    if name.endswith('.class'):
+                        yield name, archive.read(name)
+
+
+def _is_r_class(name, packages):
+    folder, _, f = name.rpartition('/')
+    return folder.replace('/', '.') in packages and \
+        (f == 'R.class' or f.startswith('R$'))
+
+
+def code_references(paths, ids, packages=()):
+    """Return the resources that the class files in ``paths`` refer to,
+    as ``(type, name)`` tuples, given the ``ids`` from ``parse_r()``.
+
+    The ids of an app are constants, so they end up in the code as
+    integers; libraries access fields of the R classes instead. Any
+    string constant which is the name of a resource counts as a
+    reference as well, as the code may look it up with
+    ``Resources.getIdentifier()``.
+
+    The R classes of ``packages``, those of the app and its libraries,
+    are skipped: they name, and hold the id of, every resource.
+    """
+    by_id = dict((v, k) for k, v in ids.items())
+    by_name = {}
+    for resource in ids:
+        by_name.setdefault(resource[1], []).append(resource)
+    found = set()
+    for name, data in _class_files(paths):
+        if _is_r_class(name, packages):
+            continue
+        for constant in _class_constants(data):
+            if isinstance(constant, tuple):
+                cls, field = constant
+                if cls.rsplit('/', 1)[-1].startswith('R$'):
+                    found.add((cls.rsplit('$', 1)[-1], field))
+            elif isinstance(constant, text_type):
+                found.update(by_name.get(constant, []))
+            elif constant in by_id:
+                found.add(by_id[constant])
+    return found
+
+
+def _xml_references(filename):
+    try:
+        with open(filename, 'rb') as f:
+            text = f.read().decode('utf-8', 'replace')
+    except IOError:
+        return set()
+    return set((type, name.replace('.', '_'))
+               for package, type, name in XML_REFERENCE.findall(text)
+               if package != 'android')
+
+
+def _resource_files(resource_dirs):
+    """Return the files in ``resource_dirs`` that define a resource of
+    their own, by ``(type, name)``; that is, all but the values files.
+    """
+    files = {}
+    for resource_dir in resource_dirs:
+        for folder in sorted(os.listdir(resource_dir)):
+            type = folder.split('-', 1)[0]
+            folder = path.join(resource_dir, folder)
+            if type == 'values' or not path.isdir(folder):
+                continue
+            for f in sorted(os.listdir(folder)):
+                files.setdefault((type, f.split('.', 1)[0]), []).append(
+                    path.join(folder, f))
+    return files
+
+
+def reachable_resources(manifest, resource_dirs, references):
+    """Return the resources which are reachable from ``references``,
+    from the manifest and from the values files.
+    """
+    roots = set(references) | _xml_references(manifest)
+    for resource_dir in resource_dirs:
+        for folder in os.listdir(resource_dir):
+            if folder.split('-', 1)[0] == 'values':
+                for f in os.listdir(path.join(resource_dir, folder)):
+                    roots |= _xml_references(
+                        path.join(resource_dir, folder, f))
+    files = _resource_files(resource_dirs)
+    reachable = set()
+    pending = list(roots)
+    while pending:
+        resource = pending.pop()
+        if resource in reachable:
+            continue
+        reachable.add(resource)
+        for filename in files.get(resource, []):
+            if filename.endswith('.xml'):
+                pending.extend(_xml_references(filename) - reachable)
+    return reachable
+
+
+def _placeholder(filename):
+    """Return the content of a placeholder for the resource file
+    ``filename``, declaring the same new ids.
+    """
+    if filename.endswith('.xml'):
+        with open(filename, 'rb') as f:
+            ids = NEW_ID.findall(f.read().decode('utf-8', 'replace'))
+        return ('<x xmlns:android="http://schemas.android.com/apk/res/'
+                'android">%s</x>\n' % ''.join(
+                    '<x android:id="@+id/%s"/>' % i for i in ids)
+                ).encode('utf-8')
+    if filename.endswith('.png'):
+        return PLACEHOLDER_PNG
+    return b''
+
+
+def _link_or_copy(source, target):
+    try:
+        os.link(source, target)
+    except (OSError, AttributeError):
+        shutil.copy2(source, target)
+
+
+def shrink_resources(resource_dirs, output_dir, reachable):
+    """Copy ``resource_dirs`` into ``output_dir``, replacing the files
+    of resources which are not ``reachable`` with placeholders. Returns
+    the new resource directories, and the number of bytes saved.
+
+    Nine-patch images are always kept, as they must be valid.
+    """
+    if path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    result = []
+    removed = 0
+    for i, resource_dir in enumerate(resource_dirs):
+        target_dir = path.join(output_dir, str(i))
+        for base, dirs, files in os.walk(resource_dir):
+            target_base = path.join(
+                target_dir, path.relpath(base, resource_dir))
+            os.makedirs(target_base)
+            type = path.basename(base).split('-', 1)[0]
+            for f in files:
+                source = path.join(base, f)
+                target = path.join(target_base, f)
+                if base == resource_dir or type == 'values' or \
+                        f.endswith('.9.png') or \
+                        (type, f.split('.', 1)[0]) in reachable:
+                    _link_or_copy(source, target)
+                else:
+                    with open(target, 'wb') as fp:
+                        fp.write(_placeholder(source))
+                    removed += os.stat(source).st_size
+        result.append(target_dir)
+    return result, removed
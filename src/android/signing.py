@@ -0,0 +1,560 @@
+"""
+Copyright (c) 2011 Michael Elsdoerfer <michael@elsdoerfer.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Signs APKs (JAR signature scheme, "v1") without starting ``jarsigner``.
+
+``sign_apk()`` copies the entries of an unsigned APK as they are, in
+their compressed form, digesting them on the way and aligning them like
+``zipalign``, then adds ``META-INF/MANIFEST.MF``, ``CERT.SF`` and
+``CERT.RSA``. Only RSA keys are supported. They can be read from Java
+keystores in the ``JKS`` format, or from PEM files.
+
+``verify_apk()`` checks a signed APK, whichever tool signed it.
+"""
+
+import os
+import re
+import zlib
+import base64
+import hashlib
+import binascii
+import tempfile
+from os import path
+
+from .apkzip import ApkReader, ApkWriter, DEFLATED, STORED
+
+
+__all__ = ('SigningKey', 'UnsupportedKeyError', 'VerificationError',
+           'load_keystore', 'load_pem', 'sign_apk', 'verify_apk')
+
+
+class UnsupportedKeyError(ValueError):
+    """The key or keystore is not in a format we can read.
+    """
+
+
+class VerificationError(ValueError):
+    """An APK is not signed, or not aligned, the way it should be.
+    """
+
+
+# Minimal DER support, just enough for keys, certificates and PKCS#7.
+
+def _der_read(data, offset=0):
+    """Return ``(tag, start, end)`` of the element at ``offset``,
+    ``start`` and ``end`` delimiting its content.
+    """
+    tag = bytearray(data[offset:offset + 1])[0]
+    length = bytearray(data[offset + 1:offset + 2])[0]
+    offset += 2
+    if length & 0x80:
+        count = length & 0x7f
+        length = int(binascii.hexlify(data[offset:offset + count]), 16)
+        offset += count
+    return tag, offset, offset + length
+
+
+def _der_children(data):
+    """Split the content of a constructed element into its children,
+    as ``(tag, content, raw element)`` tuples.
+    """
+    result = []
+    offset = 0
+    while offset < len(data):
+        tag, start, end = _der_read(data, offset)
+        result.append((tag, data[start:end], data[offset:end]))
+        offset = end
+    return result
+
+
+def _der_int(data):
+    return int(binascii.hexlify(data), 16) if data else 0
+
+
+def _der(tag, content):
+    length = len(content)
+    if length < 0x80:
+        return bytes(bytearray([tag, length])) + content
+    encoded = _unsigned(length)
+    return bytes(bytearray([tag, 0x80 | len(encoded)])) + encoded + content
+
+
+def _unsigned(value, size=0):
+    """Big-endian bytes of ``value``, zero-padded to ``size`` bytes.
+    """
+    hexed = '%x' % value
+    return binascii.unhexlify(
+        hexed.rjust(max(size * 2, len(hexed) + len(hexed) % 2), '0'))
+
+
+def _der_sequence(*items):
+    return _der(0x30, b''.join(items))
+
+
+def _der_set(*items):
+    return _der(0x31, b''.join(sorted(items)))
+
+
+def _der_integer(value):
+    data = _unsigned(value)
+    if bytearray(data)[0] & 0x80:
+        data = b'\0' + data
+    return _der(0x02, data)
+
+
+def _der_oid(oid):
+    parts = [int(p) for p in oid.split('.')]
+    encoded = bytearray([parts[0] * 40 + parts[1]])
+    for part in parts[2:]:
+        chunk = [part & 0x7f]
+        part >>= 7
+        while part:
+            chunk.insert(0, 0x80 | (part & 0x7f))
+            part >>= 7
+        encoded.extend(chunk)
+    return _der(0x06, bytes(encoded))
+
+
+_NULL = b'\x05\x00'
+OID_DATA = '1.2.840.113549.1.7.1'
+OID_SIGNED_DATA = '1.2.840.113549.1.7.2'
+OID_RSA = '1.2.840.113549.1.1.1'
+OID_JKS_KEY_PROTECTOR = '1.3.6.1.4.1.42.2.17.1.1'
+
+OID_MESSAGE_DIGEST = '1.2.840.113549.1.9.4'
+
+# Name in the manifest, hashlib name, OID
+DIGESTS = {
+    'SHA1': ('SHA1', 'sha1', '1.3.14.3.2.26'),
+    'SHA-256': ('SHA-256', 'sha256', '2.16.840.1.101.3.4.2.1'),
+}
+
+# What signatures made by jarsigner may use, in addition; by OID.
+_SIGNATURE_DIGESTS = dict(
+    [(_der_oid(oid), algorithm) for name, algorithm, oid in DIGESTS.values()]
+    + [(_der_oid('1.2.840.113549.2.5'), 'md5')])
+
+
+class SigningKey(object):
+    """An RSA private key, with the matching certificate.
+
+    ``private_key`` is a DER-encoded PKCS#1 ``RSAPrivateKey`` or a PKCS#8
+    ``PrivateKeyInfo``, ``certificate`` a DER-encoded X.509 certificate.
+    """
+
+    def __init__(self, private_key, certificate):
+        self.certificate = certificate
+        self._parse_key(private_key)
+        self._parse_certificate(certificate)
+
+    def __repr__(self):
+        return '%s <%d bits>' % (self.__class__.__name__,
+                                 self.modulus.bit_length())
+
+    def _parse_key(self, der):
+        (tag, content, _), = _der_children(der)
+        fields = _der_children(content)
+        if fields[1][0] == 0x30:
+            # PKCS#8: the algorithm, then the PKCS#1 key as octet string.
+            algorithm = _der_children(fields[1][1])[0][2]
+            if algorithm != _der_oid(OID_RSA):
+                raise UnsupportedKeyError('Only RSA keys are supported')
+            (tag, content, _), = _der_children(fields[2][1])
+            fields = _der_children(content)
+        (self.modulus, self.public_exponent, self.exponent,
+         self.p, self.q, self.dp, self.dq, self.qinv) = [
+            _der_int(f[1]) for f in fields[1:9]]
+
+    def _parse_certificate(self, der):
+        (tag, content, _), = _der_children(der)
+        tbs = _der_children(_der_children(content)[0][1])
+        if tbs[0][0] == 0xa0:
+            # Explicit version
+            tbs = tbs[1:]
+        self.serial_number = tbs[0][2]
+        self.issuer = tbs[2][2]
+
+    def sign(self, data, digest='SHA1'):
+        """Sign ``data`` with RSASSA-PKCS1-v1_5.
+        """
+        name, algorithm, oid = DIGESTS[digest]
+        digest_info = _der_sequence(
+            _der_sequence(_der_oid(oid), _NULL),
+            _der(0x04, hashlib.new(algorithm, data).digest()))
+        size = (self.modulus.bit_length() + 7) // 8
+        padding = b'\xff' * (size - len(digest_info) - 3)
+        message = _der_int(b'\x00\x01' + padding + b'\x00' + digest_info)
+        # Chinese remainder theorem, to speed things up.
+        m1 = pow(message, self.dp, self.p)
+        m2 = pow(message, self.dq, self.q)
+        h = (self.qinv * (m1 - m2)) % self.p
+        return _unsigned(m2 + h * self.q, size)
+
+    def signature_block(self, data, digest='SHA1'):
+        """Return a PKCS#7 ``SignedData`` structure, as found in
+        ``META-INF/*.RSA``, with a detached signature of ``data``.
+        """
+        algorithm = _der_sequence(_der_oid(DIGESTS[digest][2]), _NULL)
+        signer_info = _der_sequence(
+            _der_integer(1),
+            _der_sequence(self.issuer, self.serial_number),
+            algorithm,
+            _der_sequence(_der_oid(OID_RSA), _NULL),
+            _der(0x04, self.sign(data, digest)))
+        signed_data = _der_sequence(
+            _der_integer(1),
+            _der_set(algorithm),
+            _der_sequence(_der_oid(OID_DATA)),
+            _der(0xa0, self.certificate),
+            _der_set(signer_info))
+        return _der_sequence(_der_oid(OID_SIGNED_DATA),
+                             _der(0xa0, signed_data))
+
+
+def _pem_blocks(text):
+    return [(kind, base64.b64decode(body.encode('ascii')))
+            for kind, body in re.findall(
+                r'-----BEGIN ([A-Z ]+)-----(.*?)-----END \1-----',
+                text, re.S)]
+
+
+def load_pem(key_file, certificate_file=None):
+    """Read an unencrypted RSA key, and the certificate, from PEM
+    files. Both may be in the same file.
+    """
+    with open(key_file) as f:
+        blocks = _pem_blocks(f.read())
+    if certificate_file:
+        with open(certificate_file) as f:
+            blocks += _pem_blocks(f.read())
+    keys = [data for kind, data in blocks
+            if kind in ('RSA PRIVATE KEY', 'PRIVATE KEY')]
+    certificates = [data for kind, data in blocks if kind == 'CERTIFICATE']
+    if not keys:
+        raise UnsupportedKeyError(
+            'No unencrypted RSA private key in %s' % key_file)
+    if not certificates:
+        raise UnsupportedKeyError('No certificate found')
+    return SigningKey(keys[0], certificates[0])
+
+
+def _jks_password(password):
+    return password.encode('utf-16-be')
+
+
+def _jks_decrypt_key(encrypted, password):
+    """Undo Sun's proprietary "key protector" of JKS keystores.
+    """
+    algorithm, data = _der_children(_der_children(encrypted)[0][1])
+    if _der_children(algorithm[1])[0][2] != _der_oid(OID_JKS_KEY_PROTECTOR):
+        raise UnsupportedKeyError('Unknown key protection algorithm')
+    data = data[1]
+    salt, ciphertext, check = data[:20], data[20:-20], data[-20:]
+    password = _jks_password(password)
+    stream = bytearray()
+    digest = salt
+    while len(stream) < len(ciphertext):
+        digest = hashlib.sha1(password + digest).digest()
+        stream.extend(bytearray(digest))
+    key = bytes(bytearray(
+        a ^ b for a, b in zip(bytearray(ciphertext), stream)))
+    if hashlib.sha1(password + key).digest() != check:
+        raise ValueError('Wrong password for the key')
+    return key
+
+
+def load_keystore(filename, alias, password, key_password=None):
+    """Read the key ``alias`` from a Java keystore in the (classic)
+    ``JKS`` format. ``PKCS12`` and ``JCEKS`` keystores raise
+    ``UnsupportedKeyError``.
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if data[:4] != b'\xfe\xed\xfe\xed':
+        raise UnsupportedKeyError('%s is not a JKS keystore' % filename)
+
+    offset = [4]
+
+    def read(size):
+        value = data[offset[0]:offset[0] + size]
+        offset[0] += size
+        return value
+
+    def read_int(size=4):
+        return int(binascii.hexlify(read(size)), 16)
+
+    def read_utf():
+        return read(read_int(2)).decode('utf-8')
+
+    version = read_int()
+    for _ in range(read_int()):
+        tag = read_int()
+        name = read_utf()
+        read(8)   # timestamp
+        if tag == 1:
+            key = read(read_int())
+            certificates = []
+            for _ in range(read_int()):
+                if version == 2:
+                    read_utf()   # certificate type
+                certificates.append(read(read_int()))
+            if name.lower() == alias.lower():
+                return SigningKey(
+                    _jks_decrypt_key(key, key_password or password),
+                    certificates[0])
+        else:
+            if version == 2:
+                read_utf()
+            read(read_int())
+    raise ValueError('No key "%s" in %s' % (alias, filename))
+
+
+def _manifest_section(attributes):
+    """Format a manifest section; lines are wrapped after 72 bytes.
+    """
+    lines = []
+    for key, value in attributes:
+        line = ('%s: %s' % (key, value)).encode('utf-8')
+        lines.append(line[:72])
+        line = line[72:]
+        while line:
+            lines.append(b' ' + line[:71])
+            line = line[71:]
+    return b''.join(l + b'\r\n' for l in lines) + b'\r\n'
+
+
+def _is_signature_file(name):
+    name = name.upper()
+    return name == 'META-INF/MANIFEST.MF' or (
+        name.startswith('META-INF/') and name.count('/') == 1 and
+        path.splitext(name)[1] in ('.SF', '.RSA', '.DSA', '.EC'))
+
+
+def _digesting(entry, chunks, digest):
+    """Pass ``chunks`` through, feeding their uncompressed content to
+    ``digest``.
+    """
+    decompressor = zlib.decompressobj(-15) if entry.method == DEFLATED \
+        else None
+    for chunk in chunks:
+        yield chunk
+        digest.update(decompressor.decompress(chunk) if decompressor
+                      else chunk)
+    if decompressor:
+        digest.update(decompressor.flush())
+
+
+def sign_apk(apk, key, output=None, digest='SHA1', align=4,
+             date_time=None):
+    """Sign the APK file ``apk`` with ``key``, a ``SigningKey``, and
+    align it. Writes to ``output``, or replaces ``apk``. ``date_time``
+    is passed to ``ApkWriter``.
+
+    SHA1 digests are understood by all versions of Android; SHA-256
+    requires API level 18.
+    """
+    name, algorithm, oid = DIGESTS[digest]
+    output = output or apk
+    fd, tmp = tempfile.mkstemp(dir=path.dirname(path.abspath(output)),
+                               prefix='%s.' % path.basename(output),
+                               suffix='.signing')
+    os.chmod(tmp, 0o644)
+    try:
+        sections = []
+        with ApkReader(apk) as reader:
+            with os.fdopen(fd, 'wb') as f:
+                writer = ApkWriter(f, align, date_time)
+                for entry in reader.entries:
+                    if _is_signature_file(entry.name):
+                        continue
+                    if entry.is_dir:
+                        writer.write_raw(entry, reader.raw_chunks(entry))
+                        continue
+                    hash = hashlib.new(algorithm)
+                    writer.write_raw(entry, _digesting(
+                        entry, reader.raw_chunks(entry), hash))
+                    sections.append((entry.name, _manifest_section([
+                        ('Name', entry.name),
+                        ('%s-Digest' % name,
+                         base64.b64encode(hash.digest()).decode('ascii'))])))
+
+                main = _manifest_section([
+                    ('Manifest-Version', '1.0'),
+                    ('Created-By', '1.0 (py-androidbuild)')])
+                manifest = main + b''.join(s for _, s in sections)
+
+                def b64digest(data):
+                    return base64.b64encode(
+                        hashlib.new(algorithm, data).digest()).decode('ascii')
+
+                signature_file = _manifest_section([
+                    ('Signature-Version', '1.0'),
+                    ('%s-Digest-Manifest-Main-Attributes' % name,
+                     b64digest(main)),
+                    ('Created-By', '1.0 (py-androidbuild)'),
+                    ('%s-Digest-Manifest' % name, b64digest(manifest)),
+                ]) + b''.join(
+                    _manifest_section([
+                        ('Name', entry_name),
+                        ('%s-Digest' % name, b64digest(section))])
+                    for entry_name, section in sections)
+
+                writer.write('META-INF/MANIFEST.MF', manifest)
+                writer.write('META-INF/CERT.SF', signature_file)
+                writer.write('META-INF/CERT.RSA',
+                             key.signature_block(signature_file, digest))
+                writer.close()
+        os.rename(tmp, output)
+    finally:
+        if path.exists(tmp):
+            os.unlink(tmp)
+    return output
+
+
+def _parse_manifest(data):
+    """Return the sections of a manifest or signature file as a list of
+    dicts; the main section comes first.
+    """
+    sections = []
+    attributes = []
+    for line in data.splitlines():
+        if line.startswith(b' ') and attributes:
+            attributes[-1] += line[1:]
+        elif line:
+            attributes.append(line)
+        elif attributes:
+            sections.append(attributes)
+            attributes = []
+    if attributes:
+        sections.append(attributes)
+    return [dict(a.decode('utf-8').split(': ', 1) for a in section)
+            for section in sections]
+
+
+def _check_digest(attributes, chunks, what, suffix=''):
+    """Compare the digest of ``chunks`` with the one in the manifest
+    ``attributes``, named ``<algorithm>-Digest<suffix>``.
+    """
+    for key, value in attributes.items():
+        name, _, rest = key.partition('-Digest')
+        if rest != suffix or not name in DIGESTS:
+            continue
+        hash = hashlib.new(DIGESTS[name][1])
+        for chunk in chunks:
+            hash.update(chunk)
+        if base64.b64decode(value.encode('ascii')) != hash.digest():
+            raise VerificationError('Digest mismatch for %s' % what)
+        return
+    raise VerificationError('No digest for %s' % what)
+
+
+def _public_key(certificate):
+    (tag, content, _), = _der_children(certificate)
+    tbs = _der_children(_der_children(content)[0][1])
+    if tbs[0][0] == 0xa0:
+        tbs = tbs[1:]
+    spki = _der_children(tbs[5][1])
+    # A bit string; the first byte is the number of unused bits.
+    (tag, key, _), = _der_children(spki[1][1][1:])
+    modulus, exponent = [_der_int(f[1]) for f in _der_children(key)]
+    return tbs[0][2], modulus, exponent
+
+
+def _verify_signature_block(block, data):
+    """Check the PKCS#7 ``SignedData`` in ``block`` against ``data``,
+    using the certificate in the block.
+    """
+    (tag, content, _), = _der_children(block)
+    (tag, signed_data, _), = _der_children(_der_children(content)[1][1])
+    fields = _der_children(signed_data)
+    certificates = [c[2] for f in fields if f[0] == 0xa0
+                    for c in _der_children(f[1])]
+    signer = _der_children(_der_children(fields[-1][1])[0][1])
+    serial = _der_children(signer[1][1])[1][2]
+    keys = [_public_key(c) for c in certificates]
+    keys = [k[1:] for k in keys if k[0] == serial]
+    if not keys:
+        raise VerificationError('No certificate for the signature')
+    modulus, exponent = keys[0]
+
+    digest_algorithm = _der_children(signer[2][1])[0][2]
+    if not digest_algorithm in _SIGNATURE_DIGESTS:
+        raise VerificationError('Unsupported digest algorithm')
+    algorithm = _SIGNATURE_DIGESTS[digest_algorithm]
+    if signer[3][0] == 0xa0:
+        # Signed attributes, one of which is the digest of the data;
+        # the signature is over the attributes, as a DER set.
+        attributes = dict(
+            (_der_children(a[1])[0][2], _der_children(a[1])[1][1])
+            for a in _der_children(signer[3][1]))
+        message_digest = attributes.get(_der_oid(OID_MESSAGE_DIGEST))
+        if message_digest is None or _der_children(message_digest)[0][1] \
+                != hashlib.new(algorithm, data).digest():
+            raise VerificationError('Digest mismatch for the signature file')
+        data = b'\x31' + signer[3][2][1:]
+
+    signature = _der_int([f for f in signer if f[0] == 0x04][-1][1])
+    size = (modulus.bit_length() + 7) // 8
+    message = _unsigned(pow(signature, exponent, modulus), size)
+    if message[:2] != b'\x00\x01' or not b'\x00' in message[2:]:
+        raise VerificationError('Bad signature')
+    digest_info = message[message.index(b'\x00', 2) + 1:]
+    oid, digest = _der_children(_der_children(digest_info)[0][1])
+    algorithm = _SIGNATURE_DIGESTS.get(_der_children(oid[1])[0][2])
+    if not algorithm or digest[1] != hashlib.new(algorithm, data).digest():
+        raise VerificationError('Bad signature')
+
+
+def verify_apk(apk, align=4):
+    """Check that the APK file ``apk`` is signed: that every entry is
+    in the manifest, with a matching digest, and that the signature
+    files match the manifest and are signed by the certificate in the
+    signature block. Only RSA signatures are supported. Unless
+    ``align`` is 0, checks that uncompressed entries are aligned.
+
+    Raises ``VerificationError`` if not.
+    """
+    with ApkReader(apk) as reader:
+        entries = dict((e.name.upper(), e) for e in reader.entries)
+        if not 'META-INF/MANIFEST.MF' in entries:
+            raise VerificationError('%s is not signed' % apk)
+        manifest = reader.read(entries['META-INF/MANIFEST.MF'])
+        sections = dict((s.get('Name'), s)
+                        for s in _parse_manifest(manifest)[1:])
+        for entry in reader.entries:
+            if entry.is_dir or _is_signature_file(entry.name):
+                continue
+            if align and entry.method == STORED and \
+                    reader.data_offset(entry) % align:
+                raise VerificationError('%s is not aligned' % entry.name)
+            if not entry.name in sections:
+                raise VerificationError('%s is not signed' % entry.name)
+            _check_digest(sections[entry.name], reader.chunks(entry),
+                          entry.name)
+
+        signature_files = [name for name in entries
+                           if _is_signature_file(name)
+                           and name.endswith('.SF')]
+        if not signature_files:
+            raise VerificationError('%s is not signed' % apk)
+        for name in signature_files:
+            block = name[:-len('.SF')] + '.RSA'
+            if not block in entries:
+                raise VerificationError(
+                    'Only RSA signatures can be verified (%s)' % name)
+            data = reader.read(entries[name])
+            _check_digest(_parse_manifest(data)[0], [manifest],
+                          'the manifest', '-Manifest')
+            _verify_signature_block(reader.read(entries[block]), data)
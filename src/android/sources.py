@@ -0,0 +1,233 @@
+"""
+Copyright (c) 2011 Michael Elsdoerfer <michael@elsdoerfer.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Splitting Java sources into parts which can be compiled on their own.
+
+``javac`` uses a single thread. To compile a large project on several
+CPUs, its sources are divided into units, packages or modules, and the
+units into stages, such that the sources in a stage only refer to those
+in earlier stages, or in the same chunk of the stage. The chunks of a
+stage can then be compiled at the same time, against the classes of
+the earlier stages.
+
+Which unit refers to which is found by looking for qualified names of
+the classes in other units, as in imports, without parsing the code; a
+mention in a comment counts, too. What this misses, the compiler will
+complain about; ``PlatformTarget.compile_java()`` then compiles all
+sources together.
+"""
+
+import re
+import codecs
+from collections import deque
+
+
+__all__ = ('package_units', 'partition_sources')
+
+
+PACKAGE = re.compile(r'^\s*package\s+([\w.]+)\s*;', re.M)
+
+
+def _read(filename):
+    with codecs.open(filename, 'r', 'utf-8', 'replace') as f:
+        return f.read()
+
+
+def _package(text):
+    match = PACKAGE.search(text)
+    return match.group(1) if match else ''
+
+
+def package_units(files):
+    """Group ``files`` by the package they declare; returns a list of
+    ``(package, files)`` tuples.
+    """
+    units = {}
+    for filename in files:
+        units.setdefault(_package(_read(filename)), []).append(filename)
+    return sorted(units.items())
+
+
+def _references(units):
+    """Return, for each of ``units``, the indexes of the units it
+    refers to.
+    """
+    texts = [[_read(f) for f in files] for name, files in units]
+    owners = {}
+    for index, unit_texts in enumerate(texts):
+        for text in unit_texts:
+            owners.setdefault(_package(text), set()).add(index)
+    packages = sorted((p for p in owners if p), key=len, reverse=True)
+    pattern = re.compile(r'(?<![\w.])(%s)\.(?:[A-Z_$]|\*)' % '|'.join(
+        re.escape(p) for p in packages)) if packages else None
+
+    references = []
+    for index, unit_texts in enumerate(texts):
+        found = set()
+        for text in unit_texts:
+            # Classes in the same package need no qualification.
+            found |= owners[_package(text)]
+            if pattern:
+                for package in set(pattern.findall(text)):
+                    found |= owners[package]
+        found.discard(index)
+        references.append(found)
+    return references
+
+
+def _components(references):
+    """Kosaraju's algorithm, without recursion; returns the strongly
+    connected components of the graph ``references``, as lists of
+    nodes.
+    """
+    count = len(references)
+    order = []
+    visited = [False] * count
+    for start in range(count):
+        if visited[start]:
+            continue
+        visited[start] = True
+        stack = [(start, iter(references[start]))]
+        while stack:
+            node, edges = stack[-1]
+            for other in edges:
+                if not visited[other]:
+                    visited[other] = True
+                    stack.append((other, iter(references[other])))
+                    break
+            else:
+                stack.pop()
+                order.append(node)
+
+    referrers = [[] for _ in range(count)]
+    for node, edges in enumerate(references):
+        for other in edges:
+            referrers[other].append(node)
+    component = [None] * count
+    components = []
+    for start in reversed(order):
+        if component[start] is not None:
+            continue
+        members = []
+        component[start] = len(components)
+        stack = [start]
+        while stack:
+            node = stack.pop()
+            members.append(node)
+            for other in referrers[node]:
+                if component[other] is None:
+                    component[other] = len(components)
+                    stack.append(other)
+        components.append(members)
+    return components, component
+
+
+def _levels(references, components, component):
+    """The level of each component: those which refer to no other
+    component are at level 0, the others one level above the highest
+    component they refer to.
+    """
+    dependencies = [set() for _ in components]
+    dependents = [set() for _ in components]
+    for node, edges in enumerate(references):
+        for other in edges:
+            if component[node] != component[other]:
+                dependencies[component[node]].add(component[other])
+                dependents[component[other]].add(component[node])
+    levels = [0] * len(components)
+    waiting = [len(d) for d in dependencies]
+    ready = deque(i for i, n in enumerate(waiting) if n == 0)
+    while ready:
+        current = ready.popleft()
+        for other in dependents[current]:
+            levels[other] = max(levels[other], levels[current] + 1)
+            waiting[other] -= 1
+            if not waiting[other]:
+                ready.append(other)
+    return levels, dependencies
+
+
+def _chunks(members, dependencies, sizes, count):
+    """Split the components ``members`` of a stage into at most
+    ``count`` chunks, keeping those which refer to each other together.
+    """
+    # Union-find over the references within the stage.
+    parent = dict((m, m) for m in members)
+
+    def find(m):
+        while parent[m] != m:
+            parent[m] = parent[parent[m]]
+            m = parent[m]
+        return m
+    for m in members:
+        for other in dependencies[m]:
+            if other in parent:
+                parent[find(m)] = find(other)
+    groups = {}
+    for m in members:
+        groups.setdefault(find(m), []).append(m)
+
+    # Largest first, each into the smallest chunk so far.
+    chunks = [[] for _ in range(min(count, len(groups)))]
+    totals = [0] * len(chunks)
+    for group in sorted(groups.values(),
+                        key=lambda g: sum(sizes[m] for m in g),
+                        reverse=True):
+        smallest = totals.index(min(totals))
+        chunks[smallest].extend(group)
+        totals[smallest] += sum(sizes[m] for m in group)
+    return chunks
+
+
+def partition_sources(units, workers, min_files=50):
+    """Plan the compilation of ``units``, a list of ``(name, files)``
+    tuples, on ``workers`` CPUs.
+
+    Returns a list of stages, each a list of chunks, each a list of
+    files. Stages are merged until they have at least ``min_files``
+    files per worker, as every chunk costs a start of ``javac``.
+    """
+    units = [(name, files) for name, files in units if files]
+    if not units:
+        return []
+    references = _references(units)
+    components, component = _components(references)
+    levels, dependencies = _levels(references, components, component)
+    sizes = [sum(len(units[n][1]) for n in members)
+             for members in components]
+
+    # Consecutive levels are merged into stages.
+    by_level = {}
+    for index, level in enumerate(levels):
+        by_level.setdefault(level, []).append(index)
+    stages = []
+    current = []
+    for level in sorted(by_level):
+        current.extend(by_level[level])
+        if sum(sizes[c] for c in current) >= min_files * workers:
+            stages.append(current)
+            current = []
+    if current:
+        stages.append(current)
+
+    result = []
+    for members in stages:
+        total = sum(sizes[c] for c in members)
+        count = max(1, min(workers, total // max(min_files, 1)))
+        result.append([
+            sorted(f for c in chunk for n in components[c]
+                   for f in units[n][1])
+            for chunk in _chunks(members, dependencies, sizes, count)])
+    return result
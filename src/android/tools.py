@@ -16,11 +16,24 @@ limitations under the License.
 
 import sys
 import os
+import re
+import time
+import logging
+import threading
 import subprocess
+from collections import deque
 
+from .report import ToolUsage, record_usage
+from . import metrics
 
-__all__ = ('ProgramFailedError', 'Aapt', 'Aidl', 'LlvmRs', 'ApkBuilder',
-           'Dx', 'JarSigner', 'NdkBuild', 'NdkClean', 'JavaC', 'ZipAlign')
+
+__all__ = ('ProgramFailedError', 'Governor', 'governor', 'Aapt', 'Aidl',
+           'LlvmRs', 'ApkBuilder', 'Dx', 'JarSigner', 'NdkBuild', 'NdkClean', 'JavaC', 'ZipAlign',
+           'ProGuard')
+
+
+# Same logger as android.build, which imports us.
+log = logging.getLogger('py-androidbuild')
 
 
 class ProgramFailedError(RuntimeError):
@@ -44,11 +57,181 @@ class ProgramFailedError(RuntimeError):
             self.cmdline, self.returncode)
 
     def __str__(self):
+        if sys.version_info[0] >= 3:
+            return self.__unicode__()
         return self.__unicode__().encode('ascii', '?')
 
 
+def _physical_memory():
+    """Total RAM of the machine in MB, or ``None`` if unknown.
+    """
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') \
+            // (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+class Governor(object):
+    """Limits the external tools running at the same time in this
+    process, by their expected memory use and by CPU slots.
+
+    Every ``Program`` invocation goes through the governor, with the
+    ``memory`` (in MB) and ``cpu`` cost given by the program. Launches
+    which do not fit are queued, and started in order as soon as enough
+    resources are released. A program which on its own exceeds a limit
+    is allowed to run once nothing else is running.
+
+    By default, up to 75% of the RAM of the machine, and one slot per
+    CPU, is used. Change this with ``configure()``.
+    """
+
+    def __init__(self, memory=None, slots=None):
+        self._lock = threading.Lock()
+        self._waiting = deque()
+        self.used_memory = self.used_slots = 0
+        self.configure(memory, slots)
+
+    def configure(self, memory=None, slots=None):
+        """Set the memory budget in MB and the number of CPU slots.
+        """
+        with self._lock:
+            total = _physical_memory()
+            self.memory = memory or (int(total * 0.75) if total else 4096)
+            self.slots = slots or _cpu_count()
+            self._grant()
+
+    def __repr__(self):
+        return '%s <%s/%sMB, %s/%s slots, %s waiting>' % (
+            self.__class__.__name__, self.used_memory, self.memory,
+            self.used_slots, self.slots, len(self._waiting))
+
+    def _fits(self, memory, cpu):
+        if not self.used_slots:
+            return True
+        return self.used_memory + memory <= self.memory and \
+            self.used_slots + cpu <= self.slots
+
+    def _grant(self):
+        # Strictly in order, so big tools are not starved by small ones.
+        while self._waiting and self._fits(*self._waiting[0][:2]):
+            memory, cpu, wake = self._waiting.popleft()
+            self.used_memory += memory
+            self.used_slots += cpu
+            wake()
+
+    def request(self, memory, cpu, wake):
+        """Ask for resources; returns ``True`` if they were granted
+        right away. Otherwise, ``wake`` is called (from whichever thread
+        releases the resources) once they have been granted, unless
+        the request is withdrawn first.
+
+        This is the building block for ``acquire()``, and for
+        non-threaded callers like ``android.aio``.
+        """
+        with self._lock:
+            if not self._waiting and self._fits(memory, cpu):
+                self.used_memory += memory
+                self.used_slots += cpu
+                return True
+            self._waiting.append((memory, cpu, wake))
+            return False
+
+    def withdraw(self, wake):
+        """Withdraw a pending request. Returns ``False`` if it was
+        already granted, in which case it needs to be released.
+        """
+        with self._lock:
+            for item in self._waiting:
+                if item[2] is wake:
+                    self._waiting.remove(item)
+                    self._grant()
+                    return True
+            return False
+
+    def acquire(self, memory, cpu=1):
+        """Block until the resources are available. Returns the time
+        spent waiting.
+        """
+        start = time.time()
+        event = threading.Event()
+        if not self.request(memory, cpu, event.set):
+            event.wait()
+        return time.time() - start
+
+    def release(self, memory, cpu=1):
+        with self._lock:
+            self.used_memory -= memory
+            self.used_slots -= cpu
+            self._grant()
+
+
+# Shared by all tools in the process.
+governor = Governor()
+
+
+def _read_proc_io(pid):
+    """Return the bytes read and written by ``pid`` according to
+    /proc, which counts I/O served from the page cache as well.
+    """
+    try:
+        with open('/proc/%d/io' % pid) as f:
+            values = dict(line.split(': ') for line in f.read().splitlines())
+        return int(values['rchar']), int(values['wchar'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None, None
+
+
+def wait_with_usage(process):
+    """Wait for the ``Popen`` instance ``process`` to finish, and return
+    a ``ToolUsage`` with the resources it used.
+    """
+    if not hasattr(os, 'wait4'):
+        process.wait()
+        return ToolUsage(returncode=process.returncode)
+
+    read_bytes = write_bytes = None
+    if hasattr(os, 'waitid'):
+        # Wait without reaping, so that /proc/<pid> is still there.
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        read_bytes, write_bytes = _read_proc_io(process.pid)
+    _, status, rusage = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+
+    max_rss = rusage.ru_maxrss
+    if sys.platform == 'darwin':
+        # Bytes rather than KB.
+        max_rss //= 1024
+    if read_bytes is None:
+        # Only counts actual disk I/O, in 512-byte blocks.
+        read_bytes = rusage.ru_inblock * 512
+        write_bytes = rusage.ru_oublock * 512
+    return ToolUsage(
+        returncode=process.returncode, user=rusage.ru_utime,
+        sys=rusage.ru_stime, max_rss=max_rss,
+        read_bytes=read_bytes, write_bytes=write_bytes)
+
+
 class Program(object):
 
+    # Expected peak memory use in MB, and the number of CPU cores the
+    # tool keeps busy; used by the ``governor``.
+    memory = 64
+    cpu = 1
+
+    governor = governor
+
     def __init__(self, executable, framework=None):
         self.executable = executable
         # Some tools need to know the SDK environment they are running in
@@ -78,18 +261,40 @@ class Program(object):
         if shell and not sys.platform=="win32":
             # This is required for scripts that lack the +x flag
             cmdline.insert(0, '/bin/sh')
-        cmdline_str = " ".join(cmdline)
 
         custom_env = os.environ.copy()
         custom_env.update(env or {})
 
-        process = subprocess.Popen(
-            cmdline,
-            shell=True if sys.platform=="win32" else False,
-            env=custom_env,
-            stderr=subprocess.PIPE,
-            stdout=subprocess.PIPE)
-        process.wait()
+        return self.execute(cmdline, custom_env)
+
+    def execute(self, cmdline, env):
+        """Run the final ``cmdline`` with the environment ``env``.
+
+        Separate from ``__call__`` so that subclasses can change the
+        way the process is run, see ``android.aio``.
+        """
+        cmdline_str = " ".join(cmdline)
+        memory, cpu = self.cost()
+        waited = self.governor.acquire(memory, cpu)
+        if waited > 0.1:
+            log.debug('Waited %.1fs to run %s' % (waited, cmdline_str))
+        try:
+            start = time.time()
+            process = subprocess.Popen(
+                cmdline,
+                shell=True if sys.platform=="win32" else False,
+                env=env,
+                stderr=subprocess.PIPE,
+                stdout=subprocess.PIPE)
+            usage = wait_with_usage(process)
+            usage.wall = time.time() - start
+        finally:
+            self.governor.release(memory, cpu)
+        usage.tool = self.__class__.__name__
+        usage.cmdline = cmdline_str
+        usage.queue_wait = waited
+        record_usage(usage)
+        self.emit_metrics(usage)
         if process.returncode != 0:
             raise ProgramFailedError(
                 cmdline_str,
@@ -98,6 +303,64 @@ class Program(object):
 
         return cmdline_str
 
+    def cost(self):
+        """Return the ``(memory, cpu)`` cost of running this tool.
+        """
+        return self.memory, self.cpu
+
+    def emit_metrics(self, usage):
+        tags = {'tool': usage.tool}
+        metrics.observe('tool_duration_seconds', usage.wall, tags)
+        metrics.observe('tool_queue_wait_seconds', usage.queue_wait, tags)
+        if usage.returncode != 0:
+            metrics.increment('tool_failures_total', tags=tags)
+
+
+def _parse_size(value):
+    """Convert a JVM memory size like "512m" into MB; returns ``None``
+    if ``value`` is not one.
+    """
+    match = re.match(r'(\d+)([kKmMgG]?)$', value)
+    if not match:
+        return None
+    number, unit = match.groups()
+    factor = {'k': 1.0 / 1024, 'm': 1, 'g': 1024, '': 1.0 / 1024 / 1024}
+    return int(int(number) * factor[unit.lower()])
+
+
+class JavaProgram(Program):
+    """A tool that runs in a JVM.
+
+    ``jvm_options`` is a list of options for the JVM, like
+    ``['-Xmx1g']``. If a maximum heap size is given, it determines
+    the memory cost of the tool.
+    """
+
+    # Overhead of the JVM on top of the heap, in MB.
+    jvm_overhead = 96
+
+    def __init__(self, *a, **kw):
+        Program.__init__(self, *a, **kw)
+        self.jvm_options = []
+
+    def cost(self):
+        for option in reversed(self.jvm_options):
+            if option.startswith('-Xmx'):
+                size = _parse_size(option[4:])
+                if size is None:
+                    # The JVM will complain; the default will do until then.
+                    log.warning('Cannot tell the memory cost of %s from %s' % (
+                        self.__class__.__name__, option))
+                    break
+                return size + self.jvm_overhead, self.cpu
+        return Program.cost(self)
+
+    def jvm_args(self):
+        """Format ``jvm_options`` as arguments to the tool; most Java
+        tools want them prefixed with -J.
+        """
+        return ['-J%s' % option for option in self.jvm_options]
+
 
 class Aapt(Program):
     """Interface to the ``aapt`` tool used to package resources.
@@ -108,7 +371,9 @@ class Aapt(Program):
                  r_output=None, configurations=None,
                  rename_manifest_package=None, overwrite_version_code=None,
                  overwrite_version_name=None,
-                 make_dirs=None, overwrite=None):
+                 make_dirs=None, overwrite=None, no_compress=[],
+                 auto_add_overlay=None, extra_packages=[],
+                 non_constant_id=None):
         """
         command
             The APPT command to execute.
@@ -117,7 +382,8 @@ class Aapt(Program):
             AndroidManifest.xml to include in zip (-M).
 
         resource_dir
-            Directory in which to find resources (-S).
+            Directory in which to find resources, or a list of them,
+            the first one having the highest priority (-S).
 
         asset_dir
             Additional directory in which to find raw asset files (-A).
@@ -133,18 +399,41 @@ class Aapt(Program):
 
         make_dirs
             Make package directories for ``r_output`` option (-m).
+
+        no_compress
+            Extensions of files to store uncompressed; an empty string
+            means all files (-0).
+
+        auto_add_overlay
+            Allow resources which only exist in the overlays, that is,
+            in all but the first ``resource_dir`` (--auto-add-overlay).
+
+        extra_packages
+            Packages for which to generate an R.java as well, with the
+            same ids (--extra-packages).
+
+        non_constant_id
+            Generate an R.java whose ids are not constants, as needed
+            for library projects (--non-constant-id).
         """
 
         args = [command]
         self.extend_args(args, ['-m'], make_dirs)
         self.extend_args(args, ['-M', manifest])
-        self.extend_args(args, ['-S', resource_dir])
+        if not isinstance(resource_dir, (list, tuple)):
+            resource_dir = [resource_dir]
+        for directory in resource_dir:
+            self.extend_args(args, ['-S', directory])
+        self.extend_args(args, ['--auto-add-overlay'], auto_add_overlay)
+        if extra_packages:
+            args.extend(['--extra-packages', ':'.join(extra_packages)])
+        self.extend_args(args, ['--non-constant-id'], non_constant_id)
         self.extend_args(args, ['-A', asset_dir])
         self.extend_args(args, ['-c', configurations])
         if overwrite_version_code:
             self.extend_args(
                 args, ['--version-code', "%s" % overwrite_version_code])
-        self.extend_args(args, ['--version-code', overwrite_version_name])
+        self.extend_args(args, ['--version-name', overwrite_version_name])
         self.extend_args(
             args, ['--rename-manifest-package', rename_manifest_package])
         for item in include:
@@ -152,6 +441,8 @@ class Aapt(Program):
         self.extend_args(args, ['-F', apk_output])
         self.extend_args(args, ['-J', r_output])
         self.extend_args(args, ['-f'], overwrite)
+        for extension in no_compress:
+            args.extend(['-0', extension])
         return Program.__call__(self, args)
 
 
@@ -169,14 +460,17 @@ class Aidl(Program):
             File created by --preprocess to import (-p).
 
         search_path
-            Search path for import statements (-I).
+            Directories to search for import statements (-I).
 
         output_folder
             Base output folder for generated files (-o).
         """
         args = []
         self.extend_args(args, ['-p%s' % preprocessed], preprocessed)
-        self.extend_args(args, ['-I%s' % search_path], search_path)
+        if not isinstance(search_path, (list, tuple)):
+            search_path = [search_path]
+        for directory in search_path:
+            self.extend_args(args, ['-I%s' % directory], directory)
         self.extend_args(args, ['-o%s' % output_folder], output_folder)
         self.extend_args(args, [aidl_file])
         return Program.__call__(self, args)
@@ -186,6 +480,8 @@ class LlvmRs(Program):
     """Interface to the command line llvm renderscript compiler, ``llvm-rs-cc``
     """
 
+    memory = 256
+
     def __call__(self, resource_dir, resource_gen_dir, source_files, include_dirs):
         args = []
         for include in include_dirs:
@@ -201,6 +497,8 @@ class NdkBuild(Program):
     """Interface to the command line c/c++ compiler, ``ndk-build``
     """
 
+    memory = 512
+
     def __call__(self, project_path):
         """
         project_path
@@ -221,17 +519,25 @@ class NdkClean(Program):
         return Program.__call__(self, args)
 
 
-class JavaC(Program):
+class JavaC(JavaProgram):
     """Interface to the Java command line compiler, ``javac``.
     """
 
+    memory = 512
+
     def __call__(self, files, destdir=None, encoding=None,
                  target=None, classpath=[], bootclasspath=None,
-                 debug=None):
+                 debug=None, argfile=None):
         """
         files
             Files to be compiled (<source files>).
 
+        argfile
+            If given, the names of the ``files`` are written to this
+            file, which ``javac`` reads them from (@argfile), rather
+            than putting them on the command line, which has a length
+            limit. The caller deletes it.
+
         destdir
             Where to place generated class files (-d).
 
@@ -248,7 +554,7 @@ class JavaC(Program):
         target
             Generate class files for specific VM version (-target).
         """
-        args = []
+        args = self.jvm_args()
         self.extend_args(args, ['-encoding', encoding])
         self.extend_args(args, ['-target', target])
         self.extend_args(args, ['-source', target])
@@ -257,15 +563,30 @@ class JavaC(Program):
             args, ['-classpath', ":".join(classpath)], classpath)
         self.extend_args(args, ['-bootclasspath', bootclasspath])
         args.extend(['-g' if debug else '-g:none'])
-        args.extend(files)
+        if argfile:
+            with open(argfile, 'w') as f:
+                for filename in files:
+                    # Quoted, for names with spaces.
+                    f.write('"%s"\n' % filename.replace(
+                        '\\', '\\\\').replace('"', '\\"'))
+            args.append('@%s' % argfile)
+        else:
+            args.extend(files)
         return Program.__call__(self, args)
 
 
-class Dx(Program):
+class Dx(JavaProgram):
     """Interface to the ``dx`` command line tool which converts Java
     bytecode to Android's Dalvik bytecode.
     """
 
+    # The dx script defaults to -Xmx1024M.
+    memory = 1024 + JavaProgram.jvm_overhead
+
+    def jvm_args(self):
+        # The dx script wants -JXmx1g rather than -J-Xmx1g.
+        return ['-J%s' % option.lstrip('-') for option in self.jvm_options]
+
     def __call__(self, files, output=None):
         """
         files
@@ -275,13 +596,56 @@ class Dx(Program):
         output
             Target output file (--output).
         """
-        args = ['--dex']
+        args = self.jvm_args() + ['--dex']
         self.extend_args(args, ["--output=%s" % output])
         args.extend(files)
         return Program.__call__(self, args)
 
 
-class ApkBuilder(Program):
+class ProGuard(JavaProgram):
+    """Interface to ProGuard, as included in the SDK's tools/proguard
+    folder, which shrinks and optimizes Java bytecode.
+
+    The script does not pass any options on to the JVM, so
+    ``jvm_options`` have no effect, on the JVM or on the cost; change
+    ``memory`` to match the heap size the script uses.
+    """
+
+    memory = 512 + JavaProgram.jvm_overhead
+
+    def jvm_args(self):
+        return []
+
+    def cost(self):
+        return Program.cost(self)
+
+    def __call__(self, injars, outjar, libraryjars=[], configs=[]):
+        """
+        injars
+            Class file directories and jars to process (-injars).
+
+        outjar
+            The jar to write the result to (-outjars).
+
+        libraryjars
+            Jars which the code is compiled against, but which are not
+            to be included in the output (-libraryjars).
+
+        configs
+            Configuration files (@file).
+        """
+        args = self.jvm_args()
+        args.extend(['-injars', os.pathsep.join(injars)])
+        args.extend(['-outjars', outjar])
+        self.extend_args(
+            args, ['-libraryjars', os.pathsep.join(libraryjars)],
+            libraryjars)
+        for config in configs:
+            args.append('@%s' % config)
+        return Program.__call__(self, args)
+
+
+class ApkBuilder(JavaProgram):
     """Interface to the ``apkbuilder`` command line tool.
 
     The version of ``apkbuilder`` included with the Android SDK is
@@ -289,6 +653,9 @@ class ApkBuilder(Program):
     to find a version better suited to be used.
     """
 
+    # Our script defaults to -Xmx128M.
+    memory = 128 + JavaProgram.jvm_overhead
+
     def __call__(self, outputfile, dex=None, zips=[], source_dirs=[],
                  jar_paths=[], native_dirs=[]):
         """
@@ -321,17 +688,20 @@ class ApkBuilder(Program):
             args.extend(['-rj', item])
         for item in native_dirs:
             args.extend(['-nf', item])
-        return Program.__call__(
-            self, args,
-            {'ANDROID_SDK_DIR': self.framework.sdk_dir}, shell=True)
+        env = {'ANDROID_SDK_DIR': self.framework.sdk_dir}
+        if self.jvm_options:
+            env['APKBUILDER_JAVA_OPTS'] = " ".join(self.jvm_options)
+        return Program.__call__(self, args, env, shell=True)
 
 
-class JarSigner(Program):
+class JarSigner(JavaProgram):
     """Interface to the ``jarsigner`` command line tool.
     """
 
+    memory = 256
+
     def __call__(self, jarfile, keystore, alias, password):
-        args = []
+        args = self.jvm_args()
         args.extend(['-keystore', keystore])
         args.extend(['-storepass', password])
         args.extend(['-digestalg', 'SHA1'])
@@ -0,0 +1,185 @@
+"""
+Copyright (c) 2011 Michael Elsdoerfer <michael@elsdoerfer.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import errno
+import shutil
+import tempfile
+import logging
+from os import path
+
+
+__all__ = ('Workspace',)
+
+
+# Same logger as android.build, which imports us.
+log = logging.getLogger('py-androidbuild')
+
+
+# From <linux/fs.h>: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    """Create ``dst`` as a copy-on-write clone of ``src``. Only works
+    on Linux filesystems supporting it (btrfs, xfs...); raises
+    ``IOError``/``OSError`` otherwise.
+    """
+    import fcntl
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except (IOError, OSError):
+                fdst.close()
+                os.unlink(dst)
+                raise
+    shutil.copystat(src, dst)
+
+
+class Workspace(object):
+    """A lightweight snapshot of a project tree, in which a build
+    variant can modify sources without affecting the original checkout.
+
+    Files are not copied. Where the filesystem supports it, they are
+    reflinked, which gives real copy-on-write semantics. Otherwise they
+    are hardlinked, which is just as cheap, but means that a file must
+    not be written to in-place: use ``writable()`` or ``open()`` to get
+    a private copy of a file before you change it. Replacing a file
+    (writing a new one and renaming it over the old), or deleting it,
+    is always safe.
+
+    Directories are always created fresh, so adding new files to the
+    snapshot does not affect the original tree either.
+
+    ``exclude`` is a list of top-level names not to include (build
+    output directories by default), ``copy`` a list of top-level names
+    which should be fully copied rather than linked, for example
+    because an external tool will write into them.
+    """
+
+    default_exclude = ('bin', 'gen', 'obj', '.git', '.svn', '.hg')
+
+    def __init__(self, source, directory=None, exclude=None, copy=()):
+        self.source = path.abspath(source)
+        if not directory:
+            directory = tempfile.mkdtemp(
+                prefix='%s-' % path.basename(self.source))
+        self.directory = path.abspath(directory)
+        self.exclude = self.default_exclude if exclude is None else exclude
+        self.copy = copy
+        # Relative paths of files which share an inode with the original.
+        self.linked = set()
+        self._can_reflink = hasattr(os, 'uname') and \
+            os.uname()[0] == 'Linux'
+        self._populate()
+
+    def __repr__(self):
+        return '%s <%s>' % (self.__class__.__name__, self.directory)
+
+    def _populate(self):
+        log.info('Creating workspace %s from %s' % (
+            self.directory, self.source))
+        if not path.exists(self.directory):
+            os.makedirs(self.directory)
+        for name in os.listdir(self.source):
+            if name in self.exclude:
+                continue
+            src = path.join(self.source, name)
+            dst = path.join(self.directory, name)
+            if name in self.copy:
+                if path.isdir(src):
+                    shutil.copytree(src, dst, symlinks=True)
+                else:
+                    shutil.copy2(src, dst)
+            elif path.isdir(src) and not path.islink(src):
+                self._clone_tree(src, dst)
+            else:
+                self._clone_file(src, dst)
+
+    def _clone_tree(self, src, dst):
+        os.mkdir(dst)
+        for base, dirs, files in os.walk(src):
+            target = path.join(dst, path.relpath(base, src))
+            for d in list(dirs):
+                if path.islink(path.join(base, d)):
+                    # os.walk() does not follow these, treat as a file.
+                    dirs.remove(d)
+                    files.append(d)
+                else:
+                    os.mkdir(path.join(target, d))
+            for f in files:
+                self._clone_file(path.join(base, f), path.join(target, f))
+
+    def _clone_file(self, src, dst):
+        if path.islink(src):
+            os.symlink(os.readlink(src), dst)
+            return
+        if self._can_reflink:
+            try:
+                _reflink(src, dst)
+                return
+            except (IOError, OSError) as e:
+                if e.errno in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL,
+                               errno.ENOTTY):
+                    # Don't bother trying again for every single file.
+                    self._can_reflink = False
+                else:
+                    raise
+        try:
+            os.link(src, dst)
+        except (OSError, AttributeError):
+            shutil.copy2(src, dst)
+        else:
+            self.linked.add(path.relpath(dst, self.directory))
+
+    def path(self, *parts):
+        """Return the absolute path of ``parts`` within the workspace.
+        """
+        return path.join(self.directory, *parts)
+
+    def writable(self, filename):
+        """Make sure ``filename`` (relative to the workspace, or an
+        absolute path within it) can be modified in-place without
+        affecting the original tree, and return its absolute path.
+        """
+        fullpath = path.abspath(self.path(filename))
+        relpath = path.relpath(fullpath, self.directory)
+        if relpath in (os.curdir, os.pardir) or \
+                relpath.startswith(os.pardir + os.sep):
+            raise ValueError('%s is not in the workspace %s' % (
+                filename, self.directory))
+        if relpath in self.linked:
+            fd, tmp = tempfile.mkstemp(dir=path.dirname(fullpath))
+            os.close(fd)
+            shutil.copy2(fullpath, tmp)
+            os.rename(tmp, fullpath)
+            self.linked.discard(relpath)
+        return fullpath
+
+    def open(self, filename, mode='r'):
+        """Open a file in the workspace; if it is opened for writing,
+        a private copy will be created first.
+        """
+        if any(c in mode for c in 'wa+'):
+            return open(self.writable(filename), mode)
+        return open(self.path(filename), mode)
+
+    def delete(self):
+        """Remove the workspace directory.
+        """
+        log.info('Deleting tree: %s' % self.directory)
+        shutil.rmtree(self.directory)
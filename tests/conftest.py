@@ -0,0 +1,6 @@
+import sys
+from os import path
+
+# Test the code in the checkout, rather than an installed version.
+sys.path.insert(0, path.join(path.dirname(path.dirname(
+    path.abspath(__file__))), 'src'))
@@ -0,0 +1,47 @@
+import zipfile
+
+from android.apkzip import ApkReader, normalize, DETERMINISTIC_TIME
+
+
+def make_zip(filename):
+    with zipfile.ZipFile(filename, 'w') as archive:
+        for name, date_time, method in [
+                ('res/raw/b.bin', (2015, 3, 4, 5, 6, 8), zipfile.ZIP_STORED),
+                ('AndroidManifest.xml', (2012, 1, 1, 0, 0, 0),
+                 zipfile.ZIP_DEFLATED),
+                ('classes.dex', (2014, 7, 1, 12, 0, 0), zipfile.ZIP_STORED),
+                ('assets/a.txt', (2013, 2, 2, 2, 2, 2),
+                 zipfile.ZIP_DEFLATED)]:
+            info = zipfile.ZipInfo(name, date_time)
+            info.compress_type = method
+            info.external_attr = 0o644 << 16
+            archive.writestr(info, (name * 50).encode('utf-8'))
+
+
+def test_normalize(tmpdir):
+    filename = str(tmpdir.join('test.apk'))
+    make_zip(filename)
+    normalize(filename)
+
+    with ApkReader(filename) as reader:
+        names = [e.name for e in reader.entries]
+        assert names == sorted(names)
+        for entry in reader.entries:
+            assert entry.date_time == DETERMINISTIC_TIME
+            assert entry.external_attr == 0
+            assert reader.read(entry) == (entry.name * 50).encode('utf-8')
+            if entry.method == zipfile.ZIP_STORED:
+                assert reader.data_offset(entry) % 4 == 0
+    with zipfile.ZipFile(filename) as archive:
+        assert archive.testzip() is None
+
+
+def test_normalize_is_idempotent(tmpdir):
+    filename = str(tmpdir.join('test.apk'))
+    make_zip(filename)
+    normalize(filename)
+    with open(filename, 'rb') as f:
+        once = f.read()
+    normalize(filename)
+    with open(filename, 'rb') as f:
+        assert f.read() == once
@@ -0,0 +1,123 @@
+import pytest
+
+from android.axml import (
+    Document, Node, Attribute, edit_manifest, ANDROID_NS, ATTRIBUTE_IDS,
+    RES_XML_START_NAMESPACE_TYPE, RES_XML_END_NAMESPACE_TYPE,
+    RES_XML_START_ELEMENT_TYPE, RES_XML_END_ELEMENT_TYPE, TYPE_STRING,
+    TYPE_INT_DEC)
+
+
+LABEL_ID = 0x01010001
+
+
+def android(name, value, type=TYPE_STRING, resource_id=None):
+    return Attribute(ANDROID_NS, name,
+                     value if type == TYPE_STRING else None, type, value,
+                     resource_id or ATTRIBUTE_IDS[name])
+
+
+def element(line, name, attributes):
+    node = Node(RES_XML_START_ELEMENT_TYPE, line, None, [None, name])
+    node.attributes = attributes
+    return node
+
+
+def end(line, name):
+    return Node(RES_XML_END_ELEMENT_TYPE, line, None, [None, name])
+
+
+def make_manifest(utf8=False):
+    """Built like aapt would compile:
+
+        <manifest xmlns:android="..." package="com.example.app"
+                  android:versionCode="3">
+            <application android:label="Example" android:name=".App">
+                <activity android:name="Main" />
+                <activity android:name="org.other.Activity" />
+            </application>
+        </manifest>
+    """
+    nodes = [
+        Node(RES_XML_START_NAMESPACE_TYPE, 1, None, ['android', ANDROID_NS]),
+        element(1, 'manifest', [
+            android('versionCode', 3, TYPE_INT_DEC),
+            Attribute(None, 'package', 'com.example.app', TYPE_STRING,
+                      'com.example.app')]),
+        element(3, 'application', [
+            android('label', 'Example', resource_id=LABEL_ID),
+            android('name', '.App')]),
+        element(4, 'activity', [android('name', 'Main')]),
+        end(4, 'activity'),
+        element(5, 'activity', [android('name', 'org.other.Activity')]),
+        end(5, 'activity'),
+        end(6, 'application'),
+        end(7, 'manifest'),
+        Node(RES_XML_END_NAMESPACE_TYPE, 7, None, ['android', ANDROID_NS]),
+    ]
+    return Document(nodes, utf8).to_bytes()
+
+
+def values(element):
+    return [(a.name, a.value) for a in element.attributes]
+
+
+@pytest.mark.parametrize('utf8', [False, True])
+def test_round_trip(utf8):
+    data = make_manifest(utf8)
+    document = Document.parse(data)
+    assert document.utf8 == utf8
+    assert document.to_bytes() == data
+    assert [e.name for e in document.elements()] == [
+        'manifest', 'application', 'activity', 'activity']
+    assert values(document.root) == [
+        ('versionCode', 3), ('package', 'com.example.app')]
+    assert document.root.get('versionCode').resource_id == \
+        ATTRIBUTE_IDS['versionCode']
+
+
+def test_edit_nothing():
+    data = make_manifest()
+    assert edit_manifest(data) == data
+
+
+def test_add_version_name():
+    data = edit_manifest(make_manifest(), version_name='1.0-beta')
+    document = Document.parse(data)
+    manifest = document.root
+    # In the order of the resource ids, before those without one.
+    assert values(manifest) == [
+        ('versionCode', 3), ('versionName', '1.0-beta'),
+        ('package', 'com.example.app')]
+    attribute = manifest.get('versionName')
+    assert attribute.ns == ANDROID_NS
+    assert attribute.raw == '1.0-beta'
+    assert attribute.resource_id == ATTRIBUTE_IDS['versionName']
+    # The other elements kept their resource ids, too.
+    application = document.elements()[1]
+    assert application.get('label').resource_id == LABEL_ID
+    assert application.get('name').resource_id == ATTRIBUTE_IDS['name']
+    # And once it is there, it is changed in place.
+    again = Document.parse(edit_manifest(data, version_name='1.0'))
+    assert values(again.root) == [
+        ('versionCode', 3), ('versionName', '1.0'),
+        ('package', 'com.example.app')]
+
+
+def test_change_version_code():
+    document = Document.parse(edit_manifest(make_manifest(), version_code=42))
+    attribute = document.root.get('versionCode')
+    assert attribute.type == TYPE_INT_DEC
+    assert attribute.value == 42
+    assert len(document.root.attributes) == 2
+
+
+def test_change_package():
+    document = Document.parse(edit_manifest(
+        make_manifest(), package='com.example.app.pay'))
+    assert document.root.get('package', ns=None).value == \
+        'com.example.app.pay'
+    # Class names still refer to the classes of the old package.
+    names = [e.get('name').value for e in document.elements()[1:]]
+    assert names == ['com.example.app.App', 'com.example.app.Main',
+                     'org.other.Activity']
+    assert document.elements()[1].get('label').value == 'Example'
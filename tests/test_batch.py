@@ -0,0 +1,69 @@
+import zipfile
+from os import path
+
+import pytest
+
+import android.batch
+from android.batch import sign_batch, BatchError
+from android.signing import load_pem, verify_apk, VerificationError
+
+
+DATA = path.join(path.dirname(path.abspath(__file__)), 'data')
+
+
+def key():
+    return load_pem(path.join(DATA, 'key.pem'))
+
+
+def make_apks(directory, count):
+    apks = []
+    for i in range(count):
+        filename = str(directory.join('app%d.apk' % i))
+        with zipfile.ZipFile(filename, 'w') as archive:
+            archive.writestr('AndroidManifest.xml', b'\x03\x00\x08\x00' * 64)
+            archive.writestr('classes.dex', b'dex\n035\x00' * 500 * (i + 1),
+                             zipfile.ZIP_DEFLATED)
+        apks.append(filename)
+    return apks
+
+
+@pytest.mark.parametrize('processes', [False, True])
+def test_sign_batch(tmpdir, processes):
+    apks = make_apks(tmpdir.mkdir('unsigned'), 2)
+    output_dir = tmpdir.join('release')
+    summary = sign_batch(apks, str(output_dir), key(), verify=True,
+                         workers=2, processes=processes)
+    assert [r.output for r in summary.results] == [
+        str(output_dir.join('app0.apk')), str(output_dir.join('app1.apk'))]
+    for result in summary.results:
+        verify_apk(result.output)
+        assert result.error is None
+        assert set(result.timings) == set(['sign', 'verify', 'commit'])
+    assert sorted(p.basename for p in output_dir.listdir()) == [
+        'app0.apk', 'app1.apk']
+
+
+def test_sign_batch_failure(tmpdir, monkeypatch):
+    apks = make_apks(tmpdir.mkdir('unsigned'), 3)
+    # Not an APK at all.
+    tmpdir.join('unsigned', 'broken.apk').write('broken')
+    apks.append(str(tmpdir.join('unsigned', 'broken.apk')))
+
+    # Fails once signed, so that there is something to clean up.
+    def verify(filename):
+        if path.basename(filename).startswith('app1.'):
+            raise VerificationError('Forced failure')
+        return verify_apk(filename)
+    monkeypatch.setattr(android.batch, 'verify_apk', verify)
+
+    output_dir = tmpdir.join('release')
+    with pytest.raises(BatchError) as info:
+        sign_batch(apks, str(output_dir), key(), workers=2)
+    summary = info.value.summary
+    assert [path.basename(r.source) for r in summary.failed] == [
+        'app1.apk', 'broken.apk']
+    assert 'verify' in summary.failed[0].timings
+    assert 'verify' not in summary.failed[1].timings
+    # Only the complete outputs are there, and nothing else.
+    assert sorted(p.basename for p in output_dir.listdir()) == [
+        'app0.apk', 'app2.apk']
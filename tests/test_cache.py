@@ -0,0 +1,66 @@
+import pytest
+
+from android.cache import CacheServer, RemoteCache, content_key
+
+
+@pytest.fixture
+def server(tmpdir):
+    server = CacheServer(str(tmpdir.join('server'))).start()
+    yield server
+    server.stop()
+
+
+def test_put_and_get(tmpdir, server):
+    cache = RemoteCache(server.url)
+    source = tmpdir.join('classes.dex')
+    source.write_binary(b'dex\n035\x00' * 1000)
+    key = content_key('compile_java', [str(source)])
+    assert cache.put(key, str(source), wait=True)
+
+    target = tmpdir.join('downloaded.dex')
+    assert cache.get(key, str(target))
+    assert target.read_binary() == source.read_binary()
+    assert (cache.hits, cache.misses, cache.failures) == (1, 0, 0)
+
+
+def test_get_many(tmpdir, server):
+    cache = RemoteCache(server.url)
+    contents = [('%d' % i).encode('ascii') * 100 for i in range(3)]
+    keys = []
+    for i, data in enumerate(contents):
+        source = tmpdir.join('input%d' % i)
+        source.write_binary(data)
+        keys.append(content_key('step', [str(source)]))
+        # In the background, like a build would.
+        cache.put(keys[-1], str(source))
+    cache.wait()
+
+    missing = content_key('step', params='not uploaded')
+    items = [(key, str(tmpdir.join('output%d' % i)))
+             for i, key in enumerate(keys + [missing])]
+    assert cache.get_many(items) == [True, True, True, False]
+    for i, data in enumerate(contents):
+        assert tmpdir.join('output%d' % i).read_binary() == data
+    assert not tmpdir.join('output3').exists()
+    assert (cache.hits, cache.misses, cache.failures) == (3, 1, 0)
+    # Nothing was left behind by the miss.
+    assert not [p for p in tmpdir.listdir() if p.basename.startswith('tmp')]
+
+
+def test_read_only(tmpdir, server):
+    cache = RemoteCache(server.url, read_only=True)
+    source = tmpdir.join('input')
+    source.write('data')
+    key = content_key('step', [str(source)])
+    cache.put(key, str(source), wait=True)
+    assert not cache.get(key, str(tmpdir.join('output')))
+
+
+def test_server_unavailable(tmpdir, server):
+    url = server.url
+    server.stop()
+    cache = RemoteCache(url, max_failures=2)
+    key = content_key('step')
+    for _ in range(3):
+        assert not cache.get(key, str(tmpdir.join('output')))
+    assert cache.failures == 2 and not cache.enabled
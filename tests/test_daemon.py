@@ -0,0 +1,103 @@
+import threading
+
+import pytest
+
+from android.daemon import (
+    BuildDaemon, BuildResult, BuildTimeout, InotifyWatcher, request_build)
+
+
+class Project(object):
+    name = 'test'
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+
+
+class Watcher(object):
+    """Reports a change every time ``changes`` is set."""
+
+    def __init__(self):
+        self.changes = threading.Event()
+
+    def wait(self, timeout):
+        if self.changes.wait(timeout):
+            self.changes.clear()
+            return set(['src/Main.java'])
+        return set()
+
+    def close(self):
+        pass
+
+
+class Daemon(BuildDaemon):
+    """Does not build anything, but can be made to take its time."""
+
+    def __init__(self, *a, **kw):
+        BuildDaemon.__init__(self, *a, **kw)
+        self.go = threading.Event()
+        self.go.set()
+
+    def affected_steps(self, changed):
+        return set(['compile_java'])
+
+    def build(self, steps=None):
+        self.go.wait()
+        self._number += 1
+        with self._condition:
+            self.last_result = BuildResult(self._number, apk='test.apk')
+            self._condition.notify_all()
+
+
+@pytest.fixture
+def daemon(tmpdir):
+    daemon = Daemon(Project(str(tmpdir)), watcher=Watcher())
+    thread = threading.Thread(target=daemon.serve_forever)
+    thread.start()
+    yield daemon
+    daemon.go.set()
+    daemon.stop()
+    thread.join()
+
+
+def test_request_build(daemon):
+    assert daemon.request_build(5).number == 1
+    daemon.watcher.changes.set()
+    assert daemon.request_build(5).number == 2
+    # Nothing changed.
+    assert daemon.request_build(5).number == 2
+
+    result = request_build(daemon.address, 5)
+    assert result['ok'] and result['number'] == 2
+
+
+def test_request_build_timeout(daemon):
+    daemon.request_build(5)
+    daemon.go.clear()
+    daemon.watcher.changes.set()
+    with pytest.raises(BuildTimeout):
+        daemon.request_build(0.5)
+    result = request_build(daemon.address, 0.5)
+    assert result['timeout'] and not result['ok']
+
+
+def test_watch_new_directories(tmpdir):
+    try:
+        watcher = InotifyWatcher([str(tmpdir.join('src')),
+                                  str(tmpdir.join('jni'))])
+    except OSError:
+        pytest.skip('inotify is not available')
+    try:
+        tmpdir.join('jni', 'sub').ensure(dir=True)
+        tmpdir.join('jni', 'sub', 'main.c').write('int x;')
+        changed = watcher.wait(1)
+        while True:
+            more = watcher.wait(0.2)
+            if not more:
+                break
+            changed |= more
+        assert changed == set([str(tmpdir.join('jni', 'sub', 'main.c'))])
+
+        tmpdir.join('other.txt').write('')
+        assert watcher.wait(0.2) == set()
+    finally:
+        watcher.close()
@@ -0,0 +1,176 @@
+import json
+import threading
+from os import path
+try:
+    from SocketServer import BaseRequestHandler
+except ImportError:
+    from socketserver import BaseRequestHandler
+
+import pytest
+
+from android.build import AndroidProject, Apk, CodeObj, ResourceObj
+from android.distributed import Coordinator, Worker, _recv, _send
+from android.packaging import Deflater
+from android.plan import StepHistory
+
+
+class Jars(object):
+
+    def resolve(self, jars):
+        return list(jars)
+
+
+class Platform(object):
+    """Writes down what it was asked to build, instead of building."""
+
+    version = 'android-19'
+    sdk_dir = '/sdk'
+
+    def __init__(self):
+        self.jars = Jars()
+        self.deterministic = False
+        self.deflater = None
+
+    def pack_resources(self, output, package_name=None, version_code=None,
+                       **kwargs):
+        with open(output, 'w') as f:
+            json.dump({'package_name': package_name,
+                       'version_code': version_code}, f)
+        return ResourceObj(output)
+
+    def build_apk(self, output, code=None, resources=None, **kwargs):
+        with open(resources.filename) as f:
+            result = json.load(f)
+        with open(code.filename) as f:
+            result['code'] = f.read()
+        result.update(resources=resources.filename,
+                      deterministic=self.deterministic,
+                      level=self.deflater and self.deflater.level)
+        with open(output, 'w') as f:
+            json.dump(result, f)
+        return Apk(self, output)
+
+
+class StubWorker(Worker):
+
+    def get_platform(self, target):
+        assert target == Platform.version
+        return Platform()
+
+
+class _DyingHandler(BaseRequestHandler):
+
+    def handle(self):
+        worker = self.server.worker
+        upload = path.join(worker.directory, 'upload.part')
+        while True:
+            request = _recv(self.request, upload)
+            if request['op'] == 'build':
+                # Gone, without a response.
+                worker.died.set()
+                return
+            _send(self.request, *worker.handle(request, upload))
+
+
+class DyingWorker(StubWorker):
+    """Drops the connection when asked to build anything."""
+
+    def __init__(self, *a, **kw):
+        StubWorker.__init__(self, *a, **kw)
+        self.server.RequestHandlerClass = _DyingHandler
+        self.died = threading.Event()
+
+
+class PatientWorker(StubWorker):
+    """Waits for the other worker to die before building anything."""
+
+    def __init__(self, other, *a, **kw):
+        StubWorker.__init__(self, *a, **kw)
+        self.other = other
+
+    def _build(self, bundle_dir, variant):
+        self.other.died.wait(5)
+        return StubWorker._build(self, bundle_dir, variant)
+
+
+@pytest.fixture
+def project(tmpdir):
+    tmpdir.join('app', 'AndroidManifest.xml').write(
+        '<manifest package="com.example" />', ensure=True)
+    tmpdir.join('app', 'res', 'values', 'strings.xml').write(
+        '<resources />', ensure=True)
+    tmpdir.join('classes.dex').write('dex')
+    platform = Platform()
+    platform.deterministic = True
+    platform.deflater = Deflater(level=5)
+    project = AndroidProject(str(tmpdir.join('app', 'AndroidManifest.xml')),
+                             name='example', platform=platform)
+    project.code = CodeObj(str(tmpdir.join('classes.dex')))
+    return project
+
+
+def variants(tmpdir, count):
+    return [{'output': str(tmpdir.join('app-%d.apk' % i)),
+             'package_name': 'com.example.app%d' % i,
+             'version_code': i}
+            for i in range(count)]
+
+
+def read(apk):
+    with open(apk.filename) as f:
+        return json.load(f)
+
+
+def test_build(tmpdir, project):
+    workers = [StubWorker(None, directory=str(tmpdir.mkdir('worker%d' % i)))
+               .start() for i in range(2)]
+    try:
+        history = str(tmpdir.join('history.jsonl'))
+        coordinator = Coordinator([w.address for w in workers], history)
+        apks = coordinator.build(project, variants(tmpdir, 4))
+    finally:
+        for worker in workers:
+            worker.stop()
+
+    out_dirs = set()
+    for i, apk in enumerate(apks):
+        assert apk.filename == str(tmpdir.join('app-%d.apk' % i))
+        result = read(apk)
+        assert result['package_name'] == 'com.example.app%d' % i
+        assert result['version_code'] == i
+        assert result['code'] == 'dex'
+        # The settings of the coordinator's platform.
+        assert result['deterministic'] and result['level'] == 5
+        out_dirs.add(path.dirname(result['resources']))
+    # One output directory for the project on each worker, at most.
+    assert len(out_dirs) <= 2
+    assert not [p for p in tmpdir.listdir() if p.ext == '.part']
+
+    history = StepHistory(history)
+    for i in range(4):
+        assert history.estimate('app-%d.apk' % i) is not None
+
+
+def test_worker_drops_out(tmpdir, project):
+    dying = DyingWorker(None, directory=str(tmpdir.mkdir('dying'))).start()
+    patient = PatientWorker(
+        dying, None, directory=str(tmpdir.mkdir('patient'))).start()
+    try:
+        coordinator = Coordinator([dying.address, patient.address])
+        apks = coordinator.build(project, variants(tmpdir, 3))
+    finally:
+        dying.stop()
+        patient.stop()
+
+    assert dying.died.is_set()
+    # The variant the dying worker had was built by the other.
+    assert [read(apk)['version_code'] for apk in apks] == [0, 1, 2]
+    assert not [p for p in tmpdir.listdir() if p.ext == '.part']
+
+
+def test_no_worker(tmpdir, project):
+    worker = StubWorker(None, directory=str(tmpdir.mkdir('worker'))).start()
+    address = worker.address
+    worker.stop()
+    with pytest.raises(RuntimeError):
+        Coordinator([address]).build(project, variants(tmpdir, 1))
@@ -0,0 +1,147 @@
+import json
+
+import pytest
+
+import android.build
+from android.build import (
+    AndroidProject, CodeObj, PlatformTarget, is_current, set_current)
+from android.plan import StepHistory
+from android.report import BuildReport
+
+
+def write_history(filename, reports):
+    with open(filename, 'w') as f:
+        for steps in reports:
+            f.write(json.dumps({'name': 'test', 'steps': [
+                dict({'parent': None, 'up_to_date': False}, **step)
+                for step in steps]}) + '\n')
+
+
+HISTORY = [
+    [{'name': 'compile', 'wall': 30.0},
+     {'name': 'compile_java', 'wall': 20.0, 'parent': 'compile'},
+     {'name': 'pack_resources', 'wall': 4.0},
+     {'name': 'build_apk', 'wall': 2.0}],
+    [{'name': 'compile', 'wall': 10.0},
+     {'name': 'pack_base_resources', 'wall': 5.0},
+     {'name': 'build_apk', 'wall': 3.0}],
+    [{'name': 'compile', 'wall': 0.1, 'up_to_date': True},
+     {'name': 'derive_resources', 'wall': 0.5},
+     {'name': 'build_apk', 'wall': 4.0},
+     {'name': 'build_apk', 'wall': None}],
+]
+
+
+def test_history(tmpdir):
+    filename = str(tmpdir.join('history.jsonl'))
+    write_history(filename, HISTORY)
+    with open(filename, 'a') as f:
+        # A report which was cut short.
+        f.write('{"name": "test", "ste\n')
+
+    history = StepHistory(filename)
+    # The median; up-to-date runs, and inner steps, do not count.
+    assert history.estimate('compile') == 20.0
+    assert history.estimate('build_apk') == 3.0
+    assert history.estimate('compile_java') is None
+    assert history.estimate('pack_resources') == 4.0
+    assert history.estimate('pack_base_resources') == 5.0
+    assert history.estimate('derive_resources') == 0.5
+    assert history.estimate('shrink') is None
+
+    # Only the most recent ones.
+    assert StepHistory(filename, limit=2).estimate('build_apk') == 3.5
+
+    history.record('app.apk', 7.0)
+    assert history.estimate('app.apk') == 7.0
+    assert StepHistory(filename).estimate('app.apk') == 7.0
+    assert StepHistory(str(tmpdir.join('missing'))).durations == {}
+
+
+class Platform(PlatformTarget):
+    """Without any tools; packages resources by writing a file."""
+
+    def __init__(self):
+        self.version = 'android-19'
+        self.sdk_dir = '/sdk'
+        self.cache = None
+        self.deflater = None
+        self.deterministic = False
+        self.packed = []
+
+    def _pack_resources(self, manifest, resource_dir, asset_dir,
+                        configurations, output):
+        self.packed.append(output)
+        with open(output, 'w') as f:
+            f.write('resources')
+
+
+@pytest.fixture
+def project(tmpdir):
+    tmpdir.join('app', 'AndroidManifest.xml').write(
+        '<manifest package="com.example" />', ensure=True)
+    tmpdir.join('app', 'res', 'values', 'strings.xml').write(
+        '<resources />', ensure=True)
+    project = AndroidProject(str(tmpdir.join('app', 'AndroidManifest.xml')),
+                             name='example', platform=Platform())
+    project.out_dir = str(tmpdir.mkdir('out'))
+    project.history_file = str(tmpdir.join('history.jsonl'))
+    write_history(project.history_file, HISTORY)
+    return project
+
+
+def steps(plan):
+    return [(s.name, s.run, s.estimate) for s in plan.steps]
+
+
+def test_plan(project):
+    assert steps(project.plan()) == [
+        ('compile', True, 20.0),
+        ('pack_resources', True, 4.0),
+        ('build_apk', True, 3.0)]
+
+    project.code = CodeObj('classes.dex')
+    plan = project.plan(package_name='com.example.pro')
+    assert steps(plan) == [
+        ('compile', False, 0),
+        ('pack_base_resources', True, 5.0),
+        ('build_apk', True, 3.0)]
+    assert plan.estimate == 8.0
+
+    # Once the base is there, variants are derived from it.
+    kwargs = project._resource_args(None, None, None, None)
+    platform = project.platform
+    base = platform._base_resources(kwargs['output'])
+    with open(base, 'w') as f:
+        f.write('resources')
+    set_current(base, platform._resources_fingerprint(
+        kwargs['manifest'], kwargs['resource_dir'], None, None))
+    assert steps(project.plan(package_name='com.example.pro')) == [
+        ('compile', False, 0),
+        ('derive_resources', True, 0.5),
+        ('build_apk', True, 3.0)]
+
+
+def test_variant_steps(project, monkeypatch):
+    """The build reports variants under the names the plan uses."""
+    derived = []
+    monkeypatch.setattr(android.build, 'derive_resources',
+                        lambda base, output, *a, **kw: derived.append(output))
+    kwargs = project._resource_args(None, 'com.example.pro', None, None)
+    platform = project.platform
+    report = BuildReport('test')
+    with report.activate():
+        platform.pack_resources(**kwargs)
+        platform.pack_resources(**kwargs)
+    assert [s.name for s in report.steps] == [
+        'pack_base_resources', 'derive_resources']
+    assert platform.packed == [platform._base_resources(kwargs['output'])]
+    assert derived == [kwargs['output']] * 2
+    assert is_current(platform.packed[0], platform._resources_fingerprint(
+        kwargs['manifest'], kwargs['resource_dir'], None, None))
+
+    report.append_to(project.history_file)
+    history = StepHistory(project.history_file)
+    assert history.estimate('pack_base_resources') is not None
+    assert history.estimate('derive_resources') is not None
+    assert history.estimate('pack_resources') == 4.0
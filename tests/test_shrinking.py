@@ -0,0 +1,76 @@
+import os
+import struct
+import zipfile
+
+from android.shrinking import code_references
+
+
+def utf8(text):
+    data = text.encode('utf-8')
+    return b'\x01' + struct.pack('>H', len(data)) + data
+
+
+def integer(value):
+    return b'\x03' + struct.pack('>I', value)
+
+
+def class_file(*constants):
+    """Just the start of a class file, up to the constant pool, which is
+    all that is looked at.
+    """
+    return b'\xca\xfe\xba\xbe\x00\x00\x00\x32' + \
+        struct.pack('>H', len(constants) + 1) + b''.join(constants)
+
+
+IDS = {('drawable', 'icon'): 0x7f020000,
+       ('drawable', 'unused'): 0x7f020001,
+       ('string', 'app_name'): 0x7f030000}
+
+
+def write(directory, name, data):
+    filename = os.path.join(directory, *name.split('/'))
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+
+def make_classes(directory):
+    # What javac makes of the R class: the names and ids of all.
+    write(directory, 'com/example/R.class', class_file(
+        utf8('com/example/R'), utf8('java/lang/Object')))
+    write(directory, 'com/example/R$drawable.class', class_file(
+        utf8('com/example/R$drawable'), utf8('icon'), utf8('unused'),
+        utf8('ConstantValue'), integer(0x7f020000), integer(0x7f020001)))
+    write(directory, 'com/example/R$string.class', class_file(
+        utf8('com/example/R$string'), utf8('app_name'),
+        integer(0x7f030000)))
+    # A library's R class, which is not final.
+    write(directory, 'com/library/R$drawable.class', class_file(
+        utf8('com/library/R$drawable'), utf8('icon'), utf8('unused'),
+        integer(0x7f020000), integer(0x7f020001)))
+    # The code, using one of them.
+    write(directory, 'com/example/Main.class', class_file(
+        utf8('com/example/Main'), utf8('onCreate'), integer(0x7f020000)))
+
+
+def test_code_references(tmpdir):
+    classes = str(tmpdir.join('classes'))
+    make_classes(classes)
+    assert code_references([classes], IDS, ['com.example', 'com.library']) \
+        == set([('drawable', 'icon')])
+    # Without knowing the packages, the R classes refer to everything.
+    assert code_references([classes], IDS) == set(IDS)
+
+
+def test_code_references_in_jar(tmpdir):
+    classes = str(tmpdir.join('classes'))
+    make_classes(classes)
+    jar = str(tmpdir.join('classes.jar'))
+    with zipfile.ZipFile(jar, 'w') as archive:
+        for base, dirs, files in os.walk(classes):
+            for f in files:
+                filename = os.path.join(base, f)
+                archive.write(filename, os.path.relpath(filename, classes))
+    assert code_references([jar], IDS, ['com.example', 'com.library']) == \
+        set([('drawable', 'icon')])
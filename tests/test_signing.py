@@ -0,0 +1,120 @@
+import zipfile
+import binascii
+from os import path
+
+import pytest
+
+from android.apkzip import ApkReader
+from android.signing import (
+    load_pem, load_keystore, sign_apk, verify_apk, UnsupportedKeyError,
+    VerificationError)
+
+
+DATA = path.join(path.dirname(path.abspath(__file__)), 'data')
+
+# Of the key in data/key.pem, also stored in data/key.jks, with the
+# alias "androiddebugkey" and the password "android".
+MODULUS = int(
+    'C025F11629C44DA5A9C57575C8456343FDB378EE9646656776345E1768FDB8C8'
+    'FC8688D5F3F6A09B66D35323F70DD20B34AFBBC15CFA3735E680641CBFE65436'
+    '75AF7C7FD601445EAF56BCBD8844C68358A659468C4BE6FF281BDDDE4D54612D'
+    '0A6DF426F3CDCA61053D4F356B26D7AAD3201D1FD1941DFF1493941372122953',
+    16)
+
+# Signatures of b'py-androidbuild', made by openssl dgst -sign.
+SIGNATURES = {
+    'SHA1':
+        '87e9cf3871526be4dc358a279e141c25906e9dc15921cc525f84ea5ae4b3682c'
+        'a1c7c6832e8b29f53c34294bb3c61227044a225e32fb3536d84bfee8de4a0501'
+        'bae8c7f86952222410921f6c75b333d4667ccb1ba0075b52c24adc1f15f2f4c3'
+        'd1e5dafe2656d9c32b8b6e3ea090e73511b15fc75c3d89c92b74ed4cb3676652',
+    'SHA-256':
+        'a2aa948a92c120ad4abe1d5e77c99d77b1406e05310273d5ad450108071bf9cb'
+        'b96823e2b546885caa99a7b0b0d8f9b743d695e51ec026a07ac8cd26dd4dd661'
+        '8f78d3df2c9abd7c94c08bb745b85501c80bcf891f7cb0a690c8353126ac9e6a'
+        'fecdca86a6ca60673bb118e6acdf8b945e5ad98b77735e25173b298c7bf8214a',
+}
+
+
+def key():
+    return load_pem(path.join(DATA, 'key.pem'))
+
+
+def make_apk(filename):
+    with zipfile.ZipFile(filename, 'w') as archive:
+        archive.writestr('AndroidManifest.xml', b'\x03\x00\x08\x00' * 64)
+        info = zipfile.ZipInfo('res/raw/data.bin')
+        info.compress_type = zipfile.ZIP_STORED
+        archive.writestr(info, b'stored' * 1000)
+        archive.writestr('res/', b'')
+        archive.writestr('classes.dex', b'dex\n035\x00' * 500,
+                         zipfile.ZIP_DEFLATED)
+        # Long enough to be wrapped in the manifest.
+        archive.writestr('assets/%s.txt' % ('long-name' * 10), b'text')
+        # To be replaced
+        archive.writestr('META-INF/OLD.SF', b'Signature-Version: 1.0\r\n')
+
+
+@pytest.mark.parametrize('digest', ['SHA1', 'SHA-256'])
+def test_signature(digest):
+    signature = key().sign(b'py-androidbuild', digest)
+    assert binascii.hexlify(signature).decode('ascii') == SIGNATURES[digest]
+
+
+@pytest.mark.parametrize('digest', ['SHA1', 'SHA-256'])
+def test_sign_and_verify(tmpdir, digest):
+    apk = str(tmpdir.join('app.apk'))
+    output = str(tmpdir.join('signed.apk'))
+    make_apk(apk)
+    sign_apk(apk, key(), output=output, digest=digest)
+    verify_apk(output)
+
+    with ApkReader(output) as reader:
+        names = [e.name for e in reader.entries]
+        manifest = reader.read(
+            reader.entries[names.index('META-INF/MANIFEST.MF')])
+    assert not 'META-INF/OLD.SF' in names
+    assert ('%s-Digest: ' % digest).encode('ascii') in manifest
+    # Nothing else was left behind.
+    assert sorted(tmpdir.listdir()) == sorted([tmpdir.join('app.apk'),
+                                               tmpdir.join('signed.apk')])
+
+
+def test_sign_in_place(tmpdir):
+    apk = str(tmpdir.join('app.apk'))
+    make_apk(apk)
+    assert sign_apk(apk, key()) == apk
+    verify_apk(apk)
+
+
+def test_verify_detects_changes(tmpdir):
+    apk = str(tmpdir.join('app.apk'))
+    make_apk(apk)
+    sign_apk(apk, key())
+    with zipfile.ZipFile(apk, 'a') as archive:
+        archive.writestr('assets/extra.txt', b'not signed')
+    with pytest.raises(VerificationError):
+        verify_apk(apk)
+
+    unsigned = str(tmpdir.join('unsigned.apk'))
+    make_apk(unsigned)
+    with pytest.raises(VerificationError):
+        verify_apk(unsigned)
+
+
+def test_keystore():
+    keystore = path.join(DATA, 'key.jks')
+    # Aliases are not case sensitive.
+    signing_key = load_keystore(keystore, 'AndroidDebugKey', 'android')
+    assert signing_key.modulus == MODULUS
+    assert signing_key.public_exponent == 65537
+    assert signing_key.exponent == key().exponent
+    assert signing_key.certificate == key().certificate
+
+    with pytest.raises(ValueError):
+        load_keystore(keystore, 'androiddebugkey', 'wrong')
+    with pytest.raises(ValueError):
+        load_keystore(keystore, 'other', 'android')
+    with pytest.raises(UnsupportedKeyError):
+        load_keystore(path.join(DATA, 'key.pem'), 'androiddebugkey',
+                      'android')
@@ -0,0 +1,25 @@
+import logging
+
+from android.tools import Dx, _parse_size
+
+
+def test_parse_size():
+    assert _parse_size('512m') == 512
+    assert _parse_size('2G') == 2048
+    assert _parse_size('1024k') == 1
+    assert _parse_size(str(64 * 1024 * 1024)) == 64
+    assert _parse_size('1.5g') is None
+    assert _parse_size('') is None
+
+
+def test_java_cost(caplog):
+    dx = Dx('dx')
+    assert dx.cost() == (dx.memory, dx.cpu)
+    # The last one counts, as it does for the JVM.
+    dx.jvm_options = ['-Xmx256m', '-Xss4m', '-Xmx1g']
+    assert dx.cost() == (1024 + dx.jvm_overhead, dx.cpu)
+
+    dx.jvm_options = ['-Xmx1.5g']
+    with caplog.at_level(logging.WARNING, 'py-androidbuild'):
+        assert dx.cost() == (dx.memory, dx.cpu)
+    assert '-Xmx1.5g' in caplog.text
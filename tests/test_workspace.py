@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+from android.workspace import Workspace
+
+
+def make_tree(directory):
+    directory.join('src', 'Main.java').write('class Main {}', ensure=True)
+    directory.join('res', 'raw', 'script.bc').write('old', ensure=True)
+    directory.join('bin', 'classes.dex').write('dex', ensure=True)
+
+
+def test_workspace(tmpdir):
+    source = tmpdir.join('project')
+    make_tree(source)
+    workspace = Workspace(str(source), str(tmpdir.join('workspace')))
+    assert not os.path.exists(workspace.path('bin'))
+    assert open(workspace.path('src', 'Main.java')).read() == \
+        'class Main {}'
+
+    with workspace.open('src/Main.java', 'w') as f:
+        f.write('class Changed {}')
+    # Absolute paths within the workspace work as well.
+    with open(workspace.writable(workspace.path('res', 'raw',
+                                                'script.bc')), 'w') as f:
+        f.write('new')
+    assert source.join('src', 'Main.java').read() == 'class Main {}'
+    assert source.join('res', 'raw', 'script.bc').read() == 'old'
+    assert open(workspace.path('res', 'raw', 'script.bc')).read() == 'new'
+    assert not workspace.linked & set([
+        os.path.join('src', 'Main.java'),
+        os.path.join('res', 'raw', 'script.bc')])
+
+    for outside in [str(source.join('src', 'Main.java')), '../x',
+                    workspace.directory]:
+        with pytest.raises(ValueError):
+            workspace.writable(outside)
+
+    workspace.delete()
+    assert not os.path.exists(workspace.directory)